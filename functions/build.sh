@@ -0,0 +1,25 @@
+#!/bin/bash
+# Vendors the segment_hunter package into each Cloud Function source directory, so
+# the directories can be zipped and deployed as they are. Run before terraform apply.
+#Fail Fast
+set -e
+
+if [ $# -lt 1 ]; then
+  echo "Usage: $0 <ENV>"
+  exit 1
+fi
+
+ENV=$1
+REPO_ROOT=$(git rev-parse --show-toplevel)
+
+for FUNCTION_DIR in "$REPO_ROOT"/functions/*/; do
+  rm -rf "$FUNCTION_DIR/segment_hunter" "$FUNCTION_DIR/terraform"
+  cp -r "$REPO_ROOT/src/segment_hunter" "$FUNCTION_DIR/segment_hunter"
+  find "$FUNCTION_DIR/segment_hunter" -name "__pycache__" -type d -prune -exec rm -rf {} +
+
+  if [ -f "$REPO_ROOT/terraform/terraform_outputs_$ENV.json" ]; then
+    mkdir -p "$FUNCTION_DIR/terraform"
+    cp "$REPO_ROOT/terraform/terraform_outputs_$ENV.json" "$FUNCTION_DIR/terraform/"
+  fi
+  echo "Vendored segment_hunter into $FUNCTION_DIR"
+done
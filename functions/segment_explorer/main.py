@@ -0,0 +1,3 @@
+"""Cloud Function entry point, the segment_hunter package is vendored by functions/build.sh"""
+
+from segment_hunter.worker import explore_pubsub_event as process_pubsub_event  # noqa: F401
@@ -1,6 +1,7 @@
-def main():
-    print("Hello from segment-hunter!")
+import sys
+
+from segment_hunter.cli import main
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,20 @@
+#!/bin/bash
+#Fail Fast
+set -e
+
+if [ $# -lt 2 ]; then
+  echo "Usage: $0 <GCP_PROJECT_ID> <ENV>"
+  exit 1
+fi
+
+GCP_PROJECT_ID=$1
+ENV=$2
+REPO_ROOT=$(git rev-parse --show-toplevel)
+
+docker build \
+  --build-arg GCP_PROJECT_ID="$GCP_PROJECT_ID" \
+  --build-arg ENV="$ENV" \
+  -f "$REPO_ROOT/services/segment_explorer/Dockerfile" \
+  -t segment_hunter/segment_explorer:latest \
+  -t segment_hunter/segment_explorer:$(git rev-parse --short HEAD) \
+  "$REPO_ROOT"
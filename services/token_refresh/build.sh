@@ -9,10 +9,12 @@ fi
 
 GCP_PROJECT_ID=$1
 ENV=$2
+REPO_ROOT=$(git rev-parse --show-toplevel)
 
 docker build \
   --build-arg GCP_PROJECT_ID="$GCP_PROJECT_ID" \
   --build-arg ENV="$ENV" \
+  -f "$REPO_ROOT/services/token_refresh/Dockerfile" \
   -t segment_hunter/token_refresh:latest \
   -t segment_hunter/token_refresh:$(git rev-parse --short HEAD) \
-  .
\ No newline at end of file
+  "$REPO_ROOT"
\ No newline at end of file
@@ -0,0 +1,16 @@
+"""Segment Hunter: explores Strava segments over a grid of bounding boxes
+
+The pipeline is split into stages, each in its own module:
+
+    grid      splits an area into bounding boxes and loads them into Postgres
+    dispatch  hands pending bounding boxes to an executor
+    fetch     calls the Strava explore endpoint for one bounding box
+    store     uploads results to GCS and records bounding box status
+    convert   turns stored results into NDJSON for BigQuery
+
+`executors` decides where the explore stage runs (inline, thread pool, asyncio or the
+Pub/Sub triggered Cloud Function), `worker` holds the Pub/Sub consumers, and `cli`
+exposes everything as the `segment-hunter` command.
+"""
+
+__version__ = "0.1.0"
@@ -0,0 +1,5 @@
+import sys
+
+from segment_hunter.cli import main
+
+sys.exit(main())
@@ -0,0 +1,332 @@
+"""Local analytics over stored segment outputs with DuckDB
+
+Questions about the crawled segments used to mean loading them into BigQuery and
+paying per query. `segment-hunter analytics` answers them on the machine it runs on:
+
+    segment-hunter analytics density --cell-degrees 0.05
+    segment-hunter analytics climbs --top 20
+    segment-hunter analytics sweep-diff --sweep-a 3 --sweep-b 4
+    segment-hunter analytics sql "SELECT activity_type, count(*) FROM segments GROUP BY 1"
+
+Outputs under a prefix of a blob store, NDJSON_PREFIX of BLOB_STORE_URL by default, are
+synced into ANALYTICS_CACHE_DIR through the same `BlobStore` the pipeline writes them
+with, so gs:// buckets are read with the application default credentials and local
+directories work the same. NDJSON objects, gzipped or not, are typed with
+SEGMENT_SCHEMA and compacted into one Parquet part per SYNC_CHUNK_BLOBS objects;
+Parquet objects are copied as they are. Only objects not synced before are
+downloaded, so a rerun only pays for what was stored since.
+
+Queries see two views over the parts:
+
+    segment_rows  every stored row, one per segment, tile and variant explored
+    segments      the last fetched row of each segment
+
+Results are cached as Parquet keyed by the query, its parameters and the parts it
+read, so repeating a query over unchanged data is read from disk. Syncing new parts
+clears the cached results.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from segment_hunter import logging_config
+from segment_hunter.config import DATA_DIR
+from segment_hunter.sinks import SEGMENT_SCHEMA
+from segment_hunter.store import GZIP_MAGIC
+
+logger = logging_config.get_logger(__name__)
+
+ANALYTICS_CACHE_DIR = os.getenv("ANALYTICS_CACHE_DIR", os.path.join(DATA_DIR, "analytics"))
+# Objects downloaded and compacted into one Parquet part at a time
+SYNC_CHUNK_BLOBS = int(os.getenv("ANALYTICS_SYNC_CHUNK_BLOBS", "500"))
+DUCKDB_TYPES = {"INT64": "BIGINT", "FLOAT64": "DOUBLE", "STRING": "VARCHAR", "BOOL": "BOOLEAN"}
+
+# name -> (description, SQL over the views, default parameters)
+QUERIES: Dict[str, Tuple[str, str, Dict[str, Any]]] = {
+    "density": (
+        "Distinct segments starting in each cell of a latitude/longitude lattice, densest first",
+        """
+        WITH cells AS (
+            SELECT floor(start_latlng[1] / $cell_degrees) * $cell_degrees AS cell_latitude,
+                   floor(start_latlng[2] / $cell_degrees) * $cell_degrees AS cell_longitude
+            FROM segments
+            WHERE len(start_latlng) = 2
+        )
+        SELECT cell_latitude,
+               cell_longitude,
+               count(*) AS segments,
+               -- Cell area from 111.32 km per degree, shrinking with the cosine of the latitude
+               round(count(*) / (pow($cell_degrees * 111.32, 2) * cos(radians(cell_latitude + $cell_degrees / 2))), 3)
+                   AS segments_per_km2
+        FROM cells
+        GROUP BY cell_latitude, cell_longitude
+        ORDER BY segments DESC, cell_latitude, cell_longitude
+        LIMIT $top
+        """,
+        {"cell_degrees": 0.01, "top": 50},
+    ),
+    "climbs": (
+        "Climb statistics of the distinct segments of each bounding box, most categorised climbs first",
+        """
+        SELECT bbox_id,
+               any_value(bbox) AS bbox,
+               count(*) AS segments,
+               count(*) FILTER (WHERE climb_category > 0) AS categorised_climbs,
+               max(climb_category) AS max_climb_category,
+               round(avg(avg_grade), 2) AS mean_grade,
+               max(avg_grade) AS max_grade,
+               round(sum(greatest(elev_difference, 0))) AS total_elevation_difference,
+               round(avg(distance)) AS mean_distance
+        FROM segments
+        WHERE bbox_id IS NOT NULL AND coalesce(climb_category, 0) >= $min_category
+        GROUP BY bbox_id
+        ORDER BY categorised_climbs DESC, total_elevation_difference DESC, bbox_id
+        LIMIT $top
+        """,
+        {"min_category": 0, "top": 50},
+    ),
+    "sweep-diff": (
+        "Segments found per bounding box by two sweeps, and those only one of them found, most changed first",
+        """
+        WITH a AS (SELECT DISTINCT bbox_id, id FROM segment_rows WHERE sweep_id = $sweep_a),
+             b AS (SELECT DISTINCT bbox_id, id FROM segment_rows WHERE sweep_id = $sweep_b)
+        SELECT coalesce(a.bbox_id, b.bbox_id) AS bbox_id,
+               count(a.id) AS segments_a,
+               count(b.id) AS segments_b,
+               count(*) FILTER (WHERE a.id IS NULL) AS new_segments,
+               count(*) FILTER (WHERE b.id IS NULL) AS gone_segments
+        FROM a FULL JOIN b ON a.bbox_id = b.bbox_id AND a.id = b.id
+        GROUP BY 1
+        ORDER BY new_segments + gone_segments DESC, bbox_id
+        LIMIT $top
+        """,
+        {"sweep_a": None, "sweep_b": None, "top": 50},
+    ),
+}
+
+
+def ndjson_columns() -> str:
+    """DuckDB `columns` argument typing NDJSON rows with SEGMENT_SCHEMA"""
+    columns = []
+    for name, field_type, mode in SEGMENT_SCHEMA:
+        duckdb_type = DUCKDB_TYPES[field_type] + ("[]" if mode == "REPEATED" else "")
+        columns.append(f"'{name}': '{duckdb_type}'")
+    return "{" + ", ".join(columns) + "}"
+
+
+def source_dir(store_url: str, prefix: str, cache_dir: str = ANALYTICS_CACHE_DIR) -> str:
+    """Cache directory of one store and prefix, named after both so it can be found by eye"""
+    readable = re.sub(r"[^A-Za-z0-9._-]+", "_", f"{store_url}_{prefix}").strip("_")[:80]
+    digest = hashlib.sha256(f"{store_url}\n{prefix}".encode("utf-8")).hexdigest()[:8]
+    return os.path.join(cache_dir, f"{readable}_{digest}")
+
+
+def read_manifest(path: str) -> set:
+    """Names of the objects synced so far"""
+    try:
+        with open(path) as f:
+            return {line.rstrip("\n") for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def compact_chunk(con, data: Dict[str, bytes], part_path: str) -> int:
+    """Writes the NDJSON objects of a chunk as one Parquet part typed with SEGMENT_SCHEMA
+
+    Returns:
+        int: Number of NDJSON objects in the part
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i, raw in enumerate(data.values()):
+            if raw[: len(GZIP_MAGIC)] == GZIP_MAGIC:
+                raw = gzip.decompress(raw)
+            if not raw.strip():
+                continue
+            path = os.path.join(tmp, f"{i}.ndjson")
+            with open(path, "wb") as f:
+                f.write(raw)
+            paths.append(path)
+        if paths:
+            files = ", ".join(f"'{path}'" for path in paths)
+            con.execute(
+                f"COPY (SELECT * FROM read_ndjson([{files}], columns = {ndjson_columns()})) "
+                f"TO '{part_path}' (FORMAT parquet, COMPRESSION zstd)"
+            )
+    return len(paths)
+
+
+def sync(store_url: str, prefix: str, cache_dir: str = ANALYTICS_CACHE_DIR, chunk_blobs: int = SYNC_CHUNK_BLOBS) -> int:
+    """Downloads the objects under `prefix` not synced before into Parquet parts
+
+    Every chunk's object names are appended to the manifest once its part is written,
+    so an interrupted sync resumes after the last chunk.
+
+    Returns:
+        int: Number of objects synced
+    """
+    import duckdb
+
+    from segment_hunter.blobstore import open_blob_store
+
+    blobs = open_blob_store(store_url)
+    directory = source_dir(store_url, prefix, cache_dir)
+    parts_dir = os.path.join(directory, "parts")
+    os.makedirs(parts_dir, exist_ok=True)
+    manifest_path = os.path.join(directory, "synced.txt")
+    synced = read_manifest(manifest_path)
+    todo = [name for name in blobs.list(prefix) if name not in synced]
+    if not todo:
+        logger.info(f"No new objects under '{prefix}' in {store_url}")
+        return 0
+
+    logger.info(f"Syncing {len(todo)} objects under '{prefix}' from {store_url} into {directory}")
+    start = time.monotonic()
+    stamp = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    con = duckdb.connect()
+    with open(manifest_path, "a") as manifest:
+        for n, i in enumerate(range(0, len(todo), max(1, chunk_blobs))):
+            chunk = todo[i : i + chunk_blobs]
+            data = blobs.get_many(chunk)
+            ndjson = {name: raw for name, raw in data.items() if not name.endswith(".parquet")}
+            compact_chunk(con, ndjson, os.path.join(parts_dir, f"{stamp}-{n:05d}.parquet"))
+            for j, (name, raw) in enumerate(item for item in data.items() if item[0].endswith(".parquet")):
+                with open(os.path.join(parts_dir, f"{stamp}-{n:05d}-{j:05d}.parquet"), "wb") as f:
+                    f.write(raw)
+            manifest.write("".join(name + "\n" for name in chunk))
+            manifest.flush()
+            os.fsync(manifest.fileno())
+            logger.info(f"Synced {min(i + len(chunk), len(todo))} of {len(todo)} objects")
+    con.close()
+    clear_results(directory)
+    logger.info(f"Synced {len(todo)} objects in {time.monotonic() - start:.1f}s")
+    return len(todo)
+
+
+def clear_results(directory: str):
+    """Drops the cached results of a source, computed over parts since superseded"""
+    results_dir = os.path.join(directory, "results")
+    if os.path.isdir(results_dir):
+        for name in os.listdir(results_dir):
+            os.remove(os.path.join(results_dir, name))
+
+
+def connect(directory: str):
+    """DuckDB connection with the segment_rows and segments views over the parts of a source
+
+    Raises:
+        ValueError: If nothing was synced
+    """
+    import duckdb
+
+    parts_dir = os.path.join(directory, "parts")
+    if not os.path.isdir(parts_dir) or not any(name.endswith(".parquet") for name in os.listdir(parts_dir)):
+        raise ValueError(f"No segment outputs synced into {directory}")
+    con = duckdb.connect()
+    con.execute(f"CREATE VIEW segment_rows AS SELECT * FROM read_parquet('{parts_dir}/*.parquet', union_by_name = true)")
+    con.execute(
+        "CREATE VIEW segments AS SELECT * FROM segment_rows "
+        "QUALIFY row_number() OVER (PARTITION BY id ORDER BY time_fetched DESC NULLS LAST) = 1"
+    )
+    return con
+
+
+def cache_key(directory: str, query: str, params: Dict[str, Any]) -> str:
+    """Digest of a query, its parameters and the parts it reads"""
+    parts_dir = os.path.join(directory, "parts")
+    parts = sorted((name, os.path.getsize(os.path.join(parts_dir, name))) for name in os.listdir(parts_dir))
+    payload = json.dumps({"query": " ".join(query.split()), "params": params, "parts": parts}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:24]
+
+
+def run_query(
+    store_url: str,
+    prefix: str,
+    query: str,
+    params: Optional[Dict[str, Any]] = None,
+    cache_dir: str = ANALYTICS_CACHE_DIR,
+    refresh: bool = False,
+) -> Dict[str, Any]:
+    """Runs a query over the synced outputs of a store, or reads its cached result
+
+    Args:
+        store_url (str): Store the outputs were synced from
+        prefix (str): Prefix they were synced from
+        query (str): SQL over the segment_rows and segments views, with $name parameters
+        params (dict): Values of the parameters the query uses
+        cache_dir (str): Root of the analytics cache
+        refresh (bool): Run the query even if its result is cached
+
+    Returns:
+        dict: columns, rows, whether the result was cached and the seconds taken
+    """
+    params = params or {}
+    directory = source_dir(store_url, prefix, cache_dir)
+    start = time.perf_counter()
+    con = connect(directory)
+    try:
+        results_dir = os.path.join(directory, "results")
+        os.makedirs(results_dir, exist_ok=True)
+        result_path = os.path.join(results_dir, f"{cache_key(directory, query, params)}.parquet")
+        cached = os.path.exists(result_path) and not refresh
+        if not cached:
+            con.execute(f"COPY ({query}) TO '{result_path}' (FORMAT parquet)", params)
+        relation = con.execute(f"SELECT * FROM read_parquet('{result_path}')")
+        columns = [column[0] for column in relation.description]
+        rows = relation.fetchall()
+    finally:
+        con.close()
+    return {"columns": columns, "rows": rows, "cached": cached, "seconds": round(time.perf_counter() - start, 3)}
+
+
+def print_table(result: Dict[str, Any]):
+    cells = [[str(value) for value in row] for row in result["rows"]]
+    widths = [max([len(column), *(len(row[i]) for row in cells)]) for i, column in enumerate(result["columns"])]
+    print("  ".join(column.ljust(width) for column, width in zip(result["columns"], widths)))
+    for row in cells:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+    print(f"{len(cells)} rows in {result['seconds']}s{' (cached)' if result['cached'] else ''}")
+
+
+def run(
+    name: str,
+    store_url: str,
+    prefix: str,
+    params: Dict[str, Any],
+    sql: Optional[str] = None,
+    cache_dir: str = ANALYTICS_CACHE_DIR,
+    sync_first: bool = True,
+    refresh: bool = False,
+    as_json: bool = False,
+) -> int:
+    """Syncs new outputs, then runs a prebuilt query, or `sql` if `name` is sql, and
+    prints the result
+
+    Returns:
+        int: Process exit code
+    """
+    if name == "sql":
+        query, defaults = sql, {}
+    else:
+        _, query, defaults = QUERIES[name]
+    params = {**defaults, **{key: value for key, value in params.items() if value is not None}}
+    missing = [key for key, value in params.items() if value is None]
+    if missing:
+        raise ValueError(f"The {name} query needs {', '.join(missing)}")
+    # Only pass the parameters the query uses, DuckDB rejects unused ones
+    params = {key: value for key, value in params.items() if f"${key}" in query}
+
+    if sync_first:
+        sync(store_url, prefix, cache_dir)
+    result = run_query(store_url, prefix, query, params, cache_dir, refresh)
+    if as_json:
+        print(json.dumps([dict(zip(result["columns"], row)) for row in result["rows"]], indent=2, default=str))
+    else:
+        print_table(result)
+    return 0
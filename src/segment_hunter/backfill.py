@@ -0,0 +1,148 @@
+"""Backfill: reconverts historical explored blobs in bulk on one machine
+
+Applying a new NDJSON shape, or a new sink, to past data used to mean publishing one
+json_to_ndjson message per blob. `backfill` lists the explored blobs under a prefix
+and converts them on a pool of BACKFILL_PROCESSES processes, each downloading and
+converting BACKFILL_CONCURRENCY blobs at once on threads, so both the CPU bound JSON
+work and the network bound transfers are spread out.
+
+Blobs are handed out BACKFILL_CHUNK_BLOBS at a time. Every converted blob is appended
+to a checkpoint file once its output is written, so a backfill that crashes or is
+interrupted skips those blobs when run again with the same checkpoint. Blobs that
+fail are logged and left out of the checkpoint, the next run retries them.
+"""
+
+import multiprocessing
+import os
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import List, Optional, Set, Tuple
+
+from segment_hunter import logging_config
+
+logger = logging_config.get_logger(__name__)
+
+BACKFILL_PROCESSES = int(os.getenv("BACKFILL_PROCESSES", str(os.cpu_count() or 1)))
+BACKFILL_CONCURRENCY = int(os.getenv("BACKFILL_CONCURRENCY", "8"))
+BACKFILL_CHUNK_BLOBS = int(os.getenv("BACKFILL_CHUNK_BLOBS", "50"))
+DEFAULT_CHECKPOINT_PATH = "backfill.checkpoint"
+
+
+def read_checkpoint(checkpoint_path: str) -> Set[str]:
+    """Names of the blobs a previous run already converted"""
+    try:
+        with open(checkpoint_path) as f:
+            return {line.rstrip("\n") for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def convert_chunk(
+    store_url: str,
+    blob_names: List[str],
+    output_url: Optional[str] = None,
+    sink_url: Optional[str] = None,
+    concurrency: int = BACKFILL_CONCURRENCY,
+) -> List[Tuple[str, Optional[str], Optional[str]]]:
+    """Converts a chunk of blobs in a pool process, on `concurrency` threads
+
+    Stores and sinks are opened from their URLs, so each process holds its own clients.
+
+    Returns:
+        list: (blob name, output name or None if it had no segments, error or None) per blob
+    """
+    from segment_hunter import convert
+    from segment_hunter.blobstore import open_blob_store
+    from segment_hunter.sinks import open_segment_sink
+
+    blobs = open_blob_store(store_url)
+    output = open_blob_store(output_url) if output_url else None
+    sink = open_segment_sink(sink_url) if sink_url else None
+
+    def convert_one(blob_name: str):
+        try:
+            return blob_name, convert.convert_blob(blobs, blob_name, sink, output), None
+        except Exception as e:
+            logger.exception(f"Backfill of '{blob_name}' failed: {e}")
+            return blob_name, None, f"{type(e).__name__}: {e}"
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        return list(pool.map(convert_one, blob_names))
+
+
+def backfill(
+    store_url: str,
+    prefix: str = "",
+    blob_names: Optional[List[str]] = None,
+    output_url: Optional[str] = None,
+    sink_url: Optional[str] = None,
+    checkpoint_path: str = DEFAULT_CHECKPOINT_PATH,
+    processes: int = BACKFILL_PROCESSES,
+    concurrency: int = BACKFILL_CONCURRENCY,
+    chunk_blobs: int = BACKFILL_CHUNK_BLOBS,
+) -> Counter:
+    """Converts every explored blob under a prefix not converted by a previous run
+
+    Args:
+        store_url (str): Store holding the explored blobs, gs://bucket or a local directory
+        prefix (str): Only convert blobs whose name starts with it
+        blob_names (list): Convert these blobs instead of listing the store
+        output_url (str): Store the NDJSON is written to, defaults to `store_url`
+        sink_url (str): Append batches to this segment sink instead of writing NDJSON
+        checkpoint_path (str): File the converted blob names are appended to, and
+            read back to resume
+        processes (int): Conversion processes
+        concurrency (int): Blobs converted at once per process
+        chunk_blobs (int): Blobs handed to a process at a time
+
+    Returns:
+        Counter: Number of blobs per outcome: converted, empty (no segments), failed,
+            and skipped (converted by a previous run)
+    """
+    from segment_hunter import convert
+    from segment_hunter.blobstore import open_blob_store
+
+    if blob_names is None:
+        blob_names = convert.explored_blob_names(open_blob_store(store_url), prefix)
+    done = read_checkpoint(checkpoint_path)
+    todo = [name for name in blob_names if name not in done]
+    outcomes = Counter(skipped=len(blob_names) - len(todo))
+    chunks = [todo[i : i + chunk_blobs] for i in range(0, len(todo), max(1, chunk_blobs))]
+    logger.info(
+        f"Backfilling {len(todo)} of {len(blob_names)} blobs from {store_url} in {len(chunks)} chunks "
+        f"on {processes} processes, {outcomes['skipped']} already converted per {checkpoint_path}"
+    )
+
+    start = time.monotonic()
+    # Spawned rather than forked, the parent's gRPC and HTTP clients do not survive a fork
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max(1, processes), mp_context=context) as pool, open(
+        checkpoint_path, "a"
+    ) as checkpoint:
+        pending = set()
+        remaining = iter(chunks)
+        while True:
+            # Keep two chunks queued per process, rather than every chunk of the backfill
+            for chunk in remaining:
+                pending.add(pool.submit(convert_chunk, store_url, chunk, output_url, sink_url, concurrency))
+                if len(pending) >= 2 * max(1, processes):
+                    break
+            if not pending:
+                break
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                for blob_name, output_name, error in future.result():
+                    if error is not None:
+                        outcomes["failed"] += 1
+                        continue
+                    outcomes["converted" if output_name else "empty"] += 1
+                    checkpoint.write(blob_name + "\n")
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+            converted = outcomes["converted"] + outcomes["empty"] + outcomes["failed"]
+            elapsed = time.monotonic() - start
+            logger.info(f"Backfilled {converted} of {len(todo)} blobs, {converted / elapsed if elapsed else 0:.1f} blobs/s")
+
+    logger.info(f"Backfill finished in {time.monotonic() - start:.0f}s: {dict(outcomes)}")
+    return outcomes
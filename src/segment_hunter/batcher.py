@@ -0,0 +1,313 @@
+"""Micro-batching of explore results into packed NDJSON objects
+
+Storing one object per bounding box costs one PUT, one storage notification and one
+conversion per tile, which dwarfs the few kilobytes each tile returns. `TileBatcher`
+collects explored tiles and packs them into a single NDJSON object once it holds
+BATCH_MAX_TILES tiles or its oldest tile is BATCH_MAX_SECONDS old. Every row is one
+segment with the metadata of the tile it came from:
+
+    {"id": ..., "name": ..., <segment fields>, "time_fetched": ..., "bbox_id": 12,
+     "bbox": [sw_latitude, sw_longitude, ne_latitude, ne_longitude], "hilbert": 1874253,
+     "sweep_id": 3, "variant": "activity_type=riding", "activity_type": "riding"}
+
+Tiles are packed along the Hilbert curve, see `hilbert`, and the object name carries
+the range of Hilbert indexes it covers, so readers after a region can skip objects
+from the name alone. Dispatch sends neighbouring tiles together, so the range of a
+batch is usually narrow.
+
+Packed objects go through the background uploader, so they are gzipped and retried
+like any other upload, and `on_stored` is called with the whole batch once the object
+is stored or has failed for good, then the `on_stored` of each of its tiles. With a
+segment sink, the rows of each batch are appended straight to BigQuery instead, and
+only uploaded as NDJSON if the append fails. The batch is stored under its own
+"explore batch" span, linked to the trace of every tile in it.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from opentelemetry.trace import SpanKind
+
+from segment_hunter import logging_config, telemetry
+from segment_hunter.blobstore import BlobStore
+from segment_hunter.hilbert import tile_index
+from segment_hunter.sinks import SegmentSink
+from segment_hunter.uploader import BackgroundUploader, Upload, get_uploader
+
+logger = logging_config.get_logger(__name__)
+
+BATCH_PREFIX = "explored_batches"
+BATCH_MAX_TILES = int(os.getenv("BATCH_MAX_TILES", "50"))
+BATCH_MAX_SECONDS = float(os.getenv("BATCH_MAX_SECONDS", "30"))
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+
+class Tile:
+    """Explore response of one bounding box waiting to be packed
+
+    Args:
+        bbox_id (int): ID of the bounding box row
+        coordinates (list): [sw_latitude, sw_longitude, ne_latitude, ne_longitude]
+        segment_data (dict): Explore response with its `time_fetched`
+        carrier (dict): W3C trace context of the tile, from telemetry.inject_context
+        trace_id (str): Trace ID used to correlate log lines
+        sweep_id (int): Sweep that dispatched the tile, if any
+        hilbert (int): Hilbert index of the tile, computed from its coordinates if not set
+        on_stored (callable): Called with None once the tile's batch is stored and the
+            batch's `on_stored` succeeded, or with the error of either, e.g. to
+            acknowledge the message it came from
+    """
+
+    def __init__(
+        self,
+        bbox_id: int,
+        coordinates: List[float],
+        segment_data: Dict[str, Any],
+        carrier: Optional[Dict[str, str]] = None,
+        trace_id: str = "no-trace",
+        sweep_id: Optional[int] = None,
+        hilbert: Optional[int] = None,
+        on_stored: Optional[Callable[[Optional[BaseException]], None]] = None,
+    ):
+        self.bbox_id = bbox_id
+        self.coordinates = coordinates
+        self.segment_data = segment_data
+        self.carrier = carrier or {}
+        self.trace_id = trace_id
+        self.sweep_id = sweep_id
+        self.hilbert = hilbert if hilbert is not None else tile_index(*coordinates)
+        self.on_stored = on_stored
+
+    @property
+    def segment_ids(self) -> Set[int]:
+        """Distinct segments found across every variant of the tile"""
+        return {
+            segment["id"]
+            for _, _, segments in variant_results(self.segment_data)
+            for segment in segments
+            if segment.get("id") is not None
+        }
+
+    @property
+    def segment_count(self) -> int:
+        return len(self.segment_ids)
+
+    @property
+    def api_calls(self) -> int:
+        """Strava requests made for the tile, one per variant and category band explored"""
+        return len(self.segment_data.get("variants", {})) or 1
+
+
+def variant_results(segment_data: Dict[str, Any]):
+    """(variant key, query parameters, segments) of an explore result, including legacy
+    results of a single riding query that only have `segments`"""
+    if "variants" in segment_data:
+        for key, result in segment_data["variants"].items():
+            yield key, result.get("params", {}), result.get("segments", [])
+    elif "segments" in segment_data:
+        yield None, {}, segment_data["segments"]
+
+
+def tile_rows(tiles: List[Tile]) -> List[Dict[str, Any]]:
+    """One row per segment of every variant of every tile, carrying its tile metadata"""
+    rows = []
+    for tile in tiles:
+        tile_metadata = {
+            "time_fetched": tile.segment_data.get("time_fetched"),
+            "bbox_id": tile.bbox_id,
+            "bbox": tile.coordinates,
+            "hilbert": tile.hilbert,
+            "sweep_id": tile.sweep_id,
+        }
+        for key, params, segments in variant_results(tile.segment_data):
+            variant_metadata = {"variant": key, "activity_type": params.get("activity_type")} if key else {}
+            for segment in segments:
+                rows.append({**segment, **tile_metadata, **variant_metadata})
+    return rows
+
+
+def pack_rows(rows: List[Dict[str, Any]]) -> bytes:
+    return "\n".join(json.dumps(row, separators=(",", ":")) for row in rows).encode("utf-8")
+
+
+def batch_blob_name(tiles: List[Tile]) -> str:
+    """<first time_fetched>__<tiles>__h<lowest>-<highest Hilbert index>__<random>.ndjson"""
+    first_fetched = min(tile.segment_data.get("time_fetched") or 0 for tile in tiles)
+    low, high = min(tile.hilbert for tile in tiles), max(tile.hilbert for tile in tiles)
+    return f"{BATCH_PREFIX}/{first_fetched}__{len(tiles)}__h{low:010d}-{high:010d}__{uuid.uuid4().hex[:12]}.ndjson"
+
+
+class TileBatcher:
+    """Packs explored tiles into one object per BATCH_MAX_TILES tiles or BATCH_MAX_SECONDS
+
+    Args:
+        blobs (BlobStore): Destination store
+        on_stored (callable): Called on an upload thread with the tiles of a batch and
+            None once it is stored, or the error once retries are exhausted. A batch
+            without any segment is not stored and reported right away.
+        max_tiles (int): Tiles per batch
+        max_seconds (float): Age of the oldest tile at which a partial batch is packed
+        uploader (BackgroundUploader): Defaults to the process-wide uploader
+        sink (SegmentSink): Appends each batch straight to BigQuery instead, falling
+            back to an NDJSON upload if the append fails
+    """
+
+    def __init__(
+        self,
+        blobs: BlobStore,
+        on_stored: Callable[[List[Tile], Optional[BaseException]], None],
+        max_tiles: int = BATCH_MAX_TILES,
+        max_seconds: float = BATCH_MAX_SECONDS,
+        uploader: Optional[BackgroundUploader] = None,
+        sink: Optional[SegmentSink] = None,
+    ):
+        self.blobs = blobs
+        self.on_stored = on_stored
+        self.max_tiles = max(1, max_tiles)
+        self.max_seconds = max_seconds
+        self.uploader = uploader or get_uploader()
+        self.sink = sink
+        self._pending = 0
+        self._idle = threading.Condition()
+        self._tiles: List[Tile] = []
+        self._oldest = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._timer: Optional[threading.Thread] = None
+
+    def add(self, tile: Tile):
+        """Adds a tile, packing the batch if it is full"""
+        with self._lock:
+            if not self._tiles:
+                self._oldest = time.monotonic()
+            self._tiles.append(tile)
+            batch = self._take() if len(self._tiles) >= self.max_tiles else None
+        if batch:
+            self._submit(batch)
+        self._start_timer()
+
+    def _take(self) -> List[Tile]:
+        batch, self._tiles = self._tiles, []
+        return batch
+
+    def _start_timer(self):
+        if self._timer is not None or self.max_seconds <= 0:
+            return
+        with self._lock:
+            if self._timer is None:
+                self._timer = threading.Thread(target=self._flush_stale, name="tile-batcher", daemon=True)
+                self._timer.start()
+
+    def _flush_stale(self):
+        interval = min(1.0, self.max_seconds)
+        while not self._stop.wait(interval):
+            with self._lock:
+                stale = bool(self._tiles) and time.monotonic() - self._oldest >= self.max_seconds
+                batch = self._take() if stale else None
+            if batch:
+                self._submit(batch)
+
+    def _submit(self, tiles: List[Tile]) -> Optional[str]:
+        tiles = sorted(tiles, key=lambda tile: tile.hilbert)
+        blob_name = batch_blob_name(tiles)
+        links = [telemetry.link_from_carrier(tile.carrier) for tile in tiles]
+        # A new root trace for the batch, the converter continues it from the object metadata
+        with telemetry.tracer.start_as_current_span(
+            "explore batch",
+            context=telemetry.extract_context({}),
+            kind=SpanKind.PRODUCER,
+            links=[link for link in links if link is not None],
+            attributes={"batch.tiles": len(tiles), "gcs.blob": blob_name},
+        ):
+            rows = tile_rows(tiles)
+            telemetry.tiles_per_batch.record(len(tiles))
+            trace_id = telemetry.current_trace_id()
+            if not rows:
+                # Nothing to convert, the tiles are explored all the same
+                logger.info(f"[{trace_id}] No segments in {len(tiles)} tiles, nothing to store")
+                self._stored(tiles, None)
+                return None
+            carrier = telemetry.inject_context({})
+
+        if self.sink is None:
+            return self._upload(tiles, rows, blob_name, carrier, trace_id)
+
+        with self._idle:
+            self._pending += 1
+        start = time.perf_counter()
+
+        def on_appended(future):
+            error = future.exception()
+            outcome = "appended" if error is None else "fallback"
+            telemetry.sink_append_duration.record(time.perf_counter() - start, {"sink": self.sink.scheme, "outcome": outcome})
+            telemetry.sink_rows.add(len(rows), {"sink": self.sink.scheme, "outcome": outcome})
+            try:
+                if error is None:
+                    logger.info(f"[{trace_id}] Appended {len(rows)} rows from {len(tiles)} tiles to {self.sink.url}")
+                    self._stored(tiles, None)
+                else:
+                    logger.warning(f"[{trace_id}] Append to {self.sink.url} failed, falling back to NDJSON: {error}")
+                    self._upload(tiles, rows, blob_name, carrier, trace_id)
+            except Exception as e:
+                logger.exception(f"[{trace_id}] Failed to complete batch of {len(tiles)} tiles: {e}")
+            finally:
+                with self._idle:
+                    self._pending -= 1
+                    self._idle.notify_all()
+
+        self.sink.append(rows).add_done_callback(on_appended)
+        return self.sink.url
+
+    def _upload(self, tiles: List[Tile], rows: List[Dict[str, Any]], blob_name: str, carrier: Dict[str, str], trace_id: str) -> str:
+        logger.info(f"[{trace_id}] Packed {len(tiles)} tiles into {blob_name}")
+        self.uploader.submit(
+            Upload(
+                self.blobs,
+                blob_name,
+                pack_rows(rows),
+                NDJSON_CONTENT_TYPE,
+                metadata=carrier,
+                on_done=lambda error: self._stored(tiles, error),
+            )
+        )
+        return blob_name
+
+    def _stored(self, tiles: List[Tile], error: Optional[BaseException]):
+        try:
+            self.on_stored(tiles, error)
+        except Exception as e:
+            # e.g. the tiles could not be marked fetched, their messages must be retried
+            logger.exception(f"Stored callback of a batch of {len(tiles)} tiles failed: {e}")
+            error = error or e
+        for tile in tiles:
+            if tile.on_stored is not None:
+                try:
+                    tile.on_stored(error)
+                except Exception as e:
+                    logger.exception(f"[{tile.trace_id}] Stored callback of bounding box {tile.bbox_id} failed: {e}")
+
+    def flush(self) -> Optional[str]:
+        """Packs whatever tiles are waiting and waits for in-flight sink appends, so any
+        NDJSON fallback is queued on the uploader by the time this returns
+
+        Returns:
+            Optional[str]: Name of the batch blob or sink URL, or None if no tile with
+                segments was waiting
+        """
+        with self._lock:
+            batch = self._take()
+        destination = self._submit(batch) if batch else None
+        with self._idle:
+            self._idle.wait_for(lambda: self._pending == 0)
+        return destination
+
+    def close(self):
+        """Stops the age timer and packs the last batch"""
+        self._stop.set()
+        if self._timer is not None:
+            self._timer.join()
+        self.flush()
@@ -0,0 +1,139 @@
+"""Measures cold-start import time of each entry point with `python -X importtime`
+
+Each entry point module is imported in a fresh interpreter, `--repeat` times.
+Reported per entry point:
+
+    wall      median wall time of the whole interpreter run, startup included
+    imports   median total of the top-level cumulative import times, excluding
+              modules the interpreter imports at startup
+    heaviest  top-level modules with the largest cumulative import time (last run)
+
+Usage:
+    segment-hunter bench
+    segment-hunter bench explore-function --repeat 10 --top 15
+    segment-hunter bench --json > cold_start.json
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Tuple
+
+# Directory the package is imported from, so a source checkout works without installing
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> module loaded by the runtime
+ENTRY_POINTS = {
+    "explore-function": "segment_hunter.worker",
+    "convert-function": "segment_hunter.convert",
+    "dispatch": "segment_hunter.dispatch",
+    "cli": "segment_hunter.cli",
+}
+
+# Keep exporters and log sinks from doing network I/O while importing
+BENCH_ENV = {
+    "OTEL_METRICS_EXPORTER": "none",
+    "OTEL_TRACES_EXPORTER": "none",
+    "LOG_FORMAT": "json",
+}
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int]]:
+    """Returns (module, cumulative microseconds) for modules imported at the top level
+
+    Args:
+        stderr (str): Output of `python -X importtime`
+
+    Returns:
+        list: Top-level modules in import order
+    """
+    top_level = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|", 2)
+        # Nested imports are indented by two spaces per level after the separator
+        if name.startswith("  "):
+            continue
+        top_level.append((name.strip(), int(cumulative)))
+    return top_level
+
+
+def run_once(code: str) -> Tuple[float, List[Tuple[str, int]]]:
+    env = dict(os.environ, **BENCH_ENV)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [PACKAGE_PARENT, env.get("PYTHONPATH")]))
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"exit code {result.returncode}"
+        raise RuntimeError(error)
+    return wall, parse_importtime(result.stderr)
+
+
+def bench_entry_point(name: str, repeat: int = 5, top: int = 10) -> Dict[str, Any]:
+    """Imports one entry point `repeat` times in fresh interpreters
+
+    Args:
+        name (str): Key of ENTRY_POINTS
+        repeat (int): Number of cold starts to measure
+        top (int): Number of heaviest top-level modules to report
+
+    Returns:
+        dict: Median wall and import times in milliseconds, heaviest modules, or the error
+    """
+    module = ENTRY_POINTS[name]
+    # Modules the interpreter imports at startup are not attributed to the entry point
+    _, startup_modules = run_once("pass")
+    startup = {module_name for module_name, _ in startup_modules}
+    walls, totals = [], []
+    modules: List[Tuple[str, int]] = []
+    try:
+        for _ in range(repeat):
+            wall, modules = run_once(f"import {module}")
+            modules = [m for m in modules if m[0] not in startup]
+            walls.append(wall * 1000)
+            totals.append(sum(us for _, us in modules) / 1000)
+    except RuntimeError as e:
+        return {"entry_point": name, "error": str(e)}
+
+    heaviest = sorted(modules, key=lambda m: m[1], reverse=True)[:top]
+    return {
+        "entry_point": name,
+        "wall_ms": round(statistics.median(walls), 1),
+        "imports_ms": round(statistics.median(totals), 1),
+        "heaviest_ms": {module_name: round(us / 1000, 1) for module_name, us in heaviest},
+    }
+
+
+def print_report(results: List[Dict[str, Any]]):
+    for result in results:
+        if "error" in result:
+            print(f"{result['entry_point']}: failed to import ({result['error']})")
+            continue
+        print(f"{result['entry_point']}: wall {result['wall_ms']} ms, imports {result['imports_ms']} ms")
+        for module_name, ms in result["heaviest_ms"].items():
+            print(f"    {ms:>8.1f} ms  {module_name}")
+
+
+
+def run(entry_points: List[str], repeat: int = 5, top: int = 10, as_json: bool = False) -> int:
+    """Benchmarks the given entry points, all of them if empty, and prints the results
+
+    Returns:
+        int: Process exit code, 1 if any entry point failed to import
+    """
+    results = [bench_entry_point(name, repeat, top) for name in entry_points or ENTRY_POINTS]
+    if as_json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+    return 1 if any("error" in result for result in results) else 0
@@ -0,0 +1,404 @@
+"""Object storage backends behind one `BlobStore` interface
+
+    gs://bucket          GCSBlobStore, the deployed pipeline
+    file:///path, /path  LocalBlobStore, a directory on disk
+    memory://name        MemoryBlobStore, a dict shared within the process
+
+Stages take a `BlobStore` instead of a bucket name, so the explorer and converter can
+run, be profiled and be load-tested off GCP by pointing BLOB_STORE_URL at a directory
+or at memory. Reads and writes are streamed through file objects; `get_many` and
+`put_many` transfer objects on a thread pool. Stores return objects exactly as they
+were written, so readers of gzip-encoded objects decompress them themselves.
+"""
+
+import io
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import BinaryIO, Dict, Iterable, Iterator, Optional, Tuple
+
+from segment_hunter import logging_config
+
+logger = logging_config.get_logger(__name__)
+
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+TRANSFER_CONCURRENCY = int(os.getenv("BLOB_STORE_CONCURRENCY", "8"))
+# Local objects at least this large are read through a memory map instead of read()
+MMAP_THRESHOLD_BYTES = int(os.getenv("BLOB_STORE_MMAP_THRESHOLD", str(1024 * 1024)))
+
+
+class BlobStore(ABC):
+    """A flat namespace of objects addressed by name, like a GCS bucket"""
+
+    scheme = ""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    @property
+    def url(self) -> str:
+        return f"{self.scheme}://{self.name}"
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.url!r})"
+
+    @abstractmethod
+    def open_read(self, blob_name: str) -> BinaryIO:
+        """Context manager yielding a binary file object to stream the blob from
+
+        Raises:
+            FileNotFoundError: If the blob does not exist
+        """
+
+    @abstractmethod
+    def open_write(
+        self, blob_name: str, content_type: str = DEFAULT_CONTENT_TYPE, metadata: Optional[Dict[str, str]] = None
+    ) -> BinaryIO:
+        """Context manager yielding a binary file object to stream the blob to
+
+        The blob only becomes visible once the block exits without an exception.
+        """
+
+    @abstractmethod
+    def get_metadata(self, blob_name: str) -> Optional[Dict[str, str]]:
+        """Custom metadata of a blob, {} if it has none and None if it does not exist"""
+
+    @abstractmethod
+    def list(self, prefix: str = "") -> Iterator[str]:
+        """Names of the blobs starting with `prefix`, in lexicographic order"""
+
+    @abstractmethod
+    def delete(self, blob_name: str):
+        pass
+
+    def exists(self, blob_name: str) -> bool:
+        return self.get_metadata(blob_name) is not None
+
+    def read_bytes(self, blob_name: str) -> bytes:
+        with self.open_read(blob_name) as f:
+            return f.read()
+
+    def write_bytes(
+        self,
+        blob_name: str,
+        data: bytes,
+        content_type: str = DEFAULT_CONTENT_TYPE,
+        metadata: Optional[Dict[str, str]] = None,
+        content_encoding: Optional[str] = None,
+    ):
+        """Writes a whole blob
+
+        Args:
+            content_encoding (str): Encoding of `data`, e.g. gzip, served as Content-Encoding
+                by GCS. Every store keeps the bytes exactly as written.
+        """
+        with self.open_write(blob_name, content_type, metadata) as f:
+            f.write(data)
+
+    def upload_file(self, source_file_path: str, blob_name: str, content_type: str = DEFAULT_CONTENT_TYPE):
+        with open(source_file_path, "rb") as src, self.open_write(blob_name, content_type) as dst:
+            shutil.copyfileobj(src, dst)
+
+    def get_many(self, blob_names: Iterable[str], concurrency: int = TRANSFER_CONCURRENCY) -> Dict[str, bytes]:
+        """Downloads blobs in parallel
+
+        Returns:
+            dict: Contents per blob name, in the order requested
+        """
+        blob_names = list(blob_names)
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            return dict(zip(blob_names, pool.map(self.read_bytes, blob_names)))
+
+    def put_many(
+        self,
+        blobs: Iterable[Tuple[str, bytes]],
+        content_type: str = DEFAULT_CONTENT_TYPE,
+        concurrency: int = TRANSFER_CONCURRENCY,
+    ) -> int:
+        """Uploads (name, data) pairs in parallel
+
+        Returns:
+            int: Number of blobs uploaded
+        """
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            return len(list(pool.map(lambda blob: self.write_bytes(blob[0], blob[1], content_type), blobs)))
+
+    def copy_to(self, destination: "BlobStore", prefix: str = "", concurrency: int = TRANSFER_CONCURRENCY) -> int:
+        """Copies every blob under `prefix`, with its metadata, to another store
+
+        Returns:
+            int: Number of blobs copied
+        """
+
+        def copy(blob_name: str):
+            with self.open_read(blob_name) as src, destination.open_write(
+                blob_name, metadata=self.get_metadata(blob_name)
+            ) as dst:
+                shutil.copyfileobj(src, dst)
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            return len(list(pool.map(copy, self.list(prefix))))
+
+
+class GCSBlobStore(BlobStore):
+    """Objects in a Google Cloud Storage bucket"""
+
+    scheme = "gs"
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self._bucket = None
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            from segment_hunter.utils import get_storage_client
+
+            self._bucket = get_storage_client().bucket(self.name)
+        return self._bucket
+
+    @contextmanager
+    def open_read(self, blob_name: str):
+        from google.api_core.exceptions import NotFound
+
+        try:
+            # Raw bytes as stored, so gzip-encoded objects are not transcoded mid-stream
+            with self.bucket.blob(blob_name).open("rb", raw_download=True) as f:
+                yield f
+        except NotFound as e:
+            raise FileNotFoundError(f"{self.url}/{blob_name}") from e
+
+    @contextmanager
+    def open_write(self, blob_name: str, content_type: str = DEFAULT_CONTENT_TYPE, metadata: Optional[Dict[str, str]] = None):
+        blob = self.bucket.blob(blob_name)
+        blob.metadata = metadata or None
+        # Resumable upload: the object is only finalised when the writer closes cleanly
+        with blob.open("wb", content_type=content_type, ignore_flush=True) as f:
+            yield f
+
+    def read_bytes(self, blob_name: str) -> bytes:
+        from google.api_core.exceptions import NotFound
+
+        try:
+            return self.bucket.blob(blob_name).download_as_bytes(raw_download=True)
+        except NotFound as e:
+            raise FileNotFoundError(f"{self.url}/{blob_name}") from e
+
+    def write_bytes(
+        self,
+        blob_name: str,
+        data: bytes,
+        content_type: str = DEFAULT_CONTENT_TYPE,
+        metadata: Optional[Dict[str, str]] = None,
+        content_encoding: Optional[str] = None,
+    ):
+        blob = self.bucket.blob(blob_name)
+        blob.metadata = metadata or None
+        blob.content_encoding = content_encoding
+        blob.upload_from_string(data, content_type=content_type)
+
+    def upload_file(self, source_file_path: str, blob_name: str, content_type: str = DEFAULT_CONTENT_TYPE):
+        self.bucket.blob(blob_name).upload_from_filename(source_file_path, content_type=content_type)
+
+    def get_metadata(self, blob_name: str) -> Optional[Dict[str, str]]:
+        blob = self.bucket.get_blob(blob_name)
+        return (blob.metadata or {}) if blob is not None else None
+
+    def list(self, prefix: str = "") -> Iterator[str]:
+        for blob in self.bucket.client.list_blobs(self.name, prefix=prefix or None):
+            yield blob.name
+
+    def delete(self, blob_name: str):
+        self.bucket.blob(blob_name).delete()
+
+
+class _MappedRaw(io.RawIOBase):
+    """Raw read-only file over a memory map, to put a BufferedReader on"""
+
+    def __init__(self, mapped: mmap.mmap):
+        self._mapped = mapped
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self._mapped.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self._mapped.seek(offset, whence)
+        return self._mapped.tell()
+
+    def tell(self) -> int:
+        return self._mapped.tell()
+
+
+class LocalBlobStore(BlobStore):
+    """Objects as files under a directory, with metadata in a hidden sidecar tree
+
+    Writes go to a temporary file renamed into place, so readers never see a partial
+    object. Large objects are read through a read-only memory map, which lets bulk runs
+    parse them without copying each file into the Python heap first.
+    """
+
+    scheme = "file"
+    METADATA_DIR = ".metadata"
+
+    def __init__(self, name: str):
+        super().__init__(os.path.abspath(name))
+        os.makedirs(self.name, exist_ok=True)
+
+    @property
+    def url(self) -> str:
+        return f"file://{self.name}"
+
+    def _path(self, blob_name: str) -> str:
+        path = os.path.abspath(os.path.join(self.name, blob_name))
+        if not path.startswith(self.name + os.sep):
+            raise ValueError(f"Blob name escapes the store root: {blob_name}")
+        return path
+
+    def _metadata_path(self, blob_name: str) -> str:
+        return os.path.join(self.name, self.METADATA_DIR, f"{blob_name}.json")
+
+    @contextmanager
+    def open_read(self, blob_name: str):
+        with open(self._path(blob_name), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < MMAP_THRESHOLD_BYTES:
+                yield f
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                # Buffered like open() so callers can iterate lines, which a bare mmap yields byte by byte
+                yield io.BufferedReader(_MappedRaw(mapped))
+
+    @contextmanager
+    def open_write(self, blob_name: str, content_type: str = DEFAULT_CONTENT_TYPE, metadata: Optional[Dict[str, str]] = None):
+        path = self._path(blob_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                yield f
+            self._write_metadata(blob_name, metadata)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _write_metadata(self, blob_name: str, metadata: Optional[Dict[str, str]]):
+        metadata_path = self._metadata_path(blob_name)
+        if not metadata:
+            if os.path.exists(metadata_path):
+                os.unlink(metadata_path)
+            return
+        os.makedirs(os.path.dirname(metadata_path), exist_ok=True)
+        with open(metadata_path, "w") as f:
+            json.dump(metadata, f)
+
+    def upload_file(self, source_file_path: str, blob_name: str, content_type: str = DEFAULT_CONTENT_TYPE):
+        path = self._path(blob_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(source_file_path, path)
+
+    def get_metadata(self, blob_name: str) -> Optional[Dict[str, str]]:
+        if not os.path.isfile(self._path(blob_name)):
+            return None
+        try:
+            with open(self._metadata_path(blob_name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def list(self, prefix: str = "") -> Iterator[str]:
+        names = []
+        for dirpath, dirnames, filenames in os.walk(self.name):
+            if dirpath == self.name and self.METADATA_DIR in dirnames:
+                dirnames.remove(self.METADATA_DIR)
+            rel_dir = os.path.relpath(dirpath, self.name)
+            for filename in filenames:
+                if filename.startswith(".tmp-"):
+                    continue
+                blob_name = filename if rel_dir == "." else f"{rel_dir}/{filename}"
+                if blob_name.startswith(prefix):
+                    names.append(blob_name)
+        yield from sorted(names)
+
+    def delete(self, blob_name: str):
+        os.unlink(self._path(blob_name))
+        self._write_metadata(blob_name, None)
+
+
+class MemoryBlobStore(BlobStore):
+    """Objects held in a process-wide dict per store name, for tests and benchmarks"""
+
+    scheme = "memory"
+    _stores: Dict[str, Dict[str, Tuple[bytes, Dict[str, str]]]] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, name: str = "default"):
+        super().__init__(name)
+        with self._lock:
+            self._blobs = self._stores.setdefault(name, {})
+
+    @contextmanager
+    def open_read(self, blob_name: str):
+        try:
+            data, _ = self._blobs[blob_name]
+        except KeyError:
+            raise FileNotFoundError(f"{self.url}/{blob_name}") from None
+        yield io.BytesIO(data)
+
+    @contextmanager
+    def open_write(self, blob_name: str, content_type: str = DEFAULT_CONTENT_TYPE, metadata: Optional[Dict[str, str]] = None):
+        buffer = io.BytesIO()
+        yield buffer
+        with self._lock:
+            self._blobs[blob_name] = (buffer.getvalue(), dict(metadata or {}))
+
+    def get_metadata(self, blob_name: str) -> Optional[Dict[str, str]]:
+        blob = self._blobs.get(blob_name)
+        return dict(blob[1]) if blob is not None else None
+
+    def list(self, prefix: str = "") -> Iterator[str]:
+        with self._lock:
+            names = sorted(name for name in self._blobs if name.startswith(prefix))
+        yield from names
+
+    def delete(self, blob_name: str):
+        with self._lock:
+            del self._blobs[blob_name]
+
+
+BLOB_STORES = {store.scheme: store for store in (GCSBlobStore, LocalBlobStore, MemoryBlobStore)}
+
+
+@lru_cache(maxsize=None)
+def open_blob_store(url: str) -> BlobStore:
+    """Returns the store for a URL; a bare path is a local directory
+
+    Args:
+        url (str): gs://bucket, file:///path, /path or memory://name
+
+    Returns:
+        BlobStore: Store shared by every caller asking for the same URL
+    """
+    scheme, sep, name = url.partition("://")
+    if not sep:
+        scheme, name = LocalBlobStore.scheme, url
+    if scheme not in BLOB_STORES:
+        raise ValueError(f"Unknown blob store scheme '{scheme}', expected one of {list(BLOB_STORES)}")
+    store = BLOB_STORES[scheme](name)
+    logger.debug(f"Opened blob store {store.url}")
+    return store
@@ -0,0 +1,399 @@
+"""`segment-hunter` command line interface
+
+    segment-hunter grid        split an area into bounding boxes and load them into Postgres
+    segment-hunter prioritise  rank bounding boxes by expected segment yield
+    segment-hunter sweep       start, list, check on and compare sweeps of a region
+    segment-hunter dispatch    explore pending bounding boxes with an executor
+    segment-hunter explore     consume bounding boxes from Pub/Sub
+    segment-hunter convert     convert explored blobs to NDJSON
+    segment-hunter backfill    reconvert historical explored blobs on a process pool
+    segment-hunter analytics   query stored segment outputs locally with DuckDB
+    segment-hunter enrich      fetch the details of new and stale segments
+    segment-hunter tokens      refresh the Strava access tokens
+    segment-hunter replay-dlq  list or replay dead-lettered messages
+    segment-hunter bench       measure cold-start import time per entry point
+    segment-hunter bench-queue measure the work queue under concurrent claim/complete cycles
+
+Stage modules are imported by the command that needs them, so each command only pays
+for its own dependencies.
+"""
+
+import argparse
+import os
+import sys
+from typing import Any, Dict, List, Optional
+
+from segment_hunter import bench
+from segment_hunter.executors import EXECUTORS
+
+# Area covered by data/bounding_boxes.csv: sw_latitude, sw_longitude, ne_latitude, ne_longitude
+DEFAULT_GRID_BOUNDS = [51.45, -1.15, 51.75, -0.85]
+
+
+def parse_variant(spec: str) -> Dict[str, Any]:
+    """Parses a query variant such as activity_type=running,min_cat=3,max_cat=5"""
+    from segment_hunter import failures
+
+    variant = {}
+    for pair in spec.split(","):
+        field, _, value = (part.strip() for part in pair.partition("="))
+        variant[field] = int(value) if value.isdigit() else value
+    try:
+        return failures.parse_variants([variant])[0]
+    except failures.PermanentError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def run_grid(args) -> int:
+    from segment_hunter import grid, store
+    from segment_hunter.blobstore import open_blob_store
+    from segment_hunter.config import DATA_DIR, load_config
+
+    sw_lat, sw_lon, ne_lat, ne_lon = args.bounds
+    csv_path = args.output or os.path.join(DATA_DIR, "bounding_boxes.csv")
+    grid.write_grid_csv(grid.split_bbox(sw_lat, sw_lon, ne_lat, ne_lon, args.rows, args.cols), csv_path)
+
+    if args.upload or args.load:
+        config = load_config()
+        if args.upload:
+            store.upload_blob_from_path(open_blob_store(config["blob_store_url"]), csv_path, os.path.basename(csv_path))
+        if args.load:
+            grid.load_grid(config["db_params"], csv_path)
+    return 0
+
+
+def parse_raster(spec: str):
+    """Parses a raster such as data/population.tif or data/roads.tif:0.5"""
+    path, sep, weight = spec.rpartition(":")
+    if not sep or not path:
+        return spec, 1.0
+    try:
+        return path, float(weight)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Raster weight must be a number, got '{weight}'")
+
+
+def run_prioritise(args) -> int:
+    from segment_hunter import priority
+    from segment_hunter.config import load_config
+
+    priority.prioritise(load_config()["db_params"], args.rasters)
+    return 0
+
+
+def run_sweep(args) -> int:
+    import json
+
+    from segment_hunter import sweeps
+    from segment_hunter.config import load_config
+
+    db_params = load_config()["db_params"]
+    if args.sweep_command == "start":
+        result = {"sweep_id": sweeps.start_sweep(db_params, args.region, args.bounds, args.variants)}
+    elif args.sweep_command == "status":
+        result = sweeps.refresh_sweep(db_params, args.sweep_id)
+    elif args.sweep_command == "list":
+        result = sweeps.list_sweeps(db_params, args.region)
+    else:
+        result = sweeps.compare_sweeps(db_params, args.sweep_a, args.sweep_b)
+    print(json.dumps(result, indent=2, default=str))
+    return 0
+
+
+def run_dispatch(args) -> int:
+    from segment_hunter import dispatch, executors, telemetry
+    from segment_hunter.config import load_config
+
+    telemetry.setup("bbox-dispatcher")
+    try:
+        config = load_config()
+        executor = executors.get_executor(args.executor, config, args.concurrency)
+        outcomes = dispatch.dispatch(
+            config,
+            executor,
+            limit=args.limit,
+            dry_run=args.dry_run,
+            variants=args.variants,
+            budget=args.budget,
+            sweep_id=args.sweep,
+        )
+    finally:
+        telemetry.flush()
+    return 0 if not (outcomes.get("error") or outcomes.get("publish_failed")) else 1
+
+
+def run_explore(args) -> int:
+    from segment_hunter import telemetry, worker
+
+    telemetry.setup("segment-explorer")
+    if args.worker:
+        worker.run_worker(
+            concurrency=args.concurrency,
+            max_outstanding_messages=max(args.concurrency, worker.WORKER_MAX_OUTSTANDING_MESSAGES),
+        )
+    else:
+        worker.pull_once(max_messages=args.max_messages)
+    return 0
+
+
+def run_convert(args) -> int:
+    from segment_hunter import convert, telemetry
+    from segment_hunter.blobstore import open_blob_store
+    from segment_hunter.sinks import open_segment_sink
+
+    telemetry.setup_tracing("json-to-ndjson")
+    try:
+        blobs = open_blob_store(args.store)
+        blob_names = args.blobs or convert.explored_blob_names(blobs)
+        sink = open_segment_sink(args.sink) if args.sink else None
+        convert.convert_blobs(blobs, blob_names, args.concurrency, sink)
+    finally:
+        telemetry.flush()
+    return 0
+
+
+def run_backfill(args) -> int:
+    from segment_hunter import backfill
+
+    outcomes = backfill.backfill(
+        args.store,
+        prefix=args.prefix,
+        blob_names=args.blobs or None,
+        output_url=args.output,
+        sink_url=args.sink,
+        checkpoint_path=args.checkpoint,
+        processes=args.processes,
+        concurrency=args.concurrency,
+    )
+    return 1 if outcomes["failed"] else 0
+
+
+def run_analytics(args) -> int:
+    from segment_hunter import analytics, store
+
+    if args.query == "sql" and not args.sql:
+        raise SystemExit("segment-hunter analytics sql needs the SQL to run")
+    params = {
+        "cell_degrees": args.cell_degrees,
+        "min_category": args.min_category,
+        "sweep_a": args.sweep_a,
+        "sweep_b": args.sweep_b,
+        "top": args.top,
+    }
+    return analytics.run(
+        args.query,
+        args.store,
+        store.NDJSON_PREFIX if args.prefix is None else args.prefix,
+        params,
+        sql=args.sql,
+        cache_dir=args.cache_dir or analytics.ANALYTICS_CACHE_DIR,
+        sync_first=not args.no_sync,
+        refresh=args.refresh,
+        as_json=args.json,
+    )
+
+
+def run_enrich(args) -> int:
+    from segment_hunter import enrich, telemetry
+    from segment_hunter.config import load_config
+
+    telemetry.setup("segment-enricher")
+    try:
+        enrich.enrich(load_config(), budget=args.budget, concurrency=args.concurrency)
+    finally:
+        telemetry.flush()
+    return 0
+
+
+def run_tokens(args) -> int:
+    from segment_hunter import config as settings
+    from segment_hunter.tokens import get_token_pool
+
+    if os.path.exists(settings.TF_OUTPUTS_PATH):
+        config = settings.load_config()
+        gcp_project_id, db_params = config["gcp_project_id"], config["db_params"]
+    else:
+        # The token refresh service only ships credentials for Secret Manager, refresh without the lock
+        gcp_project_id, db_params = settings.gcp_project_id(), None
+
+    tokens = get_token_pool(gcp_project_id, settings.ENV, db_params)
+    tokens.refresh_all()
+    summary = tokens.summary()
+    print(summary)
+    return 0 if any(account["active"] for account in summary.values()) else 1
+
+
+def run_replay(args) -> int:
+    from segment_hunter.config import load_config
+    from segment_hunter.replay import replay_dead_letters
+
+    replay_dead_letters(load_config(), replay=args.replay, reason=args.reason, limit=args.limit)
+    return 0
+
+
+def run_bench(args) -> int:
+    return bench.run(args.entry_points, args.repeat, args.top, args.json)
+
+
+def run_bench_queue(args) -> int:
+    from segment_hunter import queuebench
+
+    return queuebench.run(args.dsn, args.rows, args.workers, args.seconds, args.batch, args.schema, args.keep, args.json)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="segment-hunter", description="Explore Strava segments over a grid of bounding boxes")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    grid = commands.add_parser("grid", help="Split an area into bounding boxes")
+    grid.add_argument("--bounds", nargs=4, type=float, default=DEFAULT_GRID_BOUNDS, metavar=("SW_LAT", "SW_LON", "NE_LAT", "NE_LON"))
+    grid.add_argument("--rows", type=int, default=30, help="Bounding boxes along the latitude axis")
+    grid.add_argument("--cols", type=int, default=30, help="Bounding boxes along the longitude axis")
+    grid.add_argument("--output", help="CSV path, defaults to data/bounding_boxes.csv")
+    grid.add_argument("--upload", action="store_true", help="Upload the CSV to the project bucket")
+    grid.add_argument("--load", action="store_true", help="Create the bounding boxes table and load the CSV if it is empty")
+    grid.set_defaults(func=run_grid)
+
+    prioritise = commands.add_parser("prioritise", help="Rank bounding boxes by expected segment yield")
+    prioritise.add_argument(
+        "--raster",
+        dest="rasters",
+        action="append",
+        type=parse_raster,
+        help="GeoTIFF in EPSG:4326 to weigh in, e.g. population or road density, as path[:weight]. Repeatable.",
+    )
+    prioritise.set_defaults(func=run_prioritise)
+
+    sweep = commands.add_parser("sweep", help="Start, list, check on and compare sweeps of a region")
+    sweep_commands = sweep.add_subparsers(dest="sweep_command", required=True)
+    sweep_start = sweep_commands.add_parser("start", help="Record a new sweep over the bounding boxes of a region")
+    sweep_start.add_argument("region", help="Name of the region, e.g. oxford")
+    sweep_start.add_argument(
+        "--bounds", nargs=4, type=float, metavar=("SW_LAT", "SW_LON", "NE_LAT", "NE_LON"), help="Defaults to the whole grid"
+    )
+    sweep_start.add_argument(
+        "--variant", dest="variants", action="append", type=parse_variant, help="Query variant of the sweep. Repeatable."
+    )
+    sweep_status = sweep_commands.add_parser("status", help="Refresh and print the counts of a sweep")
+    sweep_status.add_argument("sweep_id", type=int)
+    sweep_list = sweep_commands.add_parser("list", help="List sweeps")
+    sweep_list.add_argument("--region", help="Only sweeps of this region")
+    sweep_compare = sweep_commands.add_parser("compare", help="Compare the tiles two sweeps both fetched")
+    sweep_compare.add_argument("sweep_a", type=int)
+    sweep_compare.add_argument("sweep_b", type=int)
+    sweep.set_defaults(func=run_sweep)
+
+    dispatch = commands.add_parser("dispatch", help="Explore pending bounding boxes, highest priority first")
+    dispatch.add_argument("--executor", choices=list(EXECUTORS), default="pubsub", help="Where the explore stage runs")
+    dispatch.add_argument("--concurrency", type=int, default=4, help="Bounding boxes explored or published in parallel")
+    dispatch.add_argument("--limit", type=int, help="Maximum number of bounding boxes to dispatch")
+    dispatch.add_argument("--sweep", type=int, help="Dispatch what this sweep has left, resuming after its last checkpoint")
+    dispatch.add_argument("--budget", type=int, help="Strava requests to spend, tiles beyond it are left pending")
+    dispatch.add_argument("--dry-run", action="store_true", help="Only count the pending bounding boxes")
+    dispatch.add_argument(
+        "--variant",
+        dest="variants",
+        action="append",
+        type=parse_variant,
+        help="Query variant to explore every bounding box with, e.g. activity_type=running,min_cat=3,max_cat=5. Repeatable.",
+    )
+    dispatch.set_defaults(func=run_dispatch)
+
+    explore = commands.add_parser("explore", help="Explore bounding boxes queued in Pub/Sub")
+    explore.add_argument("--worker", action="store_true", help="Run as a long-running streaming pull worker instead of a single pull")
+    explore.add_argument("--concurrency", type=int, default=int(os.getenv("WORKER_CONCURRENCY", "4")), help="Messages processed in parallel in worker mode")
+    explore.add_argument("--max-messages", type=int, default=50, help="Messages pulled without --worker")
+    explore.set_defaults(func=run_explore)
+
+    convert = commands.add_parser("convert", help="Convert explored blobs to NDJSON")
+    convert.add_argument("blobs", nargs="*", help="Names of the explored JSON blobs, defaults to every explored blob in the store")
+    convert.add_argument(
+        "--store",
+        default=os.getenv("BLOB_STORE_URL") or f"gs://{os.getenv('BUCKET_NAME', 'segment_hunter__dev')}",
+        help="gs://bucket, a local directory or memory://name",
+    )
+    convert.add_argument("--concurrency", type=int, default=8, help="Blobs converted in parallel")
+    convert.add_argument("--sink", help="Append batches to bigquery://project/dataset/table instead of writing NDJSON")
+    convert.set_defaults(func=run_convert)
+
+    backfill = commands.add_parser("backfill", help="Reconvert historical explored blobs on a process pool, resumably")
+    backfill.add_argument("blobs", nargs="*", help="Names of the explored blobs, defaults to every explored blob under --prefix")
+    backfill.add_argument(
+        "--store",
+        default=os.getenv("BLOB_STORE_URL") or f"gs://{os.getenv('BUCKET_NAME', 'segment_hunter__dev')}",
+        help="gs://bucket, a local directory or memory://name",
+    )
+    backfill.add_argument("--prefix", default="", help="Only reconvert blobs whose name starts with it, e.g. explored_batches/2025")
+    backfill.add_argument("--output", help="Store the NDJSON is written to, defaults to --store")
+    backfill.add_argument("--sink", help="Append batches to bigquery://project/dataset/table instead of writing NDJSON")
+    backfill.add_argument("--checkpoint", default="backfill.checkpoint", help="File of converted blobs, a rerun resumes from it")
+    backfill.add_argument(
+        "--processes", type=int, default=int(os.getenv("BACKFILL_PROCESSES", str(os.cpu_count() or 1))), help="Conversion processes"
+    )
+    backfill.add_argument(
+        "--concurrency", type=int, default=int(os.getenv("BACKFILL_CONCURRENCY", "8")), help="Blobs downloaded and converted at once per process"
+    )
+    backfill.set_defaults(func=run_backfill)
+
+    analytics = commands.add_parser("analytics", help="Query stored segment outputs locally with DuckDB")
+    analytics.add_argument("query", choices=["density", "climbs", "sweep-diff", "sql"], help="Prebuilt query, or sql to run your own")
+    analytics.add_argument("sql", nargs="?", help="With sql: a query over the segment_rows and segments views")
+    analytics.add_argument(
+        "--store",
+        default=os.getenv("BLOB_STORE_URL") or f"gs://{os.getenv('BUCKET_NAME', 'segment_hunter__dev')}",
+        help="gs://bucket, a local directory or memory://name",
+    )
+    analytics.add_argument("--prefix", help="Objects to query, defaults to the converted NDJSON, e.g. explored_batches/")
+    analytics.add_argument("--cache-dir", help="Where synced outputs and results are kept, defaults to data/analytics")
+    analytics.add_argument("--cell-degrees", type=float, help="density: lattice cell size in degrees, defaults to 0.01")
+    analytics.add_argument("--min-category", type=int, help="climbs: only count segments of at least this climb category")
+    analytics.add_argument("--sweep-a", type=int, help="sweep-diff: earlier sweep")
+    analytics.add_argument("--sweep-b", type=int, help="sweep-diff: later sweep")
+    analytics.add_argument("--top", type=int, help="Rows to return, defaults to 50")
+    analytics.add_argument("--no-sync", action="store_true", help="Query what was synced before without listing the store")
+    analytics.add_argument("--refresh", action="store_true", help="Rerun the query even if its result is cached")
+    analytics.add_argument("--json", action="store_true", help="Print rows as JSON")
+    analytics.set_defaults(func=run_analytics)
+
+    enrich = commands.add_parser("enrich", help="Fetch the details of new and stale segments")
+    enrich.add_argument("--budget", type=int, help="Maximum number of detail requests")
+    enrich.add_argument("--concurrency", type=int, default=int(os.getenv("DETAIL_CONCURRENCY", "4")), help="Detail requests in flight at once")
+    enrich.set_defaults(func=run_enrich)
+
+    tokens = commands.add_parser("tokens", help="Refresh the Strava access tokens ahead of expiry")
+    tokens.set_defaults(func=run_tokens)
+
+    replay = commands.add_parser("replay-dlq", help="List or replay dead-lettered messages")
+    replay.add_argument("--replay", action="store_true", help="Republish dead letters to the explorer topic")
+    replay.add_argument("--reason", help="Only replay messages with this failure reason, e.g. http_404")
+    replay.add_argument("--limit", type=int, help="Maximum number of dead letters to process")
+    replay.set_defaults(func=run_replay)
+
+    bench_parser = commands.add_parser("bench", help="Measure cold-start import time per entry point")
+    bench_parser.add_argument("entry_points", nargs="*", choices=list(bench.ENTRY_POINTS), help="Defaults to all entry points")
+    bench_parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per entry point")
+    bench_parser.add_argument("--top", type=int, default=10, help="Heaviest top-level modules to list")
+    bench_parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    bench_parser.set_defaults(func=run_bench)
+
+    bench_queue = commands.add_parser("bench-queue", help="Measure the work queue under concurrent claim/complete cycles")
+    bench_queue.add_argument("--dsn", default=os.getenv("QUEUE_BENCH_DSN", "dbname=postgres"), help="Database to benchmark in, never production")
+    bench_queue.add_argument("--rows", type=int, default=1_000_000, help="Bounding boxes to queue")
+    bench_queue.add_argument("--workers", type=int, default=8, help="Concurrent claim/complete loops, one connection each")
+    bench_queue.add_argument("--seconds", type=float, default=30.0, help="How long to run the loops")
+    bench_queue.add_argument("--batch", type=int, default=10, help="Bounding boxes per claim")
+    bench_queue.add_argument("--schema", default="queue_bench", help="Schema created for the benchmark and dropped afterwards")
+    bench_queue.add_argument("--keep", action="store_true", help="Keep the schema to inspect it")
+    bench_queue.add_argument("--json", action="store_true", help="Print results as JSON")
+    bench_queue.set_defaults(func=run_bench_queue)
+
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""Environment and Terraform output configuration shared by every entry point
+
+Paths are resolved against SEGMENT_HUNTER_ROOT. It defaults to the directory holding
+`terraform/`: the repository root for a source checkout, or the Cloud Function bundle
+that functions/build.sh vendors the package and Terraform outputs into. Containers,
+where the package is installed, set it explicitly.
+"""
+
+import json
+import os
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+from segment_hunter import logging_config, utils
+
+logger = logging_config.get_logger(__name__)
+
+ENV = os.getenv("ENV", "dev")
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The package's parent is the bundle root when vendored into a Cloud Function, src/ in a checkout
+REPO_ROOT = os.getenv("SEGMENT_HUNTER_ROOT") or (
+    PACKAGE_PARENT if os.path.isdir(os.path.join(PACKAGE_PARENT, "terraform")) else os.path.dirname(PACKAGE_PARENT)
+)
+ENV_PATH = os.path.join(REPO_ROOT, f".env.{ENV}")
+TF_OUTPUTS_PATH = os.path.join(REPO_ROOT, "terraform", f"terraform_outputs_{ENV}.json")
+DATA_DIR = os.path.join(REPO_ROOT, "data")
+
+
+def load_env():
+    """Loads `.env.<env>` if present; deployed environments set variables directly"""
+    from dotenv import load_dotenv
+
+    load_dotenv(ENV_PATH)
+
+
+def load_tf_outputs(path: str = TF_OUTPUTS_PATH) -> Dict[str, Any]:
+    logger.debug(f"Loading Terraform outputs from {path}")
+    with open(path) as f:
+        return json.load(f)
+
+
+def gcp_project_id() -> Optional[str]:
+    load_env()
+    return os.getenv("GCP_PROJECT_ID")
+
+
+def db_params(tf_outputs: Dict[str, Any], project_id: str) -> Dict[str, Any]:
+    """psycopg2 connection parameters for the bounding boxes database
+
+    Args:
+        tf_outputs (dict): Terraform outputs
+        project_id (str): GCP project holding the database password secret
+
+    Returns:
+        dict: psycopg2 connection parameters
+    """
+    return {
+        "host": tf_outputs["db_host"]["value"],
+        "dbname": os.getenv("PG_DATABASE", "postgres"),
+        "user": tf_outputs["db_service_account_name"]["value"],
+        "password": utils.get_secret(project_id, f"postgres-service-account-pwd--{ENV}"),
+        "port": os.getenv("PG_PORT", "5432"),
+    }
+
+
+def blob_store_url(tf_outputs: Dict[str, Any]) -> str:
+    """BLOB_STORE_URL, e.g. a local directory for offline runs, else the project bucket"""
+    return os.getenv("BLOB_STORE_URL") or f"gs://{tf_outputs['bucket_name']['value']}"
+
+
+def segment_sink_url(tf_outputs: Dict[str, Any]) -> Optional[str]:
+    """SEGMENT_SINK_URL, where `bigquery` stands for the Terraform managed segments table.
+    Unset, segments only reach BigQuery through NDJSON."""
+    url = os.getenv("SEGMENT_SINK_URL")
+    if url == "bigquery":
+        project, dataset, table = tf_outputs["bigquery_segments_table"]["value"].split(".")
+        url = f"bigquery://{project}/{dataset}/{table}"
+    return url or None
+
+
+@lru_cache(maxsize=1)
+def load_config() -> Dict[str, Any]:
+    """Loads configuration once per process; warm Cloud Function instances reuse it
+
+    Returns:
+        dict: `tf_outputs`, `db_params`, `gcp_project_id`, `blob_store_url` and
+            `segment_sink_url`
+    """
+    logger.info("Loading environment variables and Terraform outputs...")
+    project_id = gcp_project_id()
+    tf_outputs = load_tf_outputs()
+    logger.info(f"GCP Project ID: {project_id}")
+
+    params = db_params(tf_outputs, project_id)
+    logger.debug(f"Database parameters loaded: host={params['host']}, db={params['dbname']}")
+    return {
+        "tf_outputs": tf_outputs,
+        "db_params": params,
+        "gcp_project_id": project_id,
+        "blob_store_url": blob_store_url(tf_outputs),
+        "segment_sink_url": segment_sink_url(tf_outputs),
+    }
@@ -0,0 +1,189 @@
+"""Convert stage: turns explored blobs into NDJSON for BigQuery
+
+Explorers write packed batches of tiles under BATCH_PREFIX, converted in one
+invocation per batch. Per-tile JSON objects written before batching are still
+converted.
+
+`convert_pubsub_event` is the entry point of the json_to_ndjson Cloud Function and
+continues the bounding box trace. The trace context is read from the message
+attributes, then from the GCS notification's object metadata, and finally from the
+metadata of the explored blob itself.
+"""
+
+import base64
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from opentelemetry.trace import SpanKind
+
+from segment_hunter import logging_config, profiling, store, telemetry
+from segment_hunter.batcher import BATCH_PREFIX, NDJSON_CONTENT_TYPE
+from segment_hunter.blobstore import TRANSFER_CONCURRENCY, BlobStore, open_blob_store
+from segment_hunter.sinks import SegmentSink
+
+logger = logging_config.get_logger(__name__)
+
+TRACE_CONTEXT_KEY = "traceparent"
+DEFAULT_BUCKET_NAME = os.getenv("BUCKET_NAME", "segment_hunter__dev")
+
+
+def convert_json_to_ndjson(data: dict) -> Optional[str]:
+    """Converts JSON object with a list of items into NDJSON string
+
+    Args:
+        data (dict): JSON object serialised as a dict
+
+    Returns:
+        Optional[str]: NDJSON string, or None if no segments
+    """
+    segments = data.get("segments", [])
+    if not segments:
+        logger.warning("No segments found - skipping")
+        return None
+    time_fetched = data.get("time_fetched")
+
+    ndjson_lines = []
+    for seg in segments:
+        seg_with_meta = seg.copy()
+        if time_fetched is not None:
+            seg_with_meta["time_fetched"] = time_fetched
+        ndjson_lines.append(json.dumps(seg_with_meta, separators=(",", ":")))
+
+    ndjson = "\n".join(ndjson_lines)
+    logger.info(f"{len(segments)} segments converted to NDJSON")
+    return ndjson
+
+
+def convert_batch(
+    blobs: BlobStore, blob_name: str, sink: Optional[SegmentSink] = None, output: Optional[BlobStore] = None
+) -> Optional[str]:
+    """Streams the rows of a packed batch into one NDJSON blob under NDJSON_PREFIX
+
+    Batch rows already carry `time_fetched` and their tile metadata, so they are only
+    validated and re-serialised compactly, one row at a time. With a sink, e.g. to
+    backfill batches written before the explorer had one, rows are appended to it
+    instead, falling back to NDJSON if the append fails. NDJSON goes to `output`,
+    defaulting to the store the batch is read from; a batch without rows writes none.
+
+    Returns:
+        Optional[str]: Name of the NDJSON blob or sink URL, or None if the batch had no rows
+    """
+    if sink is not None:
+        try:
+            appended = sink.append(list(store.iter_ndjson_rows(blobs, blob_name))).result()
+            logger.info(f"Appended {appended} rows of batch '{blob_name}' to {sink.url}")
+            return sink.url
+        except (TypeError, ValueError) as e:
+            # Sinks validate every row before sending any, so none were appended
+            logger.warning(f"Batch '{blob_name}' rejected by {sink.url}, converting to NDJSON: {e}")
+        except Exception as e:
+            logger.warning(
+                f"Append of batch '{blob_name}' to {sink.url} failed, converting to NDJSON. Rows acknowledged "
+                f"before the failure are in both, deduplicate on id, bbox_id and variant: {e}"
+            )
+
+    rows = store.iter_ndjson_rows(blobs, blob_name)
+    first = next(rows, None)
+    if first is None:
+        logger.warning(f"Batch '{blob_name}' has no rows - skipping")
+        return None
+
+    logger.info(f"Converting batch '{blob_name}' to NDJSON")
+    output = output or blobs
+    ndjson_blob_name = f"{store.NDJSON_PREFIX}/{os.path.basename(blob_name)}"
+    converted = 1
+    with telemetry.timed(telemetry.gcs_upload_duration, "gcs upload", bucket=output.name):
+        with output.open_write(ndjson_blob_name, NDJSON_CONTENT_TYPE, telemetry.inject_context({})) as f:
+            f.write(json.dumps(first, separators=(",", ":")).encode("utf-8"))
+            for row in rows:
+                f.write(b"\n" + json.dumps(row, separators=(",", ":")).encode("utf-8"))
+                converted += 1
+    logger.info(f"{converted} segments converted to NDJSON")
+    return ndjson_blob_name
+
+
+def convert_blob(
+    blobs: BlobStore, blob_name: str, sink: Optional[SegmentSink] = None, output: Optional[BlobStore] = None
+) -> Optional[str]:
+    """Converts one explored blob, a packed batch or a legacy per-tile JSON object, and
+    uploads it under NDJSON_PREFIX in `output`, defaulting to the same store
+
+    Returns:
+        Optional[str]: Name of the NDJSON blob, or None if the blob had no segments
+    """
+    if blob_name.startswith(BATCH_PREFIX + "/"):
+        return convert_batch(blobs, blob_name, sink, output)
+
+    logger.info(f"Converting '{blob_name}' to NDJSON")
+    json_blob = store.download_json_blob(blobs, blob_name)
+    nd_json = convert_json_to_ndjson(json_blob)
+    if nd_json is None:
+        return None
+    ndjson_blob_name = os.path.join(store.NDJSON_PREFIX, blob_name)
+    store.upload_blob_from_string(output or blobs, nd_json, ndjson_blob_name)
+    return ndjson_blob_name
+
+
+def explored_blob_names(blobs: BlobStore, prefix: str = "") -> List[str]:
+    """Explored blobs in a store: packed batches and legacy per-tile JSON objects, only
+    those whose name starts with `prefix` if set"""
+    batches = [name for name in blobs.list(BATCH_PREFIX + "/") if name.startswith(prefix)]
+    legacy = [name for name in blobs.list(prefix) if name.endswith(".json") and "/" not in name]
+    return batches + legacy
+
+
+def convert_blobs(
+    blobs: BlobStore, blob_names: List[str], concurrency: int = TRANSFER_CONCURRENCY, sink: Optional[SegmentSink] = None
+) -> int:
+    """Converts blobs in bulk on a thread pool, e.g. a local store when backfilling offline
+
+    Returns:
+        int: Number of blobs converted
+    """
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        converted = [name for name in pool.map(lambda name: convert_blob(blobs, name, sink), blob_names) if name]
+    logger.info(f"Converted {len(converted)} of {len(blob_names)} blobs in {blobs.url}")
+    return len(converted)
+
+
+def convert_pubsub_event(event, context):
+    """Cloud Function triggered by Pub/Sub event"""
+    telemetry.setup_tracing("json-to-ndjson")
+    try:
+        pubsub_message = event.get("data")
+        if not pubsub_message:
+            logger.error("No data in Pub/Sub message")
+            return
+
+        decoded_bytes = base64.b64decode(pubsub_message)
+        message_dict = json.loads(decoded_bytes.decode("utf-8"))
+        blob_name = message_dict.get("blob_name")
+        bucket_name = message_dict.get("bucket_name") or DEFAULT_BUCKET_NAME
+
+        if not blob_name or not bucket_name:
+            logger.error("Missing bucket_name or blob_name in message")
+            return
+
+        blobs = open_blob_store(f"gs://{bucket_name}")
+
+        # Continue the bbox trace: message attributes, then notification metadata, then the blob
+        carrier = event.get("attributes") or {}
+        if TRACE_CONTEXT_KEY not in carrier:
+            carrier = message_dict.get("metadata") or store.get_blob_metadata(blobs, blob_name)
+
+        with telemetry.tracer.start_as_current_span(
+            "convert blob",
+            context=telemetry.extract_context(carrier),
+            kind=SpanKind.CONSUMER,
+            attributes={"gcs.blob": blob_name},
+        ), profiling.profiled("converter", blobs, profiling.requested(event.get("attributes"))):
+            convert_blob(blobs, blob_name)
+
+    except Exception as e:
+        logger.exception(f"Unhandled error in Cloud Function: {e}")
+        raise
+    finally:
+        telemetry.flush()
+        logging_config.flush_logs()
@@ -0,0 +1,214 @@
+"""Dispatch stage: hands pending bounding boxes to an executor
+
+Every DISPATCH_TILES_PER_MESSAGE bounding boxes are packed into one binary message, see
+`messages`, which starts its own trace. The W3C trace context travels in the message
+attributes, so the explorer and the NDJSON converter continue the same trace whichever
+executor runs them.
+
+Pending bounding boxes are claimed from the work queue, see `workqueue`,
+DISPATCH_CHUNK_TILES at a time and highest priority first, see `priority`, so a sweep
+cut short by a request budget has explored the cells expected to hold the most
+segments, and concurrent dispatchers never send the same box. Each chunk is then sent
+along the Hilbert curve, see `hilbert`, so neighbouring tiles reach the explorers
+together and land in the same batches. Boxes whose message was never sent go back to
+pending when the dispatch ends, and boxes dispatched but never completed once
+sweeps.REDISPATCH_SECONDS have passed. With a sweep, see `sweeps`, the tiles it has
+left are dispatched instead, with checkpoints a crashed dispatch resumes from.
+"""
+
+import os
+from collections import Counter
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Tuple
+
+from opentelemetry.trace import SpanKind
+
+from segment_hunter import logging_config, messages, sweeps, telemetry, workqueue
+from segment_hunter.config import ENV
+from segment_hunter.executors import Executor, Message
+
+if TYPE_CHECKING:
+    from segment_hunter.tilegrid import TileGrid
+
+logger = logging_config.get_logger(__name__)
+
+# Tiles claimed, turned into messages and handed to the executor at once, and sweep checkpoints
+DISPATCH_CHUNK_TILES = int(os.getenv("DISPATCH_CHUNK_TILES", "500"))
+# Tiles per message, explored one after the other by the explorer that receives it
+DISPATCH_TILES_PER_MESSAGE = int(os.getenv("DISPATCH_TILES_PER_MESSAGE", "4"))
+# Outcomes of messages that never reached an explorer, whose tiles stay pending
+UNSENT_OUTCOMES = {"error", "publish_failed", "retry"}
+
+
+def claim_chunks(db_params: Dict[str, Any], limit: Optional[int] = None) -> Iterator["TileGrid"]:
+    """Claims pending bounding boxes DISPATCH_CHUNK_TILES at a time, up to `limit`, each
+    chunk as it is needed, until none are left"""
+    claimed = 0
+    while limit is None or claimed < limit:
+        size = DISPATCH_CHUNK_TILES if limit is None else min(DISPATCH_CHUNK_TILES, limit - claimed)
+        chunk = workqueue.claim(db_params, size)
+        if not len(chunk):
+            return
+        claimed += len(chunk)
+        logger.info(f"Claimed {len(chunk)} pending bounding boxes, {claimed} so far")
+        yield chunk
+
+
+def pending_summary(db_params: Dict[str, Any], sweep_id: Optional[int] = None) -> Tuple[int, float]:
+    """Number of bounding boxes left to dispatch, overall or in a sweep, and their total
+    expected segment yield"""
+    import psycopg2
+
+    if sweep_id is None:
+        query, params = "SELECT count(*), coalesce(sum(priority), 0) FROM public.bbox_queue WHERE status = %s", ("pending",)
+    else:
+        query = (
+            "SELECT count(*), coalesce(sum(q.priority), 0) FROM public.sweep_tiles t "
+            "JOIN public.bbox_queue q ON q.bbox_id = t.bbox_id WHERE t.sweep_id = %s AND t.status IN ('pending', 'dispatched')"
+        )
+        params = (sweep_id,)
+    with telemetry.timed(telemetry.db_duration, "db pending_summary", operation="pending_summary"):
+        with psycopg2.connect(**db_params) as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+                count, expected = cur.fetchone()
+    return count, float(expected)
+
+
+def build_message(
+    bboxes: List[Dict[str, Any]], variants: Optional[List[Dict[str, Any]]] = None, sweep_id: Optional[int] = None
+) -> Message:
+    """Encodes bounding boxes, with the query variants to explore them with, into one
+    message and starts its trace"""
+    with telemetry.tracer.start_as_current_span(
+        "dispatch tiles",
+        kind=SpanKind.PRODUCER,
+        attributes={"bbox.id": bboxes[0]["id"] if bboxes else -1, "message.tiles": len(bboxes)},
+    ):
+        trace_id = telemetry.current_trace_id()
+        message_bytes = messages.encode_tiles(bboxes, variants, sweep_id)
+        attributes = telemetry.inject_context({"env": ENV, "trace_id": trace_id})
+    return message_bytes, attributes
+
+
+def dispatch(
+    config: Dict[str, Any],
+    executor: Executor,
+    limit: Optional[int] = None,
+    dry_run: bool = False,
+    variants: Optional[List[Dict[str, Any]]] = None,
+    budget: Optional[int] = None,
+    sweep_id: Optional[int] = None,
+) -> Counter:
+    """Explores, or queues for exploration, every pending bounding box
+
+    Args:
+        config (dict): Output of config.load_config
+        executor (Executor): Where the explore stage runs
+        limit (int): Maximum number of bounding boxes to dispatch
+        dry_run (bool): Only count the pending bounding boxes
+        variants (list): Query variants every bounding box is explored with, defaults
+            to the explorer's riding-only query
+        budget (int): Strava requests to spend. Each bounding box costs one request per
+            variant, plus one per category band of a variant that comes back saturated,
+            so the budget is a close lower bound rather than an exact cap.
+        sweep_id (int): Dispatch the tiles of this sweep left to dispatch, with its
+            variants unless `variants` is set, checkpointing every DISPATCH_CHUNK_TILES
+            tiles
+
+    Returns:
+        Counter: Number of bounding boxes per outcome
+    """
+    from segment_hunter import explore
+    from segment_hunter.fetch import DEFAULT_VARIANTS
+    from segment_hunter.tokens import get_token_pool
+
+    # Refresh ahead of expiry so explorers find a fresh token in Secret Manager
+    get_token_pool(config["gcp_project_id"], ENV, config["db_params"]).refresh_all()
+
+    db_params = config["db_params"]
+    if sweep_id is not None:
+        variants = variants or sweeps.get_sweep(db_params, sweep_id)["grid_params"].get("variants")
+    if budget is not None:
+        tiles = budget // len(variants or DEFAULT_VARIANTS)
+        limit = tiles if limit is None else min(limit, tiles)
+
+    if dry_run:
+        if sweep_id is None:
+            left, _ = pending_summary(db_params)
+            count = left if limit is None else min(limit, left)
+        else:
+            count = len(sweeps.fetch_sweep_tiles(db_params, sweep_id, limit))
+        logger.info(f"{count} pending bounding boxes, nothing dispatched")
+        return Counter(pending=count)
+
+    left, expected = pending_summary(db_params, sweep_id) if budget is not None else (0, 0.0)
+    logger.info(f"Dispatching with the {executor.name} executor...")
+    if sweep_id is None:
+        workqueue.requeue_stale(db_params, sweeps.REDISPATCH_SECONDS)
+        outcomes, covered = dispatch_tiles(db_params, executor, claim_chunks(db_params, limit), variants)
+    else:
+        pending = sweeps.fetch_sweep_tiles(db_params, sweep_id, limit)
+        outcomes, covered = dispatch_tiles(db_params, executor, pending.chunks(DISPATCH_CHUNK_TILES), variants)
+    if budget is not None:
+        logger.info(
+            f"Budget of {budget} requests covered {sum(outcomes.values())} of {left} pending bounding boxes, "
+            f"{covered / expected if expected else 0:.0%} of their expected segments"
+        )
+    # Local executors explore in this process, their uploads must land before it exits
+    explore.flush_outputs()
+    if sweep_id is not None:
+        ledger = sweeps.refresh_sweep(db_params, sweep_id)
+        logger.info(
+            f"Sweep {sweep_id} {ledger['status']}: {ledger['tiles_fetched']} of {ledger['tiles']} tiles fetched, "
+            f"{ledger['tiles_failed']} failed, {ledger['api_calls']} Strava requests"
+        )
+    logger.info(f"Dispatch finished: {dict(outcomes)}")
+    return outcomes
+
+
+def dispatch_tiles(
+    db_params: Dict[str, Any],
+    executor: Executor,
+    chunks: Iterator["TileGrid"],
+    variants: Optional[List[Dict[str, Any]]] = None,
+) -> Tuple[Counter, float]:
+    """Dispatches chunks of tiles, each along the Hilbert curve, so only one chunk of
+    messages exists at once, and neighbouring tiles share messages. The sent tiles of a
+    sweep's chunk are marked dispatched before the next, so a dispatcher that crashes
+    resumes after the last chunk. Claimed tiles whose message was never sent are put
+    back to pending at the end, or when dispatch fails, rather than after each chunk,
+    so the next chunk does not claim them again.
+
+    Returns:
+        tuple: Number of bounding boxes per outcome of their message, and the expected
+            segments of those sent
+    """
+    outcomes = Counter()
+    covered = 0.0
+    unsent = []
+    per_message = max(1, DISPATCH_TILES_PER_MESSAGE)
+    try:
+        for chunk in chunks:
+            bboxes = list(chunk.by_hilbert().iter_tiles())
+            groups = [bboxes[i : i + per_message] for i in range(0, len(bboxes), per_message)]
+            results = executor.map([build_message(group, variants, chunk.sweep_id) for group in groups])
+            priorities = dict(zip(chunk.tiles["id"].tolist(), chunk.tiles["priority"].tolist()))
+            sent = []
+            for group, outcome in zip(groups, results):
+                outcomes[outcome] += len(group)
+                ids = [bbox["id"] for bbox in group]
+                if outcome not in UNSENT_OUTCOMES:
+                    sent.extend(ids)
+                    covered += sum(priorities[bbox_id] for bbox_id in ids)
+                elif chunk.sweep_id is None:
+                    # Tiles of a sweep stay pending in its ledger, claimed tiles go back to the queue
+                    unsent.extend(ids)
+            if chunk.sweep_id is not None:
+                if sent:
+                    sweeps.checkpoint_dispatched(db_params, chunk.sweep_id, sent)
+                logger.info(f"Checkpoint: {sum(outcomes.values())} tiles of sweep {chunk.sweep_id} dispatched")
+    finally:
+        if unsent:
+            logger.info(f"Releasing {len(unsent)} bounding boxes whose message was never sent")
+            workqueue.release(db_params, unsent)
+    return outcomes, covered
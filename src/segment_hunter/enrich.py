@@ -0,0 +1,270 @@
+"""Enrich stage: fetches the details of segments the explore stage discovered
+
+The explore endpoint only returns summary fields. Effort and athlete counts, total
+elevation gain and the full polyline come from /segments/{id}, one request per
+segment, so details are only fetched for segments that are new or stale:
+
+- explorers record the segment IDs of every stored batch in `segment_details`, which
+  deduplicates them across tiles, variants and sweeps
+- `enrich` claims never fetched segments first, then segments whose details are older
+  than DETAIL_STALE_DAYS and that explore queries still return
+- details are fetched on DETAIL_CONCURRENCY threads through the shared token pool, so
+  they come out of the same Strava quota as exploring, and stop cleanly once it is spent
+
+Details are packed DETAIL_BATCH_SIZE segments per NDJSON object under DETAIL_PREFIX,
+next to the explored segments NDJSON, and uploaded by the background uploader. Segments
+are marked fetched once their object is stored, and released for the next run if it
+never is. Segments Strava will not return (deleted, private) are marked failed.
+"""
+
+import os
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from opentelemetry import context as otel_context
+from opentelemetry.trace import SpanKind
+
+from segment_hunter import failures, fetch, logging_config, resilience, telemetry
+from segment_hunter.batcher import NDJSON_CONTENT_TYPE, pack_rows
+from segment_hunter.blobstore import BlobStore, open_blob_store
+from segment_hunter.config import ENV
+from segment_hunter.grid import read_sql_file
+from segment_hunter.tokens import StravaTokenPool, get_token_pool
+from segment_hunter.uploader import BackgroundUploader, Upload, get_uploader
+
+logger = logging_config.get_logger(__name__)
+
+DETAIL_PREFIX = "segment_details_ndjson"
+DETAIL_TABLE = "segment_details"
+DETAIL_BATCH_SIZE = int(os.getenv("DETAIL_BATCH_SIZE", "100"))
+DETAIL_CONCURRENCY = int(os.getenv("DETAIL_CONCURRENCY", "4"))
+DETAIL_STALE_DAYS = int(os.getenv("DETAIL_STALE_DAYS", "30"))
+# A claim older than this was left by a crashed run and can be taken again
+CLAIM_TIMEOUT_SECONDS = int(os.getenv("DETAIL_CLAIM_TIMEOUT_SECONDS", "3600"))
+
+
+def _table(schema: str = "public"):
+    from psycopg2 import sql
+
+    return sql.SQL("{schema}.{table}").format(schema=sql.Identifier(schema), table=sql.Identifier(DETAIL_TABLE))
+
+
+def create_table(db_params: Dict[str, Any]):
+    import psycopg2
+
+    with psycopg2.connect(**db_params) as conn:
+        with conn.cursor() as cur:
+            cur.execute(read_sql_file("create_segment_details.sql"))
+            conn.commit()
+
+
+def record_segment_ids(db_params: Dict[str, Any], segment_ids: Iterable[int]):
+    """Adds newly discovered segments and refreshes when known ones were last seen"""
+    import psycopg2
+    from psycopg2 import sql
+
+    # Sorted, so concurrent batches lock shared rows in the same order
+    segment_ids = sorted(set(segment_ids))
+    if not segment_ids:
+        return
+    query = sql.SQL(
+        "INSERT INTO {table} (id) SELECT unnest(%s::bigint[]) ON CONFLICT (id) DO UPDATE SET last_seen = now()"
+    ).format(table=_table())
+    with telemetry.timed(telemetry.db_duration, "db record_segment_ids", operation="record_segment_ids"):
+        with resilience.dependency("postgres").call(), psycopg2.connect(**db_params) as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, (segment_ids,))
+                conn.commit()
+
+
+def claim_segments(db_params: Dict[str, Any], limit: int, stale_days: int = DETAIL_STALE_DAYS) -> List[int]:
+    """Claims up to `limit` segments whose details are missing or stale, skipping rows
+    another run holds so several runs can crawl at once"""
+    import psycopg2
+    from psycopg2 import sql
+
+    query = sql.SQL(
+        """
+        UPDATE {table} SET status = 'claimed', claimed_at = now()
+        WHERE id IN (
+            SELECT id FROM {table}
+            WHERE status = 'pending'
+               OR (status = 'claimed' AND claimed_at < now() - make_interval(secs => %s))
+               OR (status = 'fetched' AND fetched_at < now() - make_interval(days => %s) AND last_seen > fetched_at)
+            ORDER BY fetched_at NULLS FIRST, first_seen
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id
+        """
+    ).format(table=_table())
+    with telemetry.timed(telemetry.db_duration, "db claim_segments", operation="claim_segments"):
+        with resilience.dependency("postgres").call(), psycopg2.connect(**db_params) as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, (CLAIM_TIMEOUT_SECONDS, stale_days, limit))
+                conn.commit()
+                return [row[0] for row in cur.fetchall()]
+
+
+def update_segments_status(db_params: Dict[str, Any], segment_ids: List[int], status: str, reason: Optional[str] = None):
+    """Sets the crawl status of segments: fetched stamps fetched_at, pending releases a claim"""
+    import psycopg2
+    from psycopg2 import sql
+
+    query = sql.SQL(
+        "UPDATE {table} SET status = %s, failure_reason = %s, claimed_at = NULL, "
+        "fetched_at = CASE WHEN %s = 'fetched' THEN now() ELSE fetched_at END WHERE id = ANY(%s)"
+    ).format(table=_table())
+    with telemetry.timed(telemetry.db_duration, "db update_segments_status", operation="update_segments_status"):
+        with resilience.dependency("postgres").call(), psycopg2.connect(**db_params) as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, (status, reason, status, list(segment_ids)))
+                conn.commit()
+    logger.info(f"Updated {len(segment_ids)} segments to {status}")
+
+
+def fetch_details(
+    segment_ids: List[int], tokens: StravaTokenPool, trace_id: str, concurrency: int = DETAIL_CONCURRENCY
+) -> Tuple[List[Dict[str, Any]], Dict[int, failures.ExplorerError]]:
+    """Fetches the details of segments concurrently
+
+    Once the quota of every account is spent, every account is revoked or the Strava
+    circuit opens, the requests not started yet are skipped and reported with that error.
+
+    Returns:
+        tuple: Details fetched, and the error of every segment that was not
+    """
+    context = otel_context.get_current()
+    stop: List[failures.ExplorerError] = []
+
+    def fetch_one(segment_id: int):
+        if stop:
+            return segment_id, stop[0]
+        token = otel_context.attach(context)
+        try:
+            return segment_id, fetch.fetch_segment_detail(segment_id, tokens, trace_id)
+        except Exception as e:
+            error = failures.classify_exception(e)
+            if isinstance(error, (failures.AuthError, failures.CircuitOpenError)) or error.reason == "quota_exhausted":
+                stop.append(error)
+            return segment_id, error
+        finally:
+            otel_context.detach(token)
+
+    details, errors = [], {}
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        for segment_id, result in pool.map(fetch_one, segment_ids):
+            if isinstance(result, failures.ExplorerError):
+                errors[segment_id] = result
+            else:
+                details.append(result)
+    return details, errors
+
+
+def detail_blob_name(details: List[Dict[str, Any]]) -> str:
+    first_fetched = min(detail["time_fetched"] for detail in details)
+    return f"{DETAIL_PREFIX}/{first_fetched}__{len(details)}__{uuid.uuid4().hex[:12]}.ndjson"
+
+
+def enrich_batch(
+    config: Dict[str, Any],
+    segment_ids: List[int],
+    tokens: StravaTokenPool,
+    blobs: BlobStore,
+    uploader: BackgroundUploader,
+    concurrency: int = DETAIL_CONCURRENCY,
+) -> Counter:
+    """Fetches the details of claimed segments and queues them for upload
+
+    Returns:
+        Counter: Number of segments per outcome: stored (queued for upload), failed
+            (Strava will not return them) and released (left for the next run)
+    """
+    db_params = config["db_params"]
+    with telemetry.tracer.start_as_current_span(
+        "enrich batch", kind=SpanKind.PRODUCER, attributes={"segments.claimed": len(segment_ids)}
+    ):
+        trace_id = telemetry.current_trace_id()
+        details, errors = fetch_details(segment_ids, tokens, trace_id, concurrency)
+        carrier = telemetry.inject_context({})
+
+    outcomes = Counter()
+    failed, released = defaultdict(list), []
+    for segment_id, error in errors.items():
+        if isinstance(error, failures.PermanentError):
+            failed[error.reason].append(segment_id)
+        else:
+            released.append(segment_id)
+    for reason, ids in failed.items():
+        update_segments_status(db_params, ids, "failed", reason)
+        outcomes["failed"] += len(ids)
+    if released:
+        update_segments_status(db_params, released, "pending")
+        outcomes["released"] += len(released)
+
+    if details:
+        stored_ids = [detail["id"] for detail in details]
+
+        def on_done(error: Optional[BaseException]):
+            if error is None:
+                update_segments_status(db_params, stored_ids, "fetched")
+            else:
+                logger.error(f"[{trace_id}] Upload failed, {len(stored_ids)} segments released: {error}")
+                update_segments_status(db_params, stored_ids, "pending")
+
+        blob_name = detail_blob_name(details)
+        logger.info(f"[{trace_id}] Packed details of {len(details)} segments into {blob_name}")
+        uploader.submit(Upload(blobs, blob_name, pack_rows(details), NDJSON_CONTENT_TYPE, carrier, on_done))
+        outcomes["stored"] += len(details)
+
+    for outcome, count in outcomes.items():
+        telemetry.segment_details.add(count, {"outcome": outcome})
+    return outcomes
+
+
+def enrich(
+    config: Dict[str, Any],
+    budget: Optional[int] = None,
+    concurrency: int = DETAIL_CONCURRENCY,
+    batch_size: int = DETAIL_BATCH_SIZE,
+) -> Counter:
+    """Fetches the details of new and stale segments until none are left, the budget is
+    spent or the Strava quota runs out
+
+    Args:
+        config (dict): Output of config.load_config
+        budget (int): Maximum number of detail requests
+        concurrency (int): Detail requests in flight at once
+        batch_size (int): Segments claimed and stored per NDJSON object
+
+    Returns:
+        Counter: Number of segments per outcome, see enrich_batch
+    """
+    db_params = config["db_params"]
+    tokens = get_token_pool(config["gcp_project_id"], ENV, db_params)
+    blobs = open_blob_store(config["blob_store_url"])
+    uploader = get_uploader()
+    create_table(db_params)
+
+    outcomes = Counter()
+    remaining = budget
+    start = time.monotonic()
+    while remaining is None or remaining > 0:
+        segment_ids = claim_segments(db_params, batch_size if remaining is None else min(batch_size, remaining))
+        if not segment_ids:
+            break
+        if remaining is not None:
+            remaining -= len(segment_ids)
+        batch_outcomes = enrich_batch(config, segment_ids, tokens, blobs, uploader, concurrency)
+        outcomes.update(batch_outcomes)
+        if batch_outcomes["released"]:
+            logger.warning(f"Stopping, {batch_outcomes['released']} segments could not be fetched and were released")
+            break
+
+    # Marks stored segments fetched before returning
+    uploader.flush()
+    logger.info(f"Enrichment finished in {time.monotonic() - start:.0f}s: {dict(outcomes)}")
+    return outcomes
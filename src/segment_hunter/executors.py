@@ -0,0 +1,194 @@
+"""Executors deciding where the explore stage runs for dispatched bounding boxes
+
+Dispatch packs pending bounding boxes into messages (the binary tile encoding of
+`messages`, plus attributes carrying the trace context; explorers still read the JSON
+messages published before it) and hands the batch to an executor:
+
+    inline    explores each message in the calling thread, one after another
+    threads   explores messages on a thread pool
+    asyncio   explores messages from an event loop, `concurrency` at a time, running the
+              blocking explore stage on worker threads
+    pubsub    publishes messages to the explorer topic, where the Cloud Function or the
+              streaming worker explores them
+
+The local executors call `explore.handle_message` just like the Pub/Sub consumers, so
+failures are classified and dead-lettered the same way. Messages that end in RETRY,
+and tiles of a message left to retry, go back to pending for the next dispatch.
+"""
+
+import asyncio
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+from opentelemetry.trace import SpanKind
+
+from segment_hunter import logging_config, resilience, telemetry
+
+logger = logging_config.get_logger(__name__)
+
+# (data, attributes) as published to Pub/Sub
+Message = Tuple[bytes, Dict[str, str]]
+# Runs the explore stage for one message and returns its outcome
+Handler = Callable[[bytes, Dict[str, str]], str]
+
+MAX_PUBSUB_RETRIES = int(os.getenv("MAX_PUBSUB_RETRIES", "3"))
+PUBSUB_BACKOFF_FACTOR = 4
+
+
+class Executor(ABC):
+    """Runs a handler over a batch of messages and counts the outcomes"""
+
+    name = ""
+
+    def __init__(self, handler: Handler = None, concurrency: int = 1):
+        self.handler = handler
+        self.concurrency = max(1, concurrency)
+
+    def _handle(self, message: Message) -> str:
+        data, attributes = message
+        try:
+            return self.handler(data, attributes)
+        except Exception as e:
+            # handle_message classifies failures itself; anything escaping it is a bug
+            logger.exception(f"Unhandled error exploring message: {e}")
+            return "error"
+
+    @abstractmethod
+    def map(self, messages: Iterable[Message]) -> List[str]:
+        """Processes every message
+
+        Returns:
+            list: Outcome of each message, in order
+        """
+
+    def run(self, messages: Iterable[Message]) -> Counter:
+        """Processes every message
+
+        Returns:
+            Counter: Number of messages per outcome
+        """
+        return Counter(self.map(messages))
+
+
+class InlineExecutor(Executor):
+    name = "inline"
+
+    def map(self, messages: Iterable[Message]) -> List[str]:
+        return [self._handle(message) for message in messages]
+
+
+class ThreadsExecutor(Executor):
+    name = "threads"
+
+    def map(self, messages: Iterable[Message]) -> List[str]:
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="explore") as pool:
+            return list(pool.map(self._handle, messages))
+
+
+class AsyncioExecutor(Executor):
+    name = "asyncio"
+
+    async def _map(self, messages: Iterable[Message]) -> List[str]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def handle(message: Message) -> str:
+            async with semaphore:
+                return await asyncio.to_thread(self._handle, message)
+
+        return list(await asyncio.gather(*(handle(message) for message in messages)))
+
+    def map(self, messages: Iterable[Message]) -> List[str]:
+        return asyncio.run(self._map(messages))
+
+
+class PubSubExecutor(Executor):
+    """Publishes messages for the Cloud Function or streaming worker to explore"""
+
+    name = "pubsub"
+
+    def __init__(self, gcp_project_id: str, topic_name: str, concurrency: int = 1):
+        super().__init__(concurrency=concurrency)
+        from google.cloud import pubsub_v1
+
+        self.publisher = pubsub_v1.PublisherClient()
+        self.topic_path = self.publisher.topic_path(gcp_project_id, topic_name)
+
+    def publish_message_with_retry(self, message_bytes: bytes, attributes: Dict[str, str]) -> str:
+        for attempt in range(1, MAX_PUBSUB_RETRIES + 1):
+            try:
+                with telemetry.timed(
+                    telemetry.pubsub_duration,
+                    "pubsub publish",
+                    kind=SpanKind.PRODUCER,
+                    context=telemetry.extract_context(attributes),
+                    operation="publish",
+                ):
+                    with resilience.dependency("pubsub").call():
+                        message_id = self.publisher.publish(self.topic_path, message_bytes, **attributes).result()
+                logger.info(f"Published message ID: {message_id} (trace_id={attributes.get('trace_id')})")
+                return message_id
+            except Exception as e:
+                wait_time = resilience.backoff_delay(
+                    attempt, factor=PUBSUB_BACKOFF_FACTOR, retry_after=getattr(e, "retry_after", None)
+                )
+                logger.warning(f"Pub/Sub publish attempt {attempt} failed: {e}. Retrying in {wait_time:.1f}s.")
+                time.sleep(wait_time)
+        raise RuntimeError("Failed to publish message to Pub/Sub after retries.")
+
+    def _handle(self, message: Message) -> str:
+        data, attributes = message
+        try:
+            self.publish_message_with_retry(data, attributes)
+            return "published"
+        except Exception as e:
+            logger.exception(f"[{attributes.get('trace_id')}] Failed to publish message: {e}")
+            return "publish_failed"
+
+    def map(self, messages: Iterable[Message]) -> List[str]:
+        # publish() batches in the background; waiting on each result is what needs threads
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="publish") as pool:
+            return list(pool.map(self._handle, messages))
+
+
+EXECUTORS = {
+    executor.name: executor
+    for executor in (InlineExecutor, ThreadsExecutor, AsyncioExecutor, PubSubExecutor)
+}
+
+
+def get_executor(name: str, config: Dict[str, Any], concurrency: int = 1) -> Executor:
+    """Builds the named executor for the configured project
+
+    Local executors explore with the process-wide Strava token pool.
+
+    Args:
+        name (str): inline, threads, asyncio or pubsub
+        config (dict): Output of config.load_config
+        concurrency (int): Messages explored in parallel by the threads and asyncio executors
+
+    Returns:
+        Executor: Executor ready to `run`
+    """
+    if name not in EXECUTORS:
+        raise ValueError(f"Unknown executor '{name}', expected one of {sorted(EXECUTORS)}")
+    if name == PubSubExecutor.name:
+        return PubSubExecutor(config["gcp_project_id"], config["tf_outputs"]["pubsub_topic_path"]["value"], concurrency)
+
+    from segment_hunter import explore, workqueue
+    from segment_hunter.config import ENV
+    from segment_hunter.tokens import get_token_pool
+
+    tokens = get_token_pool(config["gcp_project_id"], ENV, config["db_params"])
+
+    def release(tiles: List[Dict[str, Any]], attributes: Dict[str, str]):
+        # Off Pub/Sub, tiles left to retry go back to pending for the next dispatch
+        workqueue.release(config["db_params"], [tile["id"] for tile in tiles])
+
+    def handler(data: bytes, attributes: Dict[str, str]) -> str:
+        return explore.handle_message(data, attributes, tokens, config, requeue=release)
+
+    return EXECUTORS[name](handler, concurrency)
@@ -0,0 +1,345 @@
+"""Explore stage: fetch, store and mark the bounding boxes of one message
+
+Explored tiles are packed into batches by `TileBatcher`, and marked fetched once their
+batch is stored. Consumers that may be frozen or stopped call `flush_outputs` or
+`close_outputs` first.
+
+`handle_message` is shared by every consumer (streaming worker, single pull, Cloud
+Function and the local executors), so failures are classified, dead-lettered and
+counted the same way whichever executor runs the stage. It returns one of the outcomes
+below. The caller acknowledges a DEAD_LETTERED message right away and nacks a RETRY
+one. Pub/Sub consumers acknowledge a PROCESSED message from its `on_stored` callback,
+once the batches holding its tiles are stored, so a worker that stops before then
+loses no tile: the message is redelivered.
+"""
+
+import json
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from opentelemetry.trace import SpanKind
+
+from segment_hunter import enrich, failures, fetch, logging_config, messages, store, sweeps, telemetry
+from segment_hunter.batcher import Tile, TileBatcher
+from segment_hunter.blobstore import open_blob_store
+from segment_hunter.sinks import open_segment_sink
+from segment_hunter.tokens import StravaTokenPool
+from segment_hunter.uploader import get_uploader
+
+logger = logging_config.get_logger(__name__)
+
+PROCESSED = "processed"
+DEAD_LETTERED = "dead_lettered"
+RETRY = "retry"
+
+_batcher: Optional[TileBatcher] = None
+_batcher_lock = threading.Lock()
+
+
+class MessageReceipt:
+    """Calls `on_stored` once every tile a message queued is stored, with the first
+    storage error if any batch failed
+
+    The receipt is held until `release` is called for the message itself, so batches
+    stored while its later tiles are still being explored do not settle it early.
+    """
+
+    def __init__(self, on_stored: Callable[[Optional[BaseException]], None]):
+        self.on_stored = on_stored
+        self._pending = 1
+        self._error: Optional[BaseException] = None
+        self._lock = threading.Lock()
+
+    def hold(self) -> Callable[[Optional[BaseException]], None]:
+        """Holds the receipt for one more tile, returning the callback its batch calls"""
+        with self._lock:
+            self._pending += 1
+        return self.release
+
+    def release(self, error: Optional[BaseException] = None):
+        with self._lock:
+            self._error = self._error or error
+            self._pending -= 1
+            settled = self._pending == 0
+        if settled:
+            self.on_stored(self._error)
+
+
+def mark_batch_stored(config: Dict[str, Any], tiles: List[Tile], error: Optional[BaseException]):
+    """Marks the tiles of a batch fetched once stored, and records their segments for the
+    detail crawl; if it never was, they stay dispatched and a later dispatch requeues and
+    explores them again. Raises if they cannot be marked, so the messages they came
+    from are nacked and retried."""
+    if error is not None:
+        for tile in tiles:
+            logger.error(f"[{tile.trace_id}] Batch upload failed, bounding box {tile.bbox_id} stays dispatched: {error}")
+        return
+    store.update_bounding_boxes_status(
+        config["db_params"], [tile.bbox_id for tile in tiles], "fetched", [tile.segment_count for tile in tiles]
+    )
+    for sweep_id in {tile.sweep_id for tile in tiles if tile.sweep_id is not None}:
+        swept = [tile for tile in tiles if tile.sweep_id == sweep_id]
+        sweeps.update_sweep_tiles(
+            config["db_params"],
+            sweep_id,
+            [tile.bbox_id for tile in swept],
+            "fetched",
+            [tile.segment_count for tile in swept],
+            [tile.api_calls for tile in swept],
+        )
+    try:
+        enrich.record_segment_ids(config["db_params"], {segment_id for tile in tiles for segment_id in tile.segment_ids})
+    except Exception as e:
+        # The tiles are explored all the same, their segments are recorded again next sweep
+        logger.warning(f"Failed to record segments of {len(tiles)} tiles for enrichment: {e}")
+
+
+def get_batcher(config: Dict[str, Any]) -> TileBatcher:
+    """Batcher shared by every consumer in the process, writing to config["segment_sink_url"]
+    if set, else to config["blob_store_url"]"""
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            sink_url = config.get("segment_sink_url")
+            _batcher = TileBatcher(
+                open_blob_store(config["blob_store_url"]),
+                lambda tiles, error: mark_batch_stored(config, tiles, error),
+                sink=open_segment_sink(sink_url) if sink_url else None,
+            )
+        return _batcher
+
+
+def flush_outputs():
+    """Packs the waiting tiles and waits for every queued upload to be stored"""
+    if _batcher is not None:
+        _batcher.flush()
+    get_uploader().flush()
+
+
+def close_outputs():
+    """Packs the last batch, then stops the batcher and uploader threads"""
+    if _batcher is not None:
+        _batcher.close()
+        if _batcher.sink is not None:
+            _batcher.sink.close()
+    get_uploader().close()
+
+
+def explore_bbox(
+    message_data: Dict[str, Any],
+    tokens: StravaTokenPool,
+    config: Dict[str, Any],
+    trace_id: str,
+    receipt: Optional[MessageReceipt] = None,
+):
+    """Explores one bounding box with every variant of its message and adds the result to
+    the current batch, which marks it fetched once stored
+
+    Args:
+        message_data (dict): Tile validated by failures.validate_bbox_message
+        tokens (StravaTokenPool): Pool of Strava accounts to make requests with
+        config (dict): Output of config.load_config
+        trace_id (str): Trace ID used to correlate log lines
+        receipt (MessageReceipt): Receipt of the message, held until the tile is stored
+    """
+    logger.info(f"[{trace_id}] Processing bounding box {message_data['id']}...")
+    coordinates = [message_data[key] for key in failures.BBOX_KEYS]
+    logger.debug(f"[{trace_id}] Coordinates: {coordinates}")
+
+    variants = message_data.get("variants") or fetch.DEFAULT_VARIANTS
+    segment_data = fetch.explore_variants(coordinates, variants, tokens, trace_id)
+    get_batcher(config).add(
+        Tile(
+            message_data["id"],
+            coordinates,
+            segment_data,
+            telemetry.inject_context({}),
+            trace_id,
+            message_data.get("sweep_id"),
+            message_data.get("hilbert"),
+            receipt.hold() if receipt is not None else None,
+        )
+    )
+    logger.info(f"[{trace_id}] Queued bounding box {message_data['id']} for the next batch")
+
+
+def dead_letter_message(config: Dict[str, Any], data: bytes, attributes: Dict[str, str], error: failures.ExplorerError, trace_id: str):
+    """Moves a permanently failed message to the dead-letter topic and marks the bounding
+    box of each of its tiles, and its tile of the sweep that dispatched it, failed
+
+    Args:
+        config (dict): Output of config.load_config
+        data (bytes): Original message data
+        attributes (dict): Original message attributes
+        error (failures.ExplorerError): Classified failure
+        trace_id (str): Trace ID used to correlate log lines
+    """
+    message_id = failures.publish_dead_letter(
+        config["gcp_project_id"], config["tf_outputs"]["pubsub_dlq_topic"]["value"], data, error, attributes
+    )
+    logger.warning(f"[{trace_id}] Dead-lettered message as {message_id}: {error.reason}")
+    bbox_ids = failures.extract_bbox_ids(data)
+    if bbox_ids:
+        store.update_bounding_boxes_status(config["db_params"], bbox_ids, "failed", reason=error.reason)
+        sweep_id = failures.extract_sweep_id(data)
+        if sweep_id is not None:
+            sweeps.update_sweep_tiles(config["db_params"], sweep_id, bbox_ids, "failed", reason=error.reason)
+    telemetry.messages_total.add(1, {"outcome": "dead_lettered"})
+
+
+def handle_failed_message(
+    config: Dict[str, Any],
+    data: bytes,
+    attributes: Dict[str, str],
+    e: Exception,
+    trace_id: str,
+    give_up_retrying: Optional[str] = None,
+) -> bool:
+    """Classifies a processing failure and dead-letters the message if it can never succeed
+
+    Args:
+        give_up_retrying (str): Set by consumers that bound retries themselves, e.g. the
+            Cloud Function once the event is too old. Retryable failures are then
+            dead-lettered with reason `retry_window_exceeded` and this detail.
+
+    Returns:
+        bool: True if the message was dead-lettered and should be acknowledged,
+            False if it should be nacked for redelivery
+    """
+    telemetry.messages_total.add(1, {"outcome": "failed"})
+    telemetry.record_error(e)
+    error = failures.classify_exception(e)
+    if error.retryable:
+        if give_up_retrying is None:
+            logger.exception(f"[{trace_id}] Retryable failure processing message ({error.reason}): {e}")
+            return False
+        error = failures.PermanentError("retry_window_exceeded", f"{error.reason} {give_up_retrying}: {error}")
+    logger.error(f"[{trace_id}] Permanent failure processing message ({error.reason}): {e}")
+    try:
+        dead_letter_message(config, data, attributes, error, trace_id)
+        return True
+    except Exception as dlq_error:
+        logger.exception(f"[{trace_id}] Failed to dead-letter message: {dlq_error}")
+        return False
+
+
+def tile_message_data(tile: Dict[str, Any]) -> bytes:
+    """A single-tile message holding one tile of a decoded message, to dead-letter it on
+    its own. Tiles that cannot be encoded, being invalid, are kept as JSON."""
+    try:
+        return messages.encode_tiles([tile], tile.get("variants"), tile.get("sweep_id"))
+    except Exception:
+        return json.dumps(tile, default=str).encode("utf-8")
+
+
+def republish_tiles(config: Dict[str, Any], tiles: List[Dict[str, Any]], attributes: Dict[str, str]):
+    """Publishes the tiles of a message left to retry as one message of their own to the
+    explorer topic, with the original attributes, so the rest can be acknowledged"""
+    publisher = failures.get_publisher()
+    topic_path = publisher.topic_path(config["gcp_project_id"], config["tf_outputs"]["pubsub_topic_path"]["value"])
+    data = messages.encode_tiles(tiles, tiles[0].get("variants"), tiles[0].get("sweep_id"))
+    publisher.publish(topic_path, data, **attributes).result()
+
+
+def handle_tile(
+    tile: Dict[str, Any],
+    data: bytes,
+    attributes: Dict[str, str],
+    tokens: StravaTokenPool,
+    config: Dict[str, Any],
+    give_up_retrying: Optional[str] = None,
+    receipt: Optional[MessageReceipt] = None,
+) -> str:
+    """Validates and explores one tile of a message, dead-lettering it alone if it can
+    never succeed
+
+    Args:
+        tile (dict): Tile decoded by messages.decode
+        data (bytes): Message data to dead-letter for this tile
+        receipt (MessageReceipt): Receipt of the message, see `explore_bbox`
+    """
+    with telemetry.tracer.start_as_current_span("explore bbox", kind=SpanKind.INTERNAL) as span:
+        trace_id = telemetry.current_trace_id()
+        try:
+            message_data = failures.validate_bbox_message(tile)
+            span.set_attribute("bbox.id", message_data["id"])
+            explore_bbox(message_data, tokens, config, trace_id, receipt)
+            telemetry.messages_total.add(1, {"outcome": PROCESSED})
+            return PROCESSED
+        except Exception as e:
+            if handle_failed_message(config, data, attributes, e, trace_id, give_up_retrying):
+                return DEAD_LETTERED
+            return RETRY
+
+
+def handle_message(
+    data: bytes,
+    attributes: Dict[str, str],
+    tokens: StravaTokenPool,
+    config: Dict[str, Any],
+    give_up_retrying: Optional[str] = None,
+    requeue: Optional[Callable[[List[Dict[str, Any]], Dict[str, str]], None]] = None,
+    on_stored: Optional[Callable[[Optional[BaseException]], None]] = None,
+) -> str:
+    """Explores the tiles carried by one message in order, continuing its trace
+
+    A tile that can never succeed is dead-lettered on its own and the others are still
+    explored. Tiles that fail with a retryable error are requeued together once the
+    others are handled, so a redelivery never explores or dead-letters a tile twice. The
+    whole message is only redelivered if every tile failed that way, or requeueing failed.
+
+    Args:
+        data (bytes): Message data published by dispatch, see `messages`
+        attributes (dict): Message attributes, carrying the W3C trace context
+        tokens (StravaTokenPool): Pool of Strava accounts to make requests with
+        config (dict): Output of config.load_config
+        give_up_retrying (str): See handle_failed_message
+        requeue (callable): Called with the tiles to retry and the message attributes,
+            defaults to `republish_tiles`
+        on_stored (callable): For a PROCESSED message, called once with None when every
+            tile explored is stored, or with the error if a batch never was. Never
+            called for other outcomes.
+
+    Returns:
+        str: PROCESSED if any tile was explored, DEAD_LETTERED if every tile handled
+            was, or RETRY
+    """
+    with telemetry.tracer.start_as_current_span(
+        "explore message", context=telemetry.extract_context(attributes), kind=SpanKind.CONSUMER
+    ) as span:
+        trace_id = telemetry.current_trace_id()
+        try:
+            tiles = messages.decode(data)
+        except Exception as e:
+            if handle_failed_message(config, data, attributes, e, trace_id, give_up_retrying):
+                return DEAD_LETTERED
+            return RETRY
+        span.set_attribute("message.tiles", len(tiles))
+
+        receipt = MessageReceipt(on_stored) if on_stored is not None else None
+        outcomes, retry = [], []
+        for tile in tiles:
+            tile_data = data if len(tiles) == 1 else tile_message_data(tile)
+            outcome = handle_tile(tile, tile_data, attributes, tokens, config, give_up_retrying, receipt)
+            if outcome == RETRY:
+                retry.append(tile)
+            else:
+                outcomes.append(outcome)
+        if not outcomes:
+            return RETRY
+        if retry:
+            try:
+                (requeue or (lambda tiles, attributes: republish_tiles(config, tiles, attributes)))(retry, attributes)
+            except Exception as e:
+                logger.exception(
+                    f"[{trace_id}] Failed to requeue {len(retry)} of {len(tiles)} tiles, the whole message will be "
+                    f"redelivered and its other tiles explored again: {e}"
+                )
+                return RETRY
+            logger.info(f"[{trace_id}] Requeued {len(retry)} of {len(tiles)} tiles to retry")
+            telemetry.messages_total.add(len(retry), {"outcome": "requeued"})
+        if PROCESSED not in outcomes:
+            return DEAD_LETTERED
+        if receipt is not None:
+            receipt.release()
+        return PROCESSED
@@ -0,0 +1,245 @@
+"""Classification of explorer failures and dead-letter handling
+
+Failures are split into two kinds:
+
+* RetryableError: transient problems (HTTP 429/5xx, connection errors, auth errors
+  while the token is being rotated). The message is nacked and Pub/Sub redelivers it
+  with the subscription's backoff, up to its max_delivery_attempts. A call shed by an
+  open circuit breaker raises CircuitOpenError, see `resilience`.
+* PermanentError: the message itself can never succeed (undecodable payload, bad
+  coordinates, HTTP 400/404). The message is published to the dead-letter topic, its
+  bounding box is marked `failed` with the reason, and the original is acknowledged so
+  it stops consuming worker time and API quota.
+"""
+
+import math
+import sys
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+from segment_hunter import hilbert
+
+if TYPE_CHECKING:
+    import requests
+    from google.cloud import pubsub_v1
+
+BBOX_KEYS = ["sw_latitude", "sw_longitude", "ne_latitude", "ne_longitude"]
+# Explore query parameters a message may set per variant, and their allowed values
+VARIANT_FIELDS = {"activity_type": {"riding", "running"}, "min_cat": set(range(6)), "max_cat": set(range(6))}
+PERMANENT_HTTP_STATUSES = {400, 404, 422}
+AUTH_HTTP_STATUSES = {401, 403}
+
+
+class ExplorerError(Exception):
+    """Base class for classified explorer failures"""
+
+    retryable = True
+
+    def __init__(self, reason: str, message: str = ""):
+        super().__init__(message or reason)
+        self.reason = reason
+
+
+class RetryableError(ExplorerError):
+    """Transient failure, the message should be redelivered later"""
+
+    retryable = True
+
+
+class AuthError(RetryableError):
+    """Strava rejected the access token. Not worth retrying the request, but the
+    message is fine and will succeed once the token has been refreshed"""
+
+
+class CircuitOpenError(RetryableError):
+    """A dependency's circuit breaker is open and the call was shed without being made
+
+    Args:
+        dependency (str): Name of the dependency, e.g. strava
+        retry_after (float): Seconds until the breaker lets a probe call through
+    """
+
+    def __init__(self, dependency: str, retry_after: float):
+        super().__init__("circuit_open", f"{dependency} circuit open for another {retry_after:.0f}s")
+        self.dependency = dependency
+        self.retry_after = retry_after
+
+
+class PermanentError(ExplorerError):
+    """The message can never be processed and must be dead-lettered"""
+
+    retryable = False
+
+
+def classify_http_error(error: "requests.HTTPError") -> ExplorerError:
+    """Maps an HTTP error raised by `raise_for_status` to a classified failure
+
+    Args:
+        error (requests.HTTPError): Error raised for a non-2xx response
+
+    Returns:
+        ExplorerError: PermanentError, AuthError or RetryableError
+    """
+    status = error.response.status_code if error.response is not None else None
+    if status in PERMANENT_HTTP_STATUSES:
+        return PermanentError(f"http_{status}", str(error))
+    if status in AUTH_HTTP_STATUSES:
+        return AuthError(f"http_{status}", str(error))
+    return RetryableError(f"http_{status}" if status else "http_error", str(error))
+
+
+def classify_exception(error: Exception) -> ExplorerError:
+    """Classifies any exception raised while processing a message
+
+    Only a message that can never be processed is a permanent failure, and
+    messages.decode and validate_bbox_message raise PermanentError for those
+    themselves. Any other exception, including a KeyError, TypeError or ValueError
+    from a bug anywhere in the explore stage, is treated as retryable so the message is
+    not dead-lettered and its bounding box not failed for good; the subscription's dead
+    letter policy bounds how often it is redelivered.
+
+    Args:
+        error (Exception): Exception raised while processing a message
+
+    Returns:
+        ExplorerError: Classified failure
+    """
+    if isinstance(error, ExplorerError):
+        return error
+    # Only loaded by the stages calling Strava, an error cannot come from it otherwise,
+    # and the converter is deployed without it
+    requests = sys.modules.get("requests")
+    if requests is not None:
+        if isinstance(error, requests.HTTPError):
+            return classify_http_error(error)
+        if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            return RetryableError("connection_error", str(error))
+        if isinstance(error, requests.RequestException):
+            return RetryableError("request_error", str(error))
+    return RetryableError("unexpected_error", f"{type(error).__name__}: {error}")
+
+
+def validate_bbox_message(message_data: Any) -> Dict[str, Any]:
+    """Validates one tile of a message decoded by messages.decode
+
+    Args:
+        message_data (dict): Decoded tile
+
+    Raises:
+        PermanentError: If the coordinates, variants or sweep are invalid
+
+    Returns:
+        dict: The tile, with its Hilbert index computed if it had none
+    """
+    if not isinstance(message_data, dict) or message_data.get("id") is None:
+        raise PermanentError("invalid_message", "Message has no bounding box id")
+
+    try:
+        sw_lat, sw_lon, ne_lat, ne_lon = (float(message_data[key]) for key in BBOX_KEYS)
+    except (KeyError, TypeError, ValueError) as e:
+        raise PermanentError("bad_coordinates", f"Missing or non-numeric coordinate: {e}")
+
+    if not all(math.isfinite(c) for c in (sw_lat, sw_lon, ne_lat, ne_lon)):
+        raise PermanentError("bad_coordinates", "Coordinates must be finite")
+    if not (-90 <= sw_lat < ne_lat <= 90) or not (-180 <= sw_lon < ne_lon <= 180):
+        raise PermanentError(
+            "bad_coordinates",
+            f"Invalid bounds sw=({sw_lat}, {sw_lon}) ne=({ne_lat}, {ne_lon})",
+        )
+    if "variants" in message_data:
+        message_data["variants"] = parse_variants(message_data["variants"])
+    if message_data.get("sweep_id") is not None and not isinstance(message_data["sweep_id"], int):
+        raise PermanentError("invalid_message", f"Non-integer sweep id {message_data['sweep_id']!r}")
+    # Messages dispatched before tiles had a Hilbert index, or from a grid without one
+    if not isinstance(message_data.get("hilbert"), int) or message_data["hilbert"] < 0:
+        message_data["hilbert"] = hilbert.tile_index(sw_lat, sw_lon, ne_lat, ne_lon)
+    return message_data
+
+
+def parse_variants(variants: Any) -> List[Dict[str, Any]]:
+    """Validates the explore query variants of a message
+
+    Raises:
+        PermanentError: If a variant has an unknown field or value, or an inverted category band
+
+    Returns:
+        list: The variants
+    """
+    if not isinstance(variants, list) or not variants:
+        raise PermanentError("bad_variants", "variants must be a non-empty list")
+    for variant in variants:
+        if not isinstance(variant, dict):
+            raise PermanentError("bad_variants", f"Variant is not an object: {variant!r}")
+        for field, value in variant.items():
+            if field not in VARIANT_FIELDS or not isinstance(value, (str, int)) or value not in VARIANT_FIELDS[field]:
+                raise PermanentError("bad_variants", f"Invalid variant {field}={value!r}")
+        if variant.get("min_cat", 0) > variant.get("max_cat", 5):
+            raise PermanentError("bad_variants", f"min_cat above max_cat in {variant}")
+    return variants
+
+
+def extract_bbox_ids(data: bytes) -> List[int]:
+    """Best effort lookup of the bounding box ids of every tile of a message that failed
+    validation, none if it cannot be decoded"""
+    from segment_hunter import messages
+
+    try:
+        tiles = messages.decode(data)
+    except Exception:
+        return []
+    bbox_ids = []
+    for tile in tiles:
+        try:
+            bbox_ids.append(int(tile["id"]))
+        except Exception:
+            continue
+    return bbox_ids
+
+
+def extract_sweep_id(data: bytes) -> Optional[int]:
+    """Best effort lookup of the sweep that dispatched a message that failed validation"""
+    from segment_hunter import messages
+
+    try:
+        return int(messages.decode(data)[0]["sweep_id"])
+    except Exception:
+        return None
+
+
+@lru_cache(maxsize=1)
+def get_publisher() -> "pubsub_v1.PublisherClient":
+    # Imported on first dead letter, pubsub_v1 pulls in grpc and is slow to import
+    from google.cloud import pubsub_v1
+
+    return pubsub_v1.PublisherClient()
+
+
+def publish_dead_letter(
+    gcp_project_id: str,
+    topic_name: str,
+    data: bytes,
+    error: ExplorerError,
+    attributes: Optional[Dict[str, str]] = None,
+) -> str:
+    """Publishes the original message payload to the dead-letter topic
+
+    Args:
+        gcp_project_id (str): GCP project ID
+        topic_name (str): Name of the dead-letter topic
+        data (bytes): Original message data
+        error (ExplorerError): Classified failure
+        attributes (dict): Original message attributes, kept so it can be replayed
+
+    Returns:
+        str: Published message ID
+    """
+    publisher = get_publisher()
+    topic_path = publisher.topic_path(gcp_project_id, topic_name)
+    dead_letter_attributes = dict(attributes or {})
+    dead_letter_attributes.update(
+        {
+            "failure_reason": error.reason,
+            "failure_detail": str(error)[:1024],
+        }
+    )
+    return publisher.publish(topic_path, data, **dead_letter_attributes).result()
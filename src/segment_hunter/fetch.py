@@ -0,0 +1,202 @@
+"""Fetch stage: calls the Strava explore endpoint for one bounding box, and the segment
+endpoint for the details of one segment
+
+A bounding box message may carry several query variants (activity type and climb
+category band); `explore_variants` runs them all as one unit of work.
+
+Requests are scheduled across the Strava accounts of a StravaTokenPool and guarded by
+the strava dependency's adaptive limit and circuit breaker, see `resilience`. Throttled
+or rejected accounts are skipped in favour of another one; other transient failures are
+retried with jittered exponential backoff, honouring Retry-After, and failures are
+classified for the callers.
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse
+
+import requests
+from opentelemetry import context as otel_context
+from opentelemetry.trace import SpanKind
+
+from segment_hunter import failures, logging_config, resilience, telemetry
+from segment_hunter.tokens import StravaTokenPool
+
+logger = logging_config.get_logger(__name__)
+
+EXPLORE_URL = "https://www.strava.com/api/v3/segments/explore"
+SEGMENT_URL = "https://www.strava.com/api/v3/segments/{segment_id}"
+MAX_REQUEST_RETRIES = int(os.getenv("MAX_REQUEST_RETRIES", "6"))
+# Retries wait a jittered delay of up to BACKOFF_FACTOR ** (attempt - 1) seconds, or Retry-After
+BACKOFF_FACTOR = 4
+MAX_BACKOFF_SECONDS = 300
+# Worst case time spent sleeping between retries of one request
+MAX_TOTAL_BACKOFF_SECONDS = sum(min(MAX_BACKOFF_SECONDS, BACKOFF_FACTOR ** n) + 1 for n in range(MAX_REQUEST_RETRIES))
+
+# Query variants of messages that do not set any, the original riding-only query
+DEFAULT_VARIANTS = [{"activity_type": "riding"}]
+# The explore endpoint returns the top 10 segments of the bounds, more may be hidden
+EXPLORE_RESULT_LIMIT = 10
+# Climb category bands, "min-max" comma separated, a saturated variant is split into
+CATEGORY_BANDS = [
+    tuple(int(cat) for cat in band.split("-"))
+    for band in os.getenv("CATEGORY_BANDS", "0-0,1-2,3-5").split(",")
+]
+SPLIT_SATURATED = os.getenv("SPLIT_SATURATED", "1") == "1"
+# Variant requests of one tile in flight at once
+VARIANT_CONCURRENCY = int(os.getenv("VARIANT_CONCURRENCY", "4"))
+
+
+def requests_get_with_retry(
+    url: str, params: Dict[str, Any], trace_id: str, tokens: StravaTokenPool, route: Optional[str] = None
+) -> Dict[str, Any]:
+    """GETs a Strava endpoint, `route` names it in spans and metrics when the URL path
+    carries an ID, e.g. /api/v3/segments/{segment_id}"""
+    for attempt in range(1, MAX_REQUEST_RETRIES + 1):
+        account, access_token = tokens.acquire()
+        headers = {"accept": "application/json", "authorization": f"Bearer {access_token}"}
+        try:
+            logger.debug(f"[{trace_id}] Attempt {attempt} GET {url} with params {params} using account '{account}'")
+            endpoint = route or urlparse(url).path
+            start = time.perf_counter()
+            response = None
+            with telemetry.tracer.start_as_current_span(f"GET {endpoint}", kind=SpanKind.CLIENT) as span:
+                try:
+                    with resilience.dependency("strava").call() as call:
+                        response = requests.get(url, headers=headers, params=params)
+                        if response.status_code == 429:
+                            call.throttled()
+                        elif response.status_code >= 500:
+                            call.failure()
+                    span.set_attribute("http.response.status_code", response.status_code)
+                finally:
+                    telemetry.strava_request_duration.record(
+                        time.perf_counter() - start,
+                        {
+                            "endpoint": endpoint,
+                            "status_code": response.status_code if response is not None else "error",
+                            "account": account or "default",
+                        },
+                    )
+            tokens.record_response(account, response)
+            response.raise_for_status()
+            return response.json()
+        except requests.RequestException as e:
+            error = failures.classify_exception(e)
+            status = e.response.status_code if e.response is not None else None
+            if (status == 429 or isinstance(error, failures.AuthError)) and tokens.has_other_accounts(account):
+                logger.warning(f"[{trace_id}] Account '{account}' failed with {error.reason}, retrying on another account")
+                continue
+            if isinstance(error, (failures.PermanentError, failures.AuthError)):
+                logger.warning(f"[{trace_id}] GET request failed with non-retryable error ({error.reason}): {e}")
+                raise error from e
+            retry_after = resilience.parse_retry_after(e.response.headers.get("Retry-After")) if e.response is not None else None
+            wait_time = resilience.backoff_delay(attempt, factor=BACKOFF_FACTOR, cap=MAX_BACKOFF_SECONDS, retry_after=retry_after)
+            logger.warning(f"[{trace_id}] GET request attempt {attempt} failed: {e}. Retrying in {wait_time:.1f}s")
+            telemetry.strava_retries.add(1, {"reason": error.reason})
+            time.sleep(wait_time)
+    raise failures.RetryableError("retries_exhausted", f"[{trace_id}] Failed to fetch {url} after {MAX_REQUEST_RETRIES} attempts.")
+
+
+def variant_key(variant: Dict[str, Any]) -> str:
+    """Stable name of a query variant, e.g. activity_type=riding,max_cat=5,min_cat=3"""
+    return ",".join(f"{field}={variant[field]}" for field in sorted(variant))
+
+
+def fetch_segments_from_strava(
+    coordinates: List[float], tokens: StravaTokenPool, trace_id: str, variant: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """Explores the segments inside one bounding box
+
+    Args:
+        coordinates (list): sw_latitude, sw_longitude, ne_latitude, ne_longitude
+        tokens (StravaTokenPool): Pool of Strava accounts to make requests with
+        trace_id (str): Trace ID used to correlate log lines
+        variant (dict): Extra query parameters, activity_type and min_cat/max_cat.
+            Defaults to riding segments of every category.
+
+    Returns:
+        dict: Explore response with a `time_fetched` epoch timestamp added
+    """
+    variant = variant or DEFAULT_VARIANTS[0]
+    bounds = ",".join(str(coord) for coord in coordinates)
+    params = {"bounds": bounds, "activity_type": "riding", **variant}
+
+    logger.info(f"[{trace_id}] Fetching Strava segments for bounds {bounds} ({variant_key(variant)})")
+    segment_data = requests_get_with_retry(EXPLORE_URL, params, trace_id, tokens)
+    segment_data["time_fetched"] = int(time.time())
+    telemetry.segments_per_box.record(len(segment_data.get("segments", [])), {"activity_type": params["activity_type"]})
+    logger.info(f"[{trace_id}] Fetched {len(segment_data.get('segments', []))} segments")
+    return segment_data
+
+
+def category_bands(variant: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Narrower variants splitting a saturated one by climb category, per CATEGORY_BANDS"""
+    return [{**variant, "min_cat": low, "max_cat": high} for low, high in CATEGORY_BANDS]
+
+
+def explore_variants(
+    coordinates: List[float], variants: List[Dict[str, Any]], tokens: StravaTokenPool, trace_id: str
+) -> Dict[str, Any]:
+    """Explores one bounding box with every query variant of its message
+
+    Variants are requested concurrently; the token pool schedules them against the
+    shared Strava quota like any other request. The explore endpoint returns at most
+    EXPLORE_RESULT_LIMIT segments, so a variant without a category band that comes back
+    full is split into CATEGORY_BANDS, which surfaces segments the full query crowded
+    out without splitting the tile itself. Any failed variant fails the whole tile.
+
+    Args:
+        coordinates (list): sw_latitude, sw_longitude, ne_latitude, ne_longitude
+        variants (list): Query variants, see failures.parse_variants
+        tokens (StravaTokenPool): Pool of Strava accounts to make requests with
+        trace_id (str): Trace ID used to correlate log lines
+
+    Returns:
+        dict: `time_fetched` and, per variant key, the `params` and `segments` found
+    """
+    results: Dict[str, Dict[str, Any]] = {}
+    context = otel_context.get_current()
+
+    def fetch(variant: Dict[str, Any]) -> List[Dict[str, Any]]:
+        token = otel_context.attach(context)
+        try:
+            return fetch_segments_from_strava(coordinates, tokens, trace_id, variant).get("segments", [])
+        finally:
+            otel_context.detach(token)
+
+    pending = list({variant_key(variant): variant for variant in variants}.values())
+    with ThreadPoolExecutor(max_workers=max(1, min(VARIANT_CONCURRENCY, len(pending) * len(CATEGORY_BANDS)))) as pool:
+        while pending:
+            batch = [variant for variant in pending if variant_key(variant) not in results]
+            pending = []
+            for variant, segments in zip(batch, pool.map(fetch, batch)):
+                results[variant_key(variant)] = {"params": variant, "segments": segments}
+                saturated = len(segments) >= EXPLORE_RESULT_LIMIT
+                if saturated and SPLIT_SATURATED and "min_cat" not in variant and "max_cat" not in variant:
+                    logger.info(f"[{trace_id}] {variant_key(variant)} is saturated, splitting it by climb category")
+                    telemetry.saturated_variants.add(1, {"activity_type": variant.get("activity_type", "riding")})
+                    pending.extend(category_bands(variant))
+
+    return {"time_fetched": int(time.time()), "variants": results}
+
+
+def fetch_segment_detail(segment_id: int, tokens: StravaTokenPool, trace_id: str) -> Dict[str, Any]:
+    """Fetches the detailed representation of one segment: effort and athlete counts,
+    total elevation gain and the full polyline the explore endpoint leaves out
+
+    Args:
+        segment_id (int): Strava segment ID
+        tokens (StravaTokenPool): Pool of Strava accounts to make requests with
+        trace_id (str): Trace ID used to correlate log lines
+
+    Returns:
+        dict: Segment response with a `time_fetched` epoch timestamp added
+    """
+    logger.debug(f"[{trace_id}] Fetching details of segment {segment_id}")
+    url = SEGMENT_URL.format(segment_id=segment_id)
+    detail = requests_get_with_retry(url, {}, trace_id, tokens, route=urlparse(SEGMENT_URL).path)
+    detail["time_fetched"] = int(time.time())
+    return detail
@@ -0,0 +1,117 @@
+"""Grid stage: splits an area into bounding boxes and loads them into Postgres"""
+
+import os
+from typing import TYPE_CHECKING, Any, Dict
+
+from segment_hunter import logging_config
+
+if TYPE_CHECKING:
+    from segment_hunter.tilegrid import TileGrid
+
+logger = logging_config.get_logger(__name__)
+
+SQL_DIR = os.path.join(os.path.dirname(__file__), "sql")
+BBOX_TABLE = "public.bounding_boxes"
+# Column order of grid CSVs, followed by status. data/bounding_boxes.csv predates hilbert.
+GRID_COLUMNS = ["sw_longitude", "sw_latitude", "ne_longitude", "ne_latitude", "hilbert"]
+
+
+def split_bbox(
+    lat_min: float,
+    lon_min: float,
+    lat_max: float,
+    lon_max: float,
+    n_lat: int,
+    n_lon: int,
+) -> "TileGrid":
+    """Splits a bounding box into n_lat*n_lon sub-boxes
+
+    Args:
+        lat_min (float): SW Latitude (bottom corner) of bounding box
+        lon_min (float): SW Longitude (bottom corner) of bounding box
+        lat_max (float): NE Latitude (top corner) of bounding box
+        lon_max (float): NE Longitude (top corner) of bounding box
+        n_lat (int): Number of rows
+        n_lon (int): Number of columns
+
+    Returns:
+        TileGrid: Pending tiles, row by row from the south west
+    """
+    from segment_hunter.tilegrid import TileGrid
+
+    return TileGrid.split(lat_min, lon_min, lat_max, lon_max, n_lat, n_lon)
+
+
+def write_grid_csv(tile_grid: "TileGrid", file_path: str) -> str:
+    """Writes tiles as a CSV of GRID_COLUMNS and status, ready for `load_grid`"""
+    tile_grid.to_csv(file_path, GRID_COLUMNS)
+    logger.info(f"Wrote {len(tile_grid)} bounding boxes ({tile_grid.nbytes} bytes in memory) to {file_path}")
+    return file_path
+
+
+def read_sql_file(name: str) -> str:
+    with open(os.path.join(SQL_DIR, name), "r") as f:
+        return f.read()
+
+
+def assign_hilbert_indexes(cur) -> int:
+    """Sets the Hilbert index of bounding boxes without one, e.g. loaded from a CSV that
+    predates it
+
+    Returns:
+        int: Number of bounding boxes updated
+    """
+    from segment_hunter.hilbert import tile_index
+
+    cur.execute(f"SELECT id, sw_latitude, sw_longitude, ne_latitude, ne_longitude FROM {BBOX_TABLE} WHERE hilbert IS NULL")
+    rows = cur.fetchall()
+    if rows:
+        cur.execute(
+            f"UPDATE {BBOX_TABLE} AS b SET hilbert = h.hilbert "
+            "FROM unnest(%s::int[], %s::bigint[]) AS h(id, hilbert) WHERE b.id = h.id",
+            ([row[0] for row in rows], [tile_index(*row[1:]) for row in rows]),
+        )
+        logger.info(f"Assigned Hilbert indexes to {len(rows)} bounding boxes")
+    return len(rows)
+
+
+def load_grid(db_params: Dict[str, Any], csv_path: str) -> bool:
+    """Creates the bounding boxes, work queue, segment details and sweep tables and loads
+    the CSV into the bounding boxes if it is empty. Bounding boxes without a Hilbert
+    index are given one, whether the CSV had none or the table predates it, and every
+    bounding box not in the work queue yet is queued.
+
+    Returns:
+        bool: True if the CSV was loaded
+    """
+    import psycopg2
+
+    from segment_hunter import workqueue
+
+    with open(csv_path, "r") as f:
+        header = f.readline().strip().split(",")
+    unknown = set(header) - {*GRID_COLUMNS, "status"}
+    if unknown:
+        raise ValueError(f"Unknown columns {sorted(unknown)} in {csv_path}, expected {GRID_COLUMNS} and status")
+    copy_sql = f"""
+    COPY {BBOX_TABLE} ({", ".join(header)})
+    FROM STDIN WITH CSV HEADER;
+    """
+
+    with psycopg2.connect(**db_params) as conn:
+        with conn.cursor() as cur:
+            workqueue.create_tables(cur)
+            cur.execute(read_sql_file("create_segment_details.sql"))
+            cur.execute(read_sql_file("create_sweeps.sql"))
+
+            cur.execute(f"SELECT COUNT(*) FROM {BBOX_TABLE}")
+            loaded = cur.fetchone()[0] == 0
+            if loaded:
+                with open(csv_path, "r") as f:
+                    cur.copy_expert(copy_sql, f)
+                logger.info(f"{csv_path} uploaded to {BBOX_TABLE}")
+            else:
+                logger.info(f"Table {BBOX_TABLE} not empty, skipping upload.")
+            assign_hilbert_indexes(cur)
+            workqueue.enqueue_new_rows(cur)
+    return loaded
@@ -0,0 +1,194 @@
+"""Process-wide logging setup
+
+`configure_logging` is idempotent and installs a single QueueHandler on the root
+logger. A QueueListener thread does the formatting and I/O, so logging on a request
+path only costs a queue put, and module loggers obtained with `get_logger` propagate
+to that one handler instead of each attaching their own.
+
+The sink is picked with LOG_FORMAT:
+
+    console  colourised, human readable lines (default on a TTY)
+    json     one JSON object per line on stdout (default otherwise). Cloud Run, Cloud
+             Functions and GKE batch these into Cloud Logging, with severity and trace
+             correlation taken from the structured fields.
+    cloud    google.cloud.logging's CloudLoggingHandler, which batches entries on its
+             own background transport
+
+Short-lived processes should call `flush_logs` before they may be frozen or stopped.
+"""
+
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+try:
+    from opentelemetry import trace
+except ImportError:  # tracing is optional for deployables that do not ship it
+    trace = None
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT") or ("console" if sys.stdout.isatty() else "json")
+GCP_PROJECT_ID = os.getenv("GCP_PROJECT_ID") or os.getenv("GOOGLE_CLOUD_PROJECT")
+
+trace_id_var = contextvars.ContextVar("trace_id", default="no-trace")
+
+_queue: Optional[queue.Queue] = None
+_listener: Optional[QueueListener] = None
+
+
+def set_trace_id(trace_id: str):
+    """Sets the trace ID logged when there is no active OpenTelemetry span"""
+    trace_id_var.set(trace_id)
+
+
+class ContextFilter(logging.Filter):
+    """Stamps records with the active trace and span IDs.
+
+    Runs on the QueueHandler, i.e. in the thread that logged the record, since the
+    listener thread does not share its context."""
+
+    def filter(self, record):
+        record.trace_id = trace_id_var.get()
+        record.span_id = ""
+        if trace is not None:
+            span_context = trace.get_current_span().get_span_context()
+            if span_context.is_valid:
+                record.trace_id = format(span_context.trace_id, "032x")
+                record.span_id = format(span_context.span_id, "016x")
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as Cloud Logging structured JSON"""
+
+    def format(self, record):
+        log_record = {
+            "timestamp": self.formatTime(record, "%Y-%m-%dT%H:%M:%SZ"),
+            "severity": record.levelname,
+            "message": record.getMessage(),
+            "logger": record.name,
+            "filename": record.filename,
+            "line": record.lineno,
+            "process": record.process,
+            "trace_id": getattr(record, "trace_id", "no-trace"),
+        }
+        span_id = getattr(record, "span_id", "")
+        if GCP_PROJECT_ID and span_id:
+            log_record["logging.googleapis.com/trace"] = f"projects/{GCP_PROJECT_ID}/traces/{log_record['trace_id']}"
+            log_record["logging.googleapis.com/spanId"] = span_id
+        if record.exc_text:
+            log_record["exception"] = record.exc_text
+        return json.dumps(log_record)
+
+
+class _PreparedQueueHandler(QueueHandler):
+    """QueueHandler that keeps the formatted traceback in exc_text instead of folding
+    it into the message, so the JSON sink can emit it as its own field"""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+def _build_handler(log_format: str) -> logging.Handler:
+    if log_format == "console":
+        try:
+            import colorlog
+        except ImportError:  # deploy images leave out local-only dependencies
+            handler = logging.StreamHandler(stream=sys.stdout)
+            handler.setFormatter(
+                logging.Formatter(
+                    "%(name)s: %(asctime)s | %(levelname)s | %(filename)s:%(lineno)s | "
+                    "%(trace_id)s | %(process)d >>> %(message)s"
+                )
+            )
+            return handler
+
+        handler = colorlog.StreamHandler(stream=sys.stdout)
+        handler.setFormatter(
+            colorlog.ColoredFormatter(
+                "%(name)s: %(white)s%(asctime)s%(reset)s | "
+                "%(log_color)s%(levelname)s%(reset)s | "
+                "%(blue)s%(filename)s:%(lineno)s%(reset)s | "
+                "%(cyan)s%(trace_id)s%(reset)s | "
+                "%(process)d >>> %(log_color)s%(message)s%(reset)s"
+            )
+        )
+        return handler
+    if log_format == "json":
+        handler = logging.StreamHandler(stream=sys.stdout)
+        handler.setFormatter(JsonFormatter())
+        return handler
+    if log_format == "cloud":
+        import google.cloud.logging
+        from google.cloud.logging_v2.handlers import CloudLoggingHandler
+
+        handler = CloudLoggingHandler(google.cloud.logging.Client())
+        handler.setFormatter(JsonFormatter())
+        return handler
+    raise ValueError(f"Unknown LOG_FORMAT '{log_format}'")
+
+
+def configure_logging(level: str = LOG_LEVEL, log_format: str = LOG_FORMAT):
+    """Installs the queue based root handler. Calls after the first are no-ops.
+
+    Args:
+        level (str): Root log level
+        log_format (str): One of console, json or cloud
+    """
+    global _queue, _listener
+
+    if _listener is not None:
+        return
+
+    _queue = queue.Queue(-1)
+    queue_handler = _PreparedQueueHandler(_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+
+    _listener = QueueListener(_queue, _build_handler(log_format), respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Returns a module logger, configuring process-wide logging on first use"""
+    configure_logging()
+    return logging.getLogger(name)
+
+
+def flush_logs():
+    """Blocks until every queued record has been handed to the sink"""
+    if _queue is None or _listener is None:
+        return
+    _queue.join()
+    for handler in _listener.handlers:
+        handler.flush()
+
+
+def shutdown_logging():
+    """Drains the queue and stops the listener thread"""
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.flush()
+            handler.close()
+        _listener = None
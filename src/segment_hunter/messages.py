@@ -0,0 +1,131 @@
+"""Binary encoding of the tile messages dispatch publishes to the explorers
+
+A message carries several tiles, DISPATCH_TILES_PER_MESSAGE by default, so the
+per-message costs of Pub/Sub (request overhead, acks, leases, function invocations) are
+paid once for all of them. The query variants and sweep are shared by the tiles of a
+message and stored once. Layout, little-endian:
+
+    header   magic b"SHT", version u8, flags u8, tile count u16, variant count u8
+    sweep    sweep_id i32, if flags & FLAG_SWEEP
+    variants per variant: activity type u8, min_cat u8, max_cat u8 (UNSET if absent)
+    tiles    per tile: id i32, Hilbert index i64, sw_latitude, sw_longitude,
+             ne_latitude, ne_longitude f64
+
+that is 44 bytes per tile against about 150 for the JSON row it replaces. Version 1 is
+the only version so far; a new field gets a new version, and `decode` keeps reading
+the old ones, so explorers can be deployed before the dispatcher.
+
+`decode` also reads the JSON objects published before this encoding, so messages
+still queued, dead-lettered or replayed keep working. Tiles are decoded to the same
+dicts either way; failures.validate_bbox_message checks them.
+"""
+
+import json
+import struct
+from typing import Any, Dict, List, Optional
+
+from segment_hunter.failures import BBOX_KEYS, PermanentError
+
+MAGIC = b"SHT"
+VERSION = 1
+FLAG_SWEEP = 1
+UNSET = 255
+# Activity types by code, the code of a type is its index
+ACTIVITY_TYPES = ("riding", "running")
+
+_HEADER = struct.Struct("<3sBBHB")
+_SWEEP = struct.Struct("<i")
+_VARIANT = struct.Struct("<BBB")
+_TILE = struct.Struct("<iq4d")
+
+
+def encode_tiles(
+    bboxes: List[Dict[str, Any]], variants: Optional[List[Dict[str, Any]]] = None, sweep_id: Optional[int] = None
+) -> bytes:
+    """Packs bounding boxes, as from TileGrid.iter_tiles, into one message
+
+    Args:
+        bboxes (list): Dicts with id, BBOX_KEYS and optionally hilbert
+        variants (list): Query variants every tile is explored with, defaults to the
+            explorer's riding-only query
+        sweep_id (int): Sweep that dispatched the tiles
+
+    Raises:
+        ValueError: If a variant has a field the encoding has no room for
+    """
+    variants = variants or []
+    parts = [_HEADER.pack(MAGIC, VERSION, FLAG_SWEEP if sweep_id is not None else 0, len(bboxes), len(variants))]
+    if sweep_id is not None:
+        parts.append(_SWEEP.pack(sweep_id))
+    for variant in variants:
+        unknown = set(variant) - {"activity_type", "min_cat", "max_cat"}
+        if unknown:
+            raise ValueError(f"Variant fields {sorted(unknown)} cannot be encoded")
+        activity_type = variant.get("activity_type")
+        parts.append(
+            _VARIANT.pack(
+                ACTIVITY_TYPES.index(activity_type) if activity_type is not None else UNSET,
+                variant.get("min_cat", UNSET),
+                variant.get("max_cat", UNSET),
+            )
+        )
+    for bbox in bboxes:
+        hilbert = bbox.get("hilbert")
+        parts.append(_TILE.pack(bbox["id"], -1 if hilbert is None else hilbert, *(bbox[key] for key in BBOX_KEYS)))
+    return b"".join(parts)
+
+
+def _decode_binary(data: bytes) -> List[Dict[str, Any]]:
+    _, version, flags, tile_count, variant_count = _HEADER.unpack_from(data)
+    if version != VERSION:
+        raise PermanentError("undecodable_message", f"Unknown tile message version {version}")
+    offset = _HEADER.size
+    extra = {}
+    if flags & FLAG_SWEEP:
+        extra["sweep_id"] = _SWEEP.unpack_from(data, offset)[0]
+        offset += _SWEEP.size
+    variants = []
+    for _ in range(variant_count):
+        activity_type, min_cat, max_cat = _VARIANT.unpack_from(data, offset)
+        offset += _VARIANT.size
+        variant = {}
+        if activity_type != UNSET:
+            variant["activity_type"] = ACTIVITY_TYPES[activity_type] if activity_type < len(ACTIVITY_TYPES) else activity_type
+        if min_cat != UNSET:
+            variant["min_cat"] = min_cat
+        if max_cat != UNSET:
+            variant["max_cat"] = max_cat
+        variants.append(variant)
+    if variants:
+        extra["variants"] = variants
+    if len(data) != offset + tile_count * _TILE.size:
+        raise PermanentError("undecodable_message", f"{len(data)} bytes for {tile_count} tiles")
+    tiles = []
+    for tile_id, hilbert, *coordinates in _TILE.iter_unpack(data[offset:]):
+        tile = {"id": tile_id, **dict(zip(BBOX_KEYS, coordinates)), **extra}
+        if hilbert >= 0:
+            tile["hilbert"] = hilbert
+        tiles.append(tile)
+    return tiles
+
+
+def decode(data: bytes) -> List[Dict[str, Any]]:
+    """Unpacks the tiles of a message, binary or legacy JSON, without validating them
+
+    Raises:
+        PermanentError: If the message is neither
+
+    Returns:
+        list: One dict per tile, with id, BBOX_KEYS, and hilbert, sweep_id and variants
+            if the message has them
+    """
+    if data[: len(MAGIC)] == MAGIC:
+        try:
+            return _decode_binary(data)
+        except struct.error as e:
+            raise PermanentError("undecodable_message", f"Truncated tile message: {e}")
+    try:
+        message_data = json.loads(data.decode("utf-8"))
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        raise PermanentError("undecodable_message", str(e))
+    return [message_data]
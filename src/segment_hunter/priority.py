@@ -0,0 +1,168 @@
+"""Priority of bounding boxes by expected segment yield
+
+Dispatch sends pending bounding boxes highest priority first, so a sweep cut short by
+the daily Strava budget has already explored the cells most segments are in. The
+priority of a cell is a linear estimate of the distinct segments it will return:
+
+    priority = PRIOR_WEIGHT * segments found in the cell by the previous sweep
+             + NEIGHBOUR_WEIGHT * mean segments found in its 8 neighbouring cells
+             + sum(weight * EXPLORE_RESULT_LIMIT * raster value scaled to [0, 1])
+
+A term a cell has no data for (never explored, no explored neighbour, outside a
+raster) takes the mean of that term over the cells that have it, so unexplored cells
+are ranked by whatever else is known about them rather than sinking to the bottom.
+
+Rasters, e.g. population or road density, are optional GeoTIFFs in EPSG:4326 sampled
+at each cell centre; reading them needs the `priority` extra (rasterio).
+"""
+
+import os
+from collections import defaultdict
+from statistics import mean, median
+from typing import Any, Dict, List, Optional, Tuple
+
+from segment_hunter import logging_config, telemetry
+from segment_hunter.fetch import EXPLORE_RESULT_LIMIT
+
+logger = logging_config.get_logger(__name__)
+
+PRIOR_WEIGHT = float(os.getenv("PRIORITY_PRIOR_WEIGHT", "0.6"))
+NEIGHBOUR_WEIGHT = float(os.getenv("PRIORITY_NEIGHBOUR_WEIGHT", "0.4"))
+
+
+def fetch_cells(db_params: Dict[str, Any], schema="public", table="bounding_boxes") -> List[Dict[str, Any]]:
+    import psycopg2
+    from psycopg2 import sql
+
+    query = sql.SQL(
+        "SELECT b.id, b.sw_latitude, b.sw_longitude, b.ne_latitude, b.ne_longitude, q.segment_count "
+        "FROM {schema}.{table} b JOIN {schema}.bbox_queue q ON q.bbox_id = b.id"
+    ).format(schema=sql.Identifier(schema), table=sql.Identifier(table))
+    with telemetry.timed(telemetry.db_duration, "db fetch_cells", operation="fetch_cells"):
+        with psycopg2.connect(**db_params) as conn:
+            with conn.cursor() as cur:
+                cur.execute(query)
+                columns = [desc[0] for desc in cur.description]
+                return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
+def grid_positions(cells: List[Dict[str, Any]]) -> Dict[int, Tuple[int, int]]:
+    """(row, column) of each cell, assuming the regular grid `segment-hunter grid` builds"""
+    height = median(cell["ne_latitude"] - cell["sw_latitude"] for cell in cells)
+    width = median(cell["ne_longitude"] - cell["sw_longitude"] for cell in cells)
+    min_lat = min(cell["sw_latitude"] for cell in cells)
+    min_lon = min(cell["sw_longitude"] for cell in cells)
+    return {
+        cell["id"]: (round((cell["sw_latitude"] - min_lat) / height), round((cell["sw_longitude"] - min_lon) / width))
+        for cell in cells
+    }
+
+
+def neighbour_means(cells: List[Dict[str, Any]]) -> Dict[int, Optional[float]]:
+    """Mean segment count of the explored cells around each cell, None if there are none"""
+    positions = grid_positions(cells)
+    counts = {positions[cell["id"]]: cell["segment_count"] for cell in cells if cell["segment_count"] is not None}
+    means = {}
+    for cell in cells:
+        row, col = positions[cell["id"]]
+        around = [
+            counts[(row + d_row, col + d_col)]
+            for d_row in (-1, 0, 1)
+            for d_col in (-1, 0, 1)
+            if (d_row or d_col) and (row + d_row, col + d_col) in counts
+        ]
+        means[cell["id"]] = mean(around) if around else None
+    return means
+
+
+def sample_raster(path: str, cells: List[Dict[str, Any]]) -> Dict[int, Optional[float]]:
+    """Raster value at each cell centre scaled by the largest value sampled, None outside
+    the raster or on nodata"""
+    import rasterio
+
+    centres = [
+        ((cell["sw_longitude"] + cell["ne_longitude"]) / 2, (cell["sw_latitude"] + cell["ne_latitude"]) / 2)
+        for cell in cells
+    ]
+    with rasterio.open(path) as raster:
+        left, bottom, right, top = raster.bounds
+        values = []
+        for (lon, lat), sample in zip(centres, raster.sample(centres, indexes=1, masked=True)):
+            inside = left <= lon <= right and bottom <= lat <= top
+            values.append(None if not inside or sample.mask.any() else float(sample[0]))
+    peak = max((value for value in values if value is not None), default=0) or 1
+    return {cell["id"]: (value / peak if value is not None else None) for cell, value in zip(cells, values)}
+
+
+def _impute(values: Dict[int, Optional[float]]) -> Dict[int, float]:
+    known = [value for value in values.values() if value is not None]
+    fill = mean(known) if known else 0.0
+    return {cell_id: (fill if value is None else value) for cell_id, value in values.items()}
+
+
+def score_cells(
+    cells: List[Dict[str, Any]],
+    rasters: Optional[List[Tuple[str, float]]] = None,
+    prior_weight: float = PRIOR_WEIGHT,
+    neighbour_weight: float = NEIGHBOUR_WEIGHT,
+) -> Dict[int, float]:
+    """Expected segment yield of each cell
+
+    Args:
+        cells (list): Rows with id, bounds and the previous sweep's segment_count
+        rasters (list): (GeoTIFF path, weight) pairs
+        prior_weight (float): Weight of the cell's own previous result
+        neighbour_weight (float): Weight of its neighbours' previous results
+
+    Returns:
+        dict: Priority per cell id
+    """
+    if not cells:
+        return {}
+    terms = [
+        (prior_weight, _impute({cell["id"]: cell["segment_count"] for cell in cells})),
+        (neighbour_weight, _impute(neighbour_means(cells))),
+    ]
+    for path, weight in rasters or []:
+        logger.info(f"Sampling raster {path} with weight {weight}")
+        scaled = {cell_id: EXPLORE_RESULT_LIMIT * value for cell_id, value in _impute(sample_raster(path, cells)).items()}
+        terms.append((weight, scaled))
+
+    return {cell["id"]: sum(weight * values[cell["id"]] for weight, values in terms) for cell in cells}
+
+
+def write_priorities(db_params: Dict[str, Any], priorities: Dict[int, float], schema="public"):
+    """Sets the dispatch priority of bounding boxes in the work queue"""
+    import psycopg2
+    from psycopg2 import sql
+
+    query = sql.SQL(
+        "UPDATE {schema}.bbox_queue AS q SET priority = p.priority "
+        "FROM unnest(%s::int[], %s::float8[]) AS p(id, priority) WHERE q.bbox_id = p.id"
+    ).format(schema=sql.Identifier(schema))
+    with telemetry.timed(telemetry.db_duration, "db write_priorities", operation="write_priorities"):
+        with psycopg2.connect(**db_params) as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, (list(priorities), list(priorities.values())))
+                conn.commit()
+
+
+def prioritise(db_params: Dict[str, Any], rasters: Optional[List[Tuple[str, float]]] = None) -> Dict[int, float]:
+    """Scores every bounding box and stores its priority for dispatch
+
+    Returns:
+        dict: Priority per bounding box id
+    """
+    cells = fetch_cells(db_params)
+    priorities = score_cells(cells, rasters)
+    write_priorities(db_params, priorities)
+
+    explored = sum(cell["segment_count"] is not None for cell in cells)
+    histogram = defaultdict(int)
+    for value in priorities.values():
+        histogram[min(int(value), 2 * EXPLORE_RESULT_LIMIT)] += 1
+    logger.info(
+        f"Scored {len(cells)} bounding boxes ({explored} with a previous result), "
+        f"expected segments: {sum(priorities.values()):.0f}, cells per expected yield: {dict(sorted(histogram.items()))}"
+    )
+    return priorities
@@ -0,0 +1,184 @@
+"""Opt-in profiling of explorer and converter invocations
+
+A slow invocation in production can be profiled without redeploying. Set PROFILE=1 on
+the function, or PROFILE_SAMPLE_RATE to profile a fraction of invocations, or publish a
+message with the attribute profile=1 to profile only that one:
+
+    gcloud pubsub topics publish <topic> --message '{...}' --attribute profile=1
+
+`profiled` wraps the handler in a sampling profiler, pyinstrument when installed (the
+`profile` extra), else cProfile, and traces allocations with tracemalloc. When the
+block exits, even by raising, the report is uploaded to the stage's blob store under
+PROFILE_PREFIX/<stage>/, named after the time and the trace ID so it can be matched
+with the trace and log lines of the invocation:
+
+    <stamp>__<trace_id>.html            pyinstrument call tree, open in a browser
+    <stamp>__<trace_id>.prof            cProfile stats, for snakeviz or pstats
+    <stamp>__<trace_id>.txt             cProfile stats by cumulative time
+    <stamp>__<trace_id>.allocations.txt top PROFILE_TOP_ALLOCATIONS allocation sites
+
+Profiling slows the invocation down, tracemalloc noticeably so, and only the calling
+thread is sampled by cProfile.
+"""
+
+import cProfile
+import importlib.util
+import io
+import marshal
+import os
+import pstats
+import random
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+from segment_hunter import logging_config, telemetry
+from segment_hunter.blobstore import BlobStore
+
+logger = logging_config.get_logger(__name__)
+
+PROFILE = os.getenv("PROFILE", "").lower() in ("1", "true", "yes")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# pyinstrument or cprofile, defaults to pyinstrument when it is installed
+PROFILER = os.getenv("PROFILER", "")
+PROFILE_INTERVAL_SECONDS = float(os.getenv("PROFILE_INTERVAL_SECONDS", "0.001"))
+PROFILE_TOP_ALLOCATIONS = int(os.getenv("PROFILE_TOP_ALLOCATIONS", "50"))
+TRACEMALLOC_FRAMES = int(os.getenv("TRACEMALLOC_FRAMES", "10"))
+PROFILE_PREFIX = "profiles"
+PROFILE_ATTRIBUTE = "profile"
+
+
+def requested(attributes: Optional[Dict[str, str]] = None) -> bool:
+    """Whether to profile this invocation: PROFILE is set, the message asks for it with
+    the profile attribute, or it is sampled at PROFILE_SAMPLE_RATE"""
+    if PROFILE:
+        return True
+    if str((attributes or {}).get(PROFILE_ATTRIBUTE, "")).lower() in ("1", "true", "yes"):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+class Profile:
+    """Sampling profiler and allocation tracer around one invocation"""
+
+    def __init__(self, profiler: str = PROFILER):
+        self.profiler = profiler or ("pyinstrument" if _has_pyinstrument() else "cprofile")
+        self._profiler = None
+        self._started_tracemalloc = False
+        self.snapshot: Optional[tracemalloc.Snapshot] = None
+        self.peak_bytes = 0
+        self.wall_seconds = 0.0
+        self._start = 0.0
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self._started_tracemalloc = True
+        tracemalloc.reset_peak()
+        if self.profiler == "pyinstrument":
+            from pyinstrument import Profiler
+
+            self._profiler = Profiler(interval=PROFILE_INTERVAL_SECONDS)
+        else:
+            self._profiler = cProfile.Profile()
+        self._start = time.perf_counter()
+        if isinstance(self._profiler, cProfile.Profile):
+            self._profiler.enable()
+        else:
+            self._profiler.start()
+
+    def stop(self):
+        if isinstance(self._profiler, cProfile.Profile):
+            self._profiler.disable()
+        else:
+            self._profiler.stop()
+        self.wall_seconds = time.perf_counter() - self._start
+        self.snapshot = tracemalloc.take_snapshot()
+        self.peak_bytes = tracemalloc.get_traced_memory()[1]
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+
+    def reports(self) -> Dict[str, bytes]:
+        """Report contents per file suffix"""
+        reports = {}
+        if isinstance(self._profiler, cProfile.Profile):
+            # What Profile.dump_stats writes, without a temporary file
+            self._profiler.create_stats()
+            reports[".prof"] = marshal.dumps(self._profiler.stats)
+            text = io.StringIO()
+            pstats.Stats(self._profiler, stream=text).sort_stats("cumulative").print_stats(PROFILE_TOP_ALLOCATIONS)
+            reports[".txt"] = text.getvalue().encode("utf-8")
+        else:
+            reports[".html"] = self._profiler.output_html().encode("utf-8")
+        reports[".allocations.txt"] = self.allocations().encode("utf-8")
+        return reports
+
+    def allocations(self) -> str:
+        """Top allocation sites still held when profiling stopped, and the peak"""
+        statistics = self.snapshot.statistics("lineno")
+        lines = [
+            f"Wall time {self.wall_seconds:.3f}s, peak traced memory {self.peak_bytes / 1024:.1f} KiB, "
+            f"{sum(stat.size for stat in statistics) / 1024:.1f} KiB held at the end",
+            "",
+        ]
+        for stat in statistics[:PROFILE_TOP_ALLOCATIONS]:
+            frame = stat.traceback[0]
+            lines.append(f"{stat.size / 1024:10.1f} KiB {stat.count:8d} blocks  {frame.filename}:{frame.lineno}")
+        return "\n".join(lines) + "\n"
+
+
+def _has_pyinstrument() -> bool:
+    return importlib.util.find_spec("pyinstrument") is not None
+
+
+def upload_reports(profile: Profile, blobs: BlobStore, stage: str, trace_id: str) -> Dict[str, str]:
+    """Uploads the reports of a profile under PROFILE_PREFIX/<stage>/
+
+    Returns:
+        dict: Blob name per file suffix
+    """
+    stamp = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    uploaded = {}
+    for suffix, data in profile.reports().items():
+        blob_name = f"{PROFILE_PREFIX}/{stage}/{stamp}__{trace_id}{suffix}"
+        content_type = "text/html" if suffix == ".html" else "application/octet-stream" if suffix == ".prof" else "text/plain"
+        blobs.write_bytes(blob_name, data, content_type)
+        uploaded[suffix] = blob_name
+    return uploaded
+
+
+@contextmanager
+def profiled(stage: str, blobs: BlobStore, enabled: bool, trace_id: Optional[str] = None) -> Iterator[Optional[Profile]]:
+    """Profiles the block if `enabled` and uploads the reports to `blobs` afterwards
+
+    Failing to profile or upload is logged and never fails the invocation.
+
+    Args:
+        stage (str): explorer or converter, the folder under PROFILE_PREFIX
+        blobs (BlobStore): Store the stage writes its output to
+        enabled (bool): Usually `requested(attributes)`
+        trace_id (str): Trace of the invocation, defaults to the active span's
+    """
+    if not enabled:
+        yield None
+        return
+    profile = Profile()
+    try:
+        profile.start()
+    except Exception as e:
+        if profile._started_tracemalloc:
+            tracemalloc.stop()
+        logger.warning(f"Profiling with {profile.profiler} could not start: {e}")
+        yield None
+        return
+    trace_id = trace_id or telemetry.current_trace_id()
+    try:
+        yield profile
+    finally:
+        try:
+            profile.stop()
+            uploaded = upload_reports(profile, blobs, stage, trace_id)
+            logger.info(f"[{trace_id}] Profiled {stage} in {profile.wall_seconds:.3f}s, reports in {blobs.url}: {uploaded}")
+        except Exception as e:
+            logger.warning(f"[{trace_id}] Profile of {stage} could not be uploaded: {e}")
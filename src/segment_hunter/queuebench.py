@@ -0,0 +1,276 @@
+"""Benchmarks the bounding box work queue under concurrent claim/complete cycles
+
+Builds a throwaway copy of the bounding boxes and the work queue in its own schema of
+a Postgres database, with the DDL and statements of `workqueue`, fills it with
+`--rows` pending bounding boxes, then runs `--workers` threads for `--seconds`, each on
+its own connection, looping:
+
+    claim     claim_rows of `--batch` bounding boxes, committed
+    complete  complete_rows of those boxes as fetched with a segment count, committed
+
+One worker in ten fails its boxes instead of fetching them, and every tenth cycle
+of a worker releases its claim rather than completing it, as dispatch does with
+unsent messages. Reported:
+
+    latency   p50, p95, p99 and max milliseconds per statement and commit
+    rate      bounding boxes claimed and completed per second across workers
+    updates   row updates of bbox_queue, and the share that were HOT
+    sizes     bbox_queue, its pending index and its primary key, after the run
+
+The schema is dropped afterwards unless `--keep` is given. Point `--dsn` at a local or
+disposable database, never at production: the benchmark only writes to its schema but
+loads the server.
+
+Usage:
+    segment-hunter bench-queue --dsn "dbname=postgres"
+    segment-hunter bench-queue --rows 5000000 --workers 16 --batch 1 --json
+"""
+
+import json
+import os
+import statistics
+import threading
+import time
+from typing import Any, Dict, List
+
+from segment_hunter import logging_config, workqueue
+
+logger = logging_config.get_logger(__name__)
+
+QUEUE_BENCH_DSN = os.getenv("QUEUE_BENCH_DSN", "dbname=postgres")
+QUEUE_BENCH_SCHEMA = "queue_bench"
+OPERATIONS = ("claim", "complete", "release")
+
+_results_lock = threading.Lock()
+
+
+def populate(conn, schema: str, rows: int):
+    """Creates the schema and tables and queues `rows` bounding boxes of a 1000 column
+    grid with random priorities"""
+    from psycopg2 import sql
+
+    with conn.cursor() as cur:
+        cur.execute(
+            sql.SQL("DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema}").format(schema=sql.Identifier(schema))
+        )
+        workqueue.create_tables(cur, schema)
+        # The id stands in for the Hilbert index, only its order matters here
+        cur.execute(
+            sql.SQL(
+                """
+                INSERT INTO {schema}.bounding_boxes
+                    (id, sw_latitude, sw_longitude, ne_latitude, ne_longitude, status, hilbert)
+                SELECT i, 51 + (i / 1000) * 0.001, -1 + mod(i, 1000) * 0.001,
+                       51.001 + (i / 1000) * 0.001, -0.999 + mod(i, 1000) * 0.001, 'pending', i
+                FROM generate_series(1, %s) AS i
+                """
+            ).format(schema=sql.Identifier(schema)),
+            (rows,),
+        )
+        workqueue.enqueue_new_rows(cur, schema)
+        cur.execute(sql.SQL("UPDATE {schema}.bbox_queue SET priority = random() * 50").format(schema=sql.Identifier(schema)))
+    conn.commit()
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        for table in ("bounding_boxes", "bbox_queue"):
+            cur.execute(
+                sql.SQL("VACUUM ANALYZE {schema}.{table}").format(schema=sql.Identifier(schema), table=sql.Identifier(table))
+            )
+    conn.autocommit = False
+
+
+def run_worker(
+    dsn: str,
+    schema: str,
+    batch: int,
+    deadline: float,
+    fail: bool,
+    latencies: Dict[str, List[float]],
+    counts: Dict[str, int],
+):
+    """Claims and completes bounding boxes until `deadline` or the queue is empty,
+    recording the latency of each operation in milliseconds"""
+    import psycopg2
+
+    local = {operation: [] for operation in OPERATIONS}
+    claimed = completed = 0
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            cycle = 0
+            while time.monotonic() < deadline:
+                cycle += 1
+                start = time.perf_counter()
+                tiles = workqueue.claim_rows(cur, batch, schema)
+                conn.commit()
+                local["claim"].append((time.perf_counter() - start) * 1000)
+                if not len(tiles):
+                    break
+                ids = tiles.tiles["id"].tolist()
+                claimed += len(ids)
+
+                start = time.perf_counter()
+                if cycle % 10 == 0:
+                    workqueue.release_rows(cur, ids, schema)
+                    operation = "release"
+                elif fail:
+                    workqueue.complete_rows(cur, ids, "failed", reason="http_404", schema=schema)
+                    operation = "complete"
+                else:
+                    workqueue.complete_rows(cur, ids, "fetched", [cycle % 100] * len(ids), schema=schema)
+                    operation = "complete"
+                conn.commit()
+                local[operation].append((time.perf_counter() - start) * 1000)
+                if operation == "complete":
+                    completed += len(ids)
+            # Statistics are flushed at most once a second, flush them for the report
+            try:
+                cur.execute("SELECT pg_stat_force_next_flush()")
+                conn.commit()
+            except psycopg2.Error:
+                conn.rollback()
+    finally:
+        conn.close()
+    with _results_lock:
+        for operation, values in local.items():
+            latencies[operation].extend(values)
+        counts["claimed"] += claimed
+        counts["completed"] += completed
+
+
+def table_stats(conn, schema: str) -> Dict[str, Any]:
+    """Updates, HOT updates and relation sizes of bbox_queue"""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT n_tup_upd, n_tup_hot_upd, n_dead_tup,
+                   pg_relation_size(relid), pg_relation_size(%s::regclass), pg_relation_size(%s::regclass)
+            FROM pg_stat_user_tables WHERE schemaname = %s AND relname = 'bbox_queue'
+            """,
+            (f'"{schema}".bbox_queue_pending_idx', f'"{schema}".bbox_queue_pkey', schema),
+        )
+        updates, hot, dead, table_bytes, pending_bytes, pkey_bytes = cur.fetchone()
+    conn.commit()
+    return {
+        "updates": updates,
+        "hot_updates": hot,
+        "dead_rows": dead,
+        "table_bytes": table_bytes,
+        "pending_index_bytes": pending_bytes,
+        "pkey_bytes": pkey_bytes,
+    }
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def bench_queue(
+    dsn: str = QUEUE_BENCH_DSN,
+    rows: int = 1_000_000,
+    workers: int = 8,
+    seconds: float = 30.0,
+    batch: int = 10,
+    schema: str = QUEUE_BENCH_SCHEMA,
+    keep: bool = False,
+) -> Dict[str, Any]:
+    """Populates a queue of `rows` bounding boxes and runs `workers` claim/complete loops
+    on it for `seconds`
+
+    Returns:
+        dict: Settings, latency percentiles per operation, rates and table statistics
+    """
+    import psycopg2
+    from psycopg2 import sql
+
+    conn = psycopg2.connect(dsn)
+    try:
+        start = time.perf_counter()
+        populate(conn, schema, rows)
+        logger.info(f"Queued {rows} bounding boxes in schema {schema} in {time.perf_counter() - start:.1f}s")
+        before = table_stats(conn, schema)
+
+        latencies = {operation: [] for operation in OPERATIONS}
+        counts = {"claimed": 0, "completed": 0}
+        deadline = time.monotonic() + seconds
+        threads = [
+            threading.Thread(target=run_worker, args=(dsn, schema, batch, deadline, i % 10 == 9, latencies, counts))
+            for i in range(workers)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        after = table_stats(conn, schema)
+    finally:
+        if not keep:
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL("DROP SCHEMA IF EXISTS {schema} CASCADE").format(schema=sql.Identifier(schema)))
+            conn.commit()
+        conn.close()
+
+    updates = after["updates"] - before["updates"]
+    hot = after["hot_updates"] - before["hot_updates"]
+    return {
+        "rows": rows,
+        "workers": workers,
+        "batch": batch,
+        "seconds": round(elapsed, 1),
+        "latency_ms": {
+            operation: {
+                "count": len(values),
+                "p50": round(statistics.median(values), 3),
+                "p95": round(percentile(values, 0.95), 3),
+                "p99": round(percentile(values, 0.99), 3),
+                "max": round(max(values), 3),
+            }
+            for operation, values in latencies.items()
+            if values
+        },
+        "claimed_per_second": round(counts["claimed"] / elapsed, 1),
+        "completed_per_second": round(counts["completed"] / elapsed, 1),
+        "updates": updates,
+        "hot_share": round(hot / updates, 3) if updates else 0.0,
+        "sizes_bytes": {key: after[key] for key in ("table_bytes", "pending_index_bytes", "pkey_bytes")},
+    }
+
+
+def print_report(result: Dict[str, Any]):
+    print(
+        f"{result['rows']} bounding boxes, {result['workers']} workers, batches of {result['batch']}, "
+        f"{result['seconds']}s"
+    )
+    for operation, stats in result["latency_ms"].items():
+        print(
+            f"    {operation:<9} {stats['count']:>8} ops  p50 {stats['p50']:>7.3f} ms  p95 {stats['p95']:>7.3f} ms  "
+            f"p99 {stats['p99']:>7.3f} ms  max {stats['max']:>8.3f} ms"
+        )
+    print(f"    {result['claimed_per_second']} claimed/s, {result['completed_per_second']} completed/s")
+    print(f"    {result['updates']} row updates, {result['hot_share']:.1%} HOT")
+    print("    " + ", ".join(f"{key} {value / 1024 / 1024:.1f} MiB" for key, value in result["sizes_bytes"].items()))
+
+
+def run(
+    dsn: str = QUEUE_BENCH_DSN,
+    rows: int = 1_000_000,
+    workers: int = 8,
+    seconds: float = 30.0,
+    batch: int = 10,
+    schema: str = QUEUE_BENCH_SCHEMA,
+    keep: bool = False,
+    as_json: bool = False,
+) -> int:
+    """Runs `bench_queue` and prints the results
+
+    Returns:
+        int: Process exit code
+    """
+    result = bench_queue(dsn, rows, workers, seconds, batch, schema, keep)
+    if as_json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+    return 0
@@ -0,0 +1,108 @@
+"""Inspects and replays messages from the segment explorer dead-letter topic
+
+Usage:
+    segment-hunter replay-dlq                      # list dead letters
+    segment-hunter replay-dlq --replay             # replay all of them
+    segment-hunter replay-dlq --replay --reason http_404 --limit 100
+"""
+
+from collections import Counter
+from typing import Any, Dict, Optional
+
+from segment_hunter import failures, logging_config
+from segment_hunter.config import ENV
+from segment_hunter.store import update_bounding_boxes_status
+
+logger = logging_config.get_logger(__name__)
+
+PULL_BATCH_SIZE = 100
+
+
+def replay_dead_letters(
+    config: Dict[str, Any],
+    replay: bool = False,
+    reason: Optional[str] = None,
+    limit: Optional[int] = None,
+) -> Counter:
+    """Drains the dead-letter subscription, optionally republishing messages to the explorer topic
+
+    Replayed messages have the bounding box of every tile reset to `pending` and are acknowledged on
+    the dead-letter subscription. Messages that are only listed, or filtered out by
+    `reason`, stay leased until the end of the run and are then nacked so they remain
+    in the dead-letter subscription.
+
+    Args:
+        config (dict): Output of config.load_config
+        replay (bool): Republish matching messages instead of only listing them
+        reason (str): Only consider messages dead-lettered with this failure reason
+        limit (int): Maximum number of messages to consider
+
+    Returns:
+        Counter: Number of dead letters seen per failure reason
+    """
+    from google.cloud import pubsub_v1
+
+    gcp_project_id = config["gcp_project_id"]
+    tf_outputs = config["tf_outputs"]
+
+    subscriber = pubsub_v1.SubscriberClient()
+    publisher = pubsub_v1.PublisherClient()
+    subscription_path = subscriber.subscription_path(gcp_project_id, tf_outputs["pubsub_dlq_sub"]["value"])
+    topic_path = publisher.topic_path(gcp_project_id, tf_outputs["pubsub_topic_path"]["value"])
+
+    reasons = Counter()
+    seen = 0
+    skip_ids = []
+    with subscriber:
+        while limit is None or seen < limit:
+            max_messages = PULL_BATCH_SIZE if limit is None else min(PULL_BATCH_SIZE, limit - seen)
+            response = subscriber.pull(
+                request={"subscription": subscription_path, "max_messages": max_messages},
+                timeout=30,
+            )
+            if not response.received_messages:
+                break
+
+            ack_ids = []
+            for received in response.received_messages:
+                seen += 1
+                message = received.message
+                # Messages forwarded by the subscription's own dead letter policy carry no reason
+                failure_reason = message.attributes.get("failure_reason", "max_delivery_attempts")
+                bbox_ids = failures.extract_bbox_ids(message.data)
+                bbox_id = bbox_ids[0] if bbox_ids else None
+                reasons[failure_reason] += 1
+                logger.info(
+                    f"[{bbox_id}] Dead letter {message.message_id}: {failure_reason} "
+                    f"{message.attributes.get('failure_detail', '')}"
+                )
+
+                if not replay or (reason and failure_reason != reason):
+                    skip_ids.append(received.ack_id)
+                    continue
+
+                attributes = {
+                    k: v for k, v in message.attributes.items() if not k.startswith("failure_")
+                }
+                attributes.update({"env": ENV, "replayed_from": message.message_id})
+                publisher.publish(topic_path, message.data, **attributes).result()
+                if bbox_ids:
+                    update_bounding_boxes_status(config["db_params"], bbox_ids, "pending")
+                ack_ids.append(received.ack_id)
+                logger.info(f"[{bbox_id}] Replayed dead letter {message.message_id} of {len(bbox_ids)} tiles")
+
+            if ack_ids:
+                subscriber.acknowledge(request={"subscription": subscription_path, "ack_ids": ack_ids})
+
+        for i in range(0, len(skip_ids), PULL_BATCH_SIZE):
+            subscriber.modify_ack_deadline(
+                request={
+                    "subscription": subscription_path,
+                    "ack_ids": skip_ids[i : i + PULL_BATCH_SIZE],
+                    "ack_deadline_seconds": 0,
+                }
+            )
+
+    logger.info(f"Dead letters by reason: {dict(reasons)}")
+    return reasons
+
@@ -0,0 +1,301 @@
+"""Adaptive concurrency limits, circuit breakers and backoff for outbound calls
+
+Every call to a dependency (strava, gcs, postgres, pubsub) goes through its shared
+`Dependency`, so the workers of a process back off together instead of retrying in
+lockstep:
+
+    with resilience.dependency("strava").call() as call:
+        response = requests.get(...)
+        if response.status_code == 429:
+            call.throttled()
+
+- `AdaptiveLimiter` caps the calls in flight with AIMD: the limit grows by one per
+  limit's worth of calls answered faster than the latency target, and is cut by
+  DECREASE_FACTOR when a call fails, is throttled or is slow, at most once per latency
+  target so one burst of errors counts once. Throughput settles just under what the
+  dependency sustains; callers above the limit wait their turn.
+- `CircuitBreaker` opens after FAILURE_THRESHOLD consecutive failures and sheds calls
+  with failures.CircuitOpenError, so messages are nacked without touching the
+  dependency. After the open period one probe call is let through, which closes the
+  breaker, or reopens it for twice as long, up to MAX_OPEN_SECONDS.
+- `backoff_delay` spreads retries with full jitter and honours Retry-After.
+
+Limits are per dependency and per process; the dependencies' own quotas (the Strava
+token pool, Pub/Sub flow control) still apply on top.
+"""
+
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Iterator, Optional
+
+from segment_hunter import failures, logging_config, telemetry
+
+logger = logging_config.get_logger(__name__)
+
+DECREASE_FACTOR = float(os.getenv("AIMD_DECREASE_FACTOR", "0.7"))
+FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+MAX_OPEN_SECONDS = float(os.getenv("CIRCUIT_MAX_OPEN_SECONDS", "600"))
+# Initial and maximum calls in flight, and the latency above which a call counts as slow
+DEPENDENCY_LIMITS = {
+    "strava": {"initial": 8, "maximum": 32, "latency_target": 3.0},
+    "gcs": {"initial": 16, "maximum": 64, "latency_target": 5.0},
+    "postgres": {"initial": 8, "maximum": 20, "latency_target": 1.0},
+    "pubsub": {"initial": 16, "maximum": 64, "latency_target": 2.0},
+}
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, either delay-seconds or an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(
+    attempt: int, base: float = 1.0, factor: float = 2.0, cap: float = 300.0, retry_after: Optional[float] = None
+) -> float:
+    """Full jitter backoff: a uniform delay up to base * factor ** (attempt - 1), capped
+
+    Args:
+        attempt (int): Attempt that just failed, from 1
+        base (float): Upper bound of the first delay
+        factor (float): Growth of the upper bound per attempt
+        cap (float): Largest upper bound
+        retry_after (float): Delay asked for by the dependency, which is waited at
+            least, up to `cap`, plus a jitter of up to `base`
+
+    Returns:
+        float: Seconds to sleep before the next attempt
+    """
+    delay = random.uniform(0, min(cap, base * factor ** (attempt - 1)))
+    if retry_after is not None:
+        delay = max(delay, min(cap, retry_after) + random.uniform(0, base))
+    return delay
+
+
+class AdaptiveLimiter:
+    """AIMD limit on the calls in flight to one dependency
+
+    Args:
+        name (str): Dependency name, for logs and metrics
+        initial (int): Starting limit
+        maximum (int): Largest limit
+        latency_target (float): Latency in seconds above which a call counts as slow
+        minimum (int): Smallest limit, one keeps probing a struggling dependency
+    """
+
+    def __init__(self, name: str, initial: int, maximum: int, latency_target: float, minimum: int = 1):
+        self.name = name
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.latency_target = latency_target
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        telemetry.concurrency_limit.add(int(self.limit), {"dependency": name})
+
+    def acquire(self):
+        """Waits for a free slot under the current limit"""
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    def release(self, latency: float, overloaded: bool):
+        """Frees a slot and adapts the limit to how the call went
+
+        Args:
+            latency (float): Seconds the call took
+            overloaded (bool): The call failed or was throttled by the dependency
+        """
+        with self._condition:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            before = int(self.limit)
+            now = time.monotonic()
+            if overloaded or latency > self.latency_target:
+                if now - self._last_decrease >= self.latency_target:
+                    self.limit = max(self.minimum, self.limit * DECREASE_FACTOR)
+                    self._last_decrease = now
+            elif saturated:
+                # Only grow a limit that is actually holding callers back
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            if int(self.limit) != before:
+                telemetry.concurrency_limit.add(int(self.limit) - before, {"dependency": self.name})
+                logger.debug(f"{self.name} concurrency limit {before} -> {int(self.limit)}")
+            self._condition.notify_all()
+
+
+class CircuitBreaker:
+    """Sheds calls to a dependency that keeps failing
+
+    Args:
+        name (str): Dependency name, for logs and metrics
+        failure_threshold (int): Consecutive failures that open the breaker
+        open_seconds (float): First open period, doubled each time a probe fails
+        max_open_seconds (float): Longest open period
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = FAILURE_THRESHOLD,
+        open_seconds: float = OPEN_SECONDS,
+        max_open_seconds: float = MAX_OPEN_SECONDS,
+    ):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self._current_open_seconds = open_seconds
+        self._open_until = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _transition(self, state: str):
+        if state != self.state:
+            logger.warning(f"{self.name} circuit {self.state} -> {state}")
+            telemetry.circuit_transitions.add(1, {"dependency": self.name, "state": state})
+            self.state = state
+
+    def retry_after(self) -> float:
+        """Seconds until the breaker lets a call through, 0 unless it is open"""
+        with self._lock:
+            return max(0.0, self._open_until - time.monotonic()) if self.state == OPEN else 0.0
+
+    def before_call(self):
+        """Raises failures.CircuitOpenError if the call must be shed"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN and now >= self._open_until:
+                self._transition(HALF_OPEN)
+                self._probing = False
+            if self.state == OPEN or (self.state == HALF_OPEN and self._probing):
+                telemetry.calls_shed.add(1, {"dependency": self.name})
+                raise failures.CircuitOpenError(self.name, max(0.0, self._open_until - now) or self._current_open_seconds)
+            if self.state == HALF_OPEN:
+                self._probing = True
+
+    def on_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            self._current_open_seconds = self.open_seconds
+            self._transition(CLOSED)
+
+    def on_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                self._current_open_seconds = min(self.max_open_seconds, self._current_open_seconds * 2)
+            elif self.failures < self.failure_threshold:
+                return
+            self._probing = False
+            self._open_until = time.monotonic() + self._current_open_seconds
+            self._transition(OPEN)
+
+
+class Call:
+    """Outcome of one call, for responses that do not raise but still signal trouble"""
+
+    def __init__(self):
+        self.failed = None
+        self.overloaded = False
+
+    def failure(self):
+        """The dependency failed, e.g. an HTTP 5xx: counts towards opening the breaker"""
+        self.failed = True
+        self.overloaded = True
+
+    def throttled(self):
+        """The dependency asked to slow down, e.g. an HTTP 429: only lowers the limit"""
+        self.overloaded = True
+
+    def success(self):
+        """The dependency answered, even if the exception raised in the block says otherwise,
+        e.g. an HTTP 404"""
+        self.failed = False
+
+
+class Dependency:
+    """Adaptive limiter and circuit breaker guarding the calls to one dependency"""
+
+    def __init__(self, name: str, limiter: AdaptiveLimiter, breaker: CircuitBreaker):
+        self.name = name
+        self.limiter = limiter
+        self.breaker = breaker
+
+    @contextmanager
+    def call(self) -> Iterator[Call]:
+        """Guards one call: sheds it while the breaker is open, waits for a slot under the
+        limit, then feeds the latency and outcome back. An exception raised in the block
+        counts as a failure unless `Call.success` was called."""
+        self.breaker.before_call()
+        self.limiter.acquire()
+        call = Call()
+        start = time.perf_counter()
+        try:
+            yield call
+        except Exception:
+            if call.failed is None:
+                call.failure()
+            raise
+        finally:
+            self.limiter.release(time.perf_counter() - start, call.overloaded)
+            if call.failed:
+                self.breaker.on_failure()
+            else:
+                self.breaker.on_success()
+
+
+_dependencies: Dict[str, Dependency] = {}
+_dependencies_lock = threading.Lock()
+
+
+def dependency(name: str) -> Dependency:
+    """The process-wide guard of a dependency, with the limits of DEPENDENCY_LIMITS
+    unless <NAME>_MAX_CONCURRENCY or <NAME>_LATENCY_TARGET are set"""
+    with _dependencies_lock:
+        guard = _dependencies.get(name)
+        if guard is None:
+            limits = DEPENDENCY_LIMITS.get(name, {"initial": 8, "maximum": 32, "latency_target": 5.0})
+            maximum = int(os.getenv(f"{name.upper()}_MAX_CONCURRENCY", str(limits["maximum"])))
+            latency_target = float(os.getenv(f"{name.upper()}_LATENCY_TARGET", str(limits["latency_target"])))
+            limiter = AdaptiveLimiter(name, min(limits["initial"], maximum), maximum, latency_target)
+            guard = _dependencies[name] = Dependency(name, limiter, CircuitBreaker(name))
+        return guard
+
+
+def shed_delay() -> float:
+    """Seconds until every open circuit lets a probe through, 0 if none is open"""
+    with _dependencies_lock:
+        guards = list(_dependencies.values())
+    return max((guard.breaker.retry_after() for guard in guards), default=0.0)
+
+
+def summary() -> Dict[str, Dict[str, Any]]:
+    """Current limit, calls in flight and circuit state per dependency used so far"""
+    with _dependencies_lock:
+        guards = list(_dependencies.values())
+    return {
+        guard.name: {"limit": int(guard.limiter.limit), "in_flight": guard.limiter.in_flight, "circuit": guard.breaker.state}
+        for guard in guards
+    }
@@ -0,0 +1,289 @@
+"""Segment sinks writing typed rows straight to BigQuery
+
+    bigquery://project/dataset/table  BigQueryWriteSink, Storage Write API default stream
+    memory://name                     MemorySegmentSink, a local fake for tests and benchmarks
+
+With SEGMENT_SINK_URL set, explorers append each packed batch to the sink, so segments
+are queryable seconds after they are fetched instead of after the GCS, Pub/Sub,
+json_to_ndjson and load job hops. A batch the sink rejects falls back to the NDJSON
+path, see `batcher.TileBatcher`.
+
+Rows are coerced to SEGMENT_SCHEMA, the schema of the Terraform managed segments
+table, and fields outside it are dropped.
+"""
+
+import os
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+from segment_hunter import logging_config
+
+logger = logging_config.get_logger(__name__)
+
+# Keep in sync with terraform/modules/bigquery/segments_schema.json
+SEGMENT_SCHEMA = [
+    ("id", "INT64", "REQUIRED"),
+    ("name", "STRING", "NULLABLE"),
+    ("climb_category", "INT64", "NULLABLE"),
+    ("climb_category_desc", "STRING", "NULLABLE"),
+    ("avg_grade", "FLOAT64", "NULLABLE"),
+    ("start_latlng", "FLOAT64", "REPEATED"),
+    ("end_latlng", "FLOAT64", "REPEATED"),
+    ("elev_difference", "FLOAT64", "NULLABLE"),
+    ("distance", "FLOAT64", "NULLABLE"),
+    ("points", "STRING", "NULLABLE"),
+    ("starred", "BOOL", "NULLABLE"),
+    ("time_fetched", "INT64", "NULLABLE"),
+    ("bbox_id", "INT64", "NULLABLE"),
+    ("bbox", "FLOAT64", "REPEATED"),
+    ("hilbert", "INT64", "NULLABLE"),
+    ("sweep_id", "INT64", "NULLABLE"),
+    ("variant", "STRING", "NULLABLE"),
+    ("activity_type", "STRING", "NULLABLE"),
+]
+_COERCE = {"INT64": int, "FLOAT64": float, "STRING": str, "BOOL": bool}
+# AppendRows requests are limited to 10 MB
+MAX_APPEND_BYTES = int(os.getenv("BIGQUERY_MAX_APPEND_BYTES", str(9 * 1024 * 1024)))
+
+
+def segment_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Coerces a segment row to SEGMENT_SCHEMA, dropping unknown fields and nulls
+
+    Raises:
+        ValueError: If a required field is missing or a value has the wrong type
+    """
+    typed = {}
+    for name, field_type, mode in SEGMENT_SCHEMA:
+        value = row.get(name)
+        if value is None:
+            if mode == "REQUIRED":
+                raise ValueError(f"Segment row without {name}: {row}")
+            continue
+        coerce = _COERCE[field_type]
+        typed[name] = [coerce(item) for item in value] if mode == "REPEATED" else coerce(value)
+    return typed
+
+
+class SegmentSink(ABC):
+    """Destination segment rows are appended to"""
+
+    scheme = ""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    @property
+    def url(self) -> str:
+        return f"{self.scheme}://{self.name}"
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.url!r})"
+
+    @abstractmethod
+    def append(self, rows: List[Dict[str, Any]]) -> Future:
+        """Appends rows without waiting for them to be committed
+
+        Args:
+            rows (list): Segment rows, coerced with `segment_row` by the sink
+
+        Returns:
+            Future: Resolves to the number of rows appended, or to the append error
+        """
+
+    def close(self):
+        pass
+
+
+class BigQueryWriteSink(SegmentSink):
+    """Appends rows to a table through the default stream of the Storage Write API
+
+    The default stream commits rows as soon as each append is acknowledged, at least
+    once. Rows are sent as proto2 messages built from SEGMENT_SCHEMA, in as few
+    requests as the 10 MB request limit allows, over one long-lived bidirectional
+    stream that is reopened after an error.
+    """
+
+    scheme = "bigquery"
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.project, self.dataset, self.table = name.split("/")
+        self._client = None
+        self._stream = None
+        self._row_class = None
+        self._descriptor = None
+        self._lock = threading.Lock()
+
+    def _build_row_class(self):
+        from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+        field_types = {
+            "INT64": descriptor_pb2.FieldDescriptorProto.TYPE_INT64,
+            "FLOAT64": descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE,
+            "STRING": descriptor_pb2.FieldDescriptorProto.TYPE_STRING,
+            "BOOL": descriptor_pb2.FieldDescriptorProto.TYPE_BOOL,
+        }
+        file_proto = descriptor_pb2.FileDescriptorProto(name="segment_row.proto", package="segment_hunter", syntax="proto2")
+        message = file_proto.message_type.add(name="SegmentRow")
+        for number, (name, field_type, mode) in enumerate(SEGMENT_SCHEMA, start=1):
+            message.field.add(
+                name=name,
+                number=number,
+                type=field_types[field_type],
+                label=(
+                    descriptor_pb2.FieldDescriptorProto.LABEL_REPEATED
+                    if mode == "REPEATED"
+                    else descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL
+                ),
+            )
+        pool = descriptor_pool.DescriptorPool()
+        pool.Add(file_proto)
+        descriptor = pool.FindMessageTypeByName("segment_hunter.SegmentRow")
+
+        self._descriptor = descriptor_pb2.DescriptorProto()
+        descriptor.CopyToProto(self._descriptor)
+        self._row_class = message_factory.GetMessageClass(descriptor)
+
+    def _open_stream(self):
+        from google.cloud import bigquery_storage_v1
+        from google.cloud.bigquery_storage_v1 import types, writer
+
+        if self._client is None:
+            self._client = bigquery_storage_v1.BigQueryWriteClient()
+            self._build_row_class()
+        template = types.AppendRowsRequest(
+            write_stream=f"{self._client.table_path(self.project, self.dataset, self.table)}/streams/_default",
+            proto_rows=types.AppendRowsRequest.ProtoData(
+                writer_schema=types.ProtoSchema(proto_descriptor=self._descriptor)
+            ),
+        )
+        logger.info(f"Opening Storage Write API stream to {self.project}.{self.dataset}.{self.table}")
+        return writer.AppendRowsStream(self._client, template)
+
+    def _chunks(self, rows: List[Dict[str, Any]]):
+        """Serialised rows grouped into chunks that fit in one AppendRows request"""
+        chunk, chunk_bytes = [], 0
+        for row in rows:
+            serialized = self._row_class(**segment_row(row)).SerializeToString()
+            if chunk and chunk_bytes + len(serialized) > MAX_APPEND_BYTES:
+                yield chunk
+                chunk, chunk_bytes = [], 0
+            chunk.append(serialized)
+            chunk_bytes += len(serialized)
+        if chunk:
+            yield chunk
+
+    def append(self, rows: List[Dict[str, Any]]) -> Future:
+        from google.cloud.bigquery_storage_v1 import types
+
+        result = Future()
+        if not rows:
+            result.set_result(0)
+            return result
+        try:
+            with self._lock:
+                if self._stream is None:
+                    self._stream = self._open_stream()
+                # Serialise every row before sending any, so a row failing validation
+                # rejects the whole append instead of leaving part of it committed
+                chunks = list(self._chunks(rows))
+                futures = [
+                    self._stream.send(
+                        types.AppendRowsRequest(
+                            proto_rows=types.AppendRowsRequest.ProtoData(rows=types.ProtoRows(serialized_rows=chunk))
+                        )
+                    )
+                    for chunk in chunks
+                ]
+        except Exception as e:
+            self._reset()
+            result.set_exception(e)
+            return result
+
+        pending = [len(futures)]
+        pending_lock = threading.Lock()
+
+        def on_done(future):
+            error = future.exception()
+            with pending_lock:
+                if result.done():
+                    return
+                if error is not None:
+                    self._reset()
+                    result.set_exception(error)
+                    return
+                pending[0] -= 1
+                if pending[0] == 0:
+                    result.set_result(len(rows))
+
+        for future in futures:
+            future.add_done_callback(on_done)
+        return result
+
+    def _reset(self):
+        """Drops a failed stream, the next append opens a new one"""
+        with self._lock:
+            stream, self._stream = self._stream, None
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception as e:
+                logger.warning(f"Failed to close Storage Write API stream: {e}")
+
+    def close(self):
+        self._reset()
+
+
+class MemorySegmentSink(SegmentSink):
+    """Keeps appended rows in a process-wide list per sink name
+
+    Args:
+        name (str): Sink name, sinks with the same name share their rows
+        fail_with (Exception): Error every append fails with, to exercise the fallback
+    """
+
+    scheme = "memory"
+    _sinks: Dict[str, List[Dict[str, Any]]] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, name: str = "default", fail_with: Optional[Exception] = None):
+        super().__init__(name)
+        self.fail_with = fail_with
+        with self._lock:
+            self.rows = self._sinks.setdefault(name, [])
+
+    def append(self, rows: List[Dict[str, Any]]) -> Future:
+        result = Future()
+        try:
+            if self.fail_with is not None:
+                raise self.fail_with
+            typed = [segment_row(row) for row in rows]
+        except Exception as e:
+            result.set_exception(e)
+            return result
+        with self._lock:
+            self.rows.extend(typed)
+        result.set_result(len(typed))
+        return result
+
+
+SEGMENT_SINKS = {sink.scheme: sink for sink in (BigQueryWriteSink, MemorySegmentSink)}
+
+
+@lru_cache(maxsize=None)
+def open_segment_sink(url: str) -> SegmentSink:
+    """Returns the sink for a URL
+
+    Args:
+        url (str): bigquery://project/dataset/table or memory://name
+
+    Returns:
+        SegmentSink: Sink shared by every caller asking for the same URL
+    """
+    scheme, sep, name = url.partition("://")
+    if not sep or scheme not in SEGMENT_SINKS:
+        raise ValueError(f"Unknown segment sink '{url}', expected one of {[f'{s}://' for s in SEGMENT_SINKS]}")
+    return SEGMENT_SINKS[scheme](name)
@@ -0,0 +1,34 @@
+-- Work queue of bounding boxes, split from the bounding_boxes catalogue so the updates of
+-- every claim and completion rewrite a narrow row: about 60 bytes with its header
+DO $$
+BEGIN
+    CREATE TYPE {schema}.bbox_status AS ENUM ('pending', 'dispatched', 'fetched', 'failed');
+EXCEPTION
+    WHEN duplicate_object THEN NULL;
+END
+$$;
+
+-- fillfactor 70 leaves room on each page for the new row versions of updates, which then
+-- stay on the same page. Status changes still add index entries (status is in the partial
+-- index predicates), so they are not HOT; updates of other unindexed columns are. The
+-- dead versions every claim leaves are vacuumed after 1% of the rows rather than 20%.
+CREATE TABLE IF NOT EXISTS {schema}.bbox_queue (
+    bbox_id INTEGER PRIMARY KEY REFERENCES {schema}.bounding_boxes (id) ON DELETE CASCADE,
+    status {schema}.bbox_status NOT NULL DEFAULT 'pending',
+    -- Dispatch order: expected segment yield from `segment-hunter prioritise`, highest first,
+    -- then along the Hilbert curve
+    priority REAL NOT NULL DEFAULT 0,
+    hilbert BIGINT,
+    -- Distinct segments found by the last sweep that explored the box
+    segment_count INTEGER,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    failure_reason TEXT
+) WITH (fillfactor = 70, autovacuum_vacuum_scale_factor = 0.01, autovacuum_vacuum_cost_delay = 0);
+
+-- Claims read this index in dispatch order and skip locked rows; it only holds pending
+-- rows, so it stays as small as the backlog and completions never touch it
+CREATE INDEX IF NOT EXISTS bbox_queue_pending_idx
+    ON {schema}.bbox_queue (priority DESC, hilbert, bbox_id) WHERE status = 'pending';
+-- Boxes dispatched long ago and never completed, requeued by requeue_stale
+CREATE INDEX IF NOT EXISTS bbox_queue_dispatched_idx
+    ON {schema}.bbox_queue (updated_at) WHERE status = 'dispatched';
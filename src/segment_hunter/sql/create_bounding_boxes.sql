@@ -0,0 +1,14 @@
+-- Grid catalogue: one row per bounding box, written when the grid is loaded. Queue state
+-- lives in bbox_queue, see create_bbox_queue.sql.
+CREATE TABLE IF NOT EXISTS {schema}.bounding_boxes (
+    id SERIAL PRIMARY KEY,
+    sw_latitude FLOAT,
+    sw_longitude FLOAT,
+    ne_latitude FLOAT,
+    ne_longitude FLOAT,
+    -- Initial status from the grid CSV, copied into bbox_queue when the box is queued
+    status TEXT
+);
+
+-- Position of the box centre along the Hilbert curve, see segment_hunter.hilbert
+ALTER TABLE {schema}.bounding_boxes ADD COLUMN IF NOT EXISTS hilbert BIGINT;
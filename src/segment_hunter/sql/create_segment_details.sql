@@ -0,0 +1,15 @@
+-- Segments found by the explore stage and the state of their /segments/{id} detail crawl
+CREATE TABLE IF NOT EXISTS public.segment_details (
+    id BIGINT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending',
+    first_seen TIMESTAMPTZ NOT NULL DEFAULT now(),
+    -- Last time the segment came back from an explore query, details are only refreshed while it does
+    last_seen TIMESTAMPTZ NOT NULL DEFAULT now(),
+    claimed_at TIMESTAMPTZ,
+    fetched_at TIMESTAMPTZ,
+    failure_reason TEXT
+);
+
+-- Claim order: never fetched first, then the stalest details
+CREATE INDEX IF NOT EXISTS segment_details_claim_idx
+    ON public.segment_details (fetched_at NULLS FIRST, first_seen) WHERE status <> 'failed';
@@ -0,0 +1,32 @@
+-- One row per sweep: a pass over the bounding boxes of a region
+CREATE TABLE IF NOT EXISTS public.sweeps (
+    id SERIAL PRIMARY KEY,
+    region TEXT NOT NULL,
+    -- Bounds of the region and the query variants its tiles are explored with
+    grid_params JSONB NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL DEFAULT 'running',
+    started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    finished_at TIMESTAMPTZ,
+    -- Snapshot of sweep_tiles, refreshed by `segment-hunter sweep status` and after each dispatch
+    tiles INTEGER NOT NULL DEFAULT 0,
+    tiles_fetched INTEGER NOT NULL DEFAULT 0,
+    tiles_failed INTEGER NOT NULL DEFAULT 0,
+    segments INTEGER NOT NULL DEFAULT 0,
+    api_calls INTEGER NOT NULL DEFAULT 0
+);
+
+-- Status of every tile of a sweep: pending -> dispatched -> fetched or failed
+CREATE TABLE IF NOT EXISTS public.sweep_tiles (
+    sweep_id INTEGER NOT NULL REFERENCES public.sweeps (id) ON DELETE CASCADE,
+    bbox_id INTEGER NOT NULL REFERENCES public.bounding_boxes (id),
+    status TEXT NOT NULL DEFAULT 'pending',
+    dispatched_at TIMESTAMPTZ,
+    fetched_at TIMESTAMPTZ,
+    segment_count INTEGER,
+    api_calls INTEGER,
+    failure_reason TEXT,
+    PRIMARY KEY (sweep_id, bbox_id)
+);
+
+CREATE INDEX IF NOT EXISTS sweep_tiles_open_idx
+    ON public.sweep_tiles (sweep_id, status) WHERE status IN ('pending', 'dispatched');
@@ -0,0 +1,14 @@
+-- Queues the bounding boxes not queued yet, loaded since or before the queue existed, with
+-- their status from the grid CSV, and copies Hilbert indexes assigned since
+INSERT INTO {schema}.bbox_queue (bbox_id, status, hilbert)
+SELECT b.id,
+       CASE WHEN b.status IN ('dispatched', 'fetched', 'failed') THEN b.status::{schema}.bbox_status
+            ELSE 'pending' END,
+       b.hilbert
+FROM {schema}.bounding_boxes b
+WHERE NOT EXISTS (SELECT 1 FROM {schema}.bbox_queue q WHERE q.bbox_id = b.id)
+ON CONFLICT (bbox_id) DO NOTHING;
+
+UPDATE {schema}.bbox_queue q SET hilbert = b.hilbert
+FROM {schema}.bounding_boxes b
+WHERE q.bbox_id = b.id AND q.hilbert IS NULL AND b.hilbert IS NOT NULL;
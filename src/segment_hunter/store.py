@@ -0,0 +1,131 @@
+"""Store stage: explored objects in a BlobStore and bounding box status in Postgres"""
+
+import gzip
+import json
+from contextlib import contextmanager
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional
+
+from opentelemetry.trace import SpanKind
+
+from segment_hunter import logging_config, resilience, telemetry
+from segment_hunter.blobstore import BlobStore
+
+logger = logging_config.get_logger(__name__)
+
+NDJSON_PREFIX = "explored_segments_ndjson"
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def upload_blob_from_path(blobs: BlobStore, source_file_path: str, destination_blob_name: str):
+    """Uploads a file to a blob store given a file path
+
+    Args:
+        blobs (BlobStore): Destination store
+        source_file_path (str): Path to your file
+        destination_blob_name (str): Name of the blob to save
+
+    Returns:
+        None
+    """
+    blobs.upload_file(source_file_path, destination_blob_name)
+
+
+def upload_blob_from_string(blobs: BlobStore, string_blob: str, destination_blob_name: str):
+    """Uploads a file to a blob store given a string
+
+    Args:
+        blobs (BlobStore): Destination store
+        string_blob (str): String representation of your blob
+        destination_blob_name (str): Name of the blob to save
+
+    Returns:
+        None
+    """
+    data = string_blob.encode("utf-8")
+    with telemetry.timed(telemetry.gcs_upload_duration, "gcs upload", bucket=blobs.name):
+        # Carry the trace context to whatever converts this object downstream
+        blobs.write_bytes(destination_blob_name, data, "application/json", telemetry.inject_context({}))
+    telemetry.gcs_upload_bytes.record(len(data), {"bucket": blobs.name})
+
+
+def get_blob_metadata(blobs: BlobStore, blob_name: str) -> Dict[str, str]:
+    """Returns the custom metadata of a blob, e.g. the trace context set by the explorer"""
+    return blobs.get_metadata(blob_name) or {}
+
+
+@contextmanager
+def open_decoded(blobs: BlobStore, blob_name: str) -> Iterator[BinaryIO]:
+    """Streams a blob, decompressing it on the fly when it starts with the gzip magic
+    number, as objects written by the background uploader do"""
+    with blobs.open_read(blob_name) as f:
+        is_gzip = f.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+        f.seek(0)
+        yield gzip.GzipFile(fileobj=f) if is_gzip else f
+
+
+def download_json_blob(blobs: BlobStore, source_blob_name: str) -> dict:
+    """Downloads a JSON blob, gzipped or not, and converts it to a dictionary"""
+    try:
+        with telemetry.tracer.start_as_current_span("gcs download", kind=SpanKind.CLIENT):
+            with open_decoded(blobs, source_blob_name) as f:
+                data = json.load(f)
+    except json.JSONDecodeError:
+        logger.error(f"Failed to parse JSON from blob '{source_blob_name}'")
+        raise
+    except Exception as e:
+        logger.error(f"Failed to download {source_blob_name} from {blobs.url}: {e}")
+        raise
+
+    logger.info(f"Downloaded '{source_blob_name}' from '{blobs.url}' and converted to JSON")
+    return data
+
+
+def iter_ndjson_rows(blobs: BlobStore, source_blob_name: str) -> Iterator[dict]:
+    """Streams the rows of an NDJSON blob, gzipped or not, without loading it whole"""
+    with telemetry.tracer.start_as_current_span("gcs download", kind=SpanKind.CLIENT):
+        with open_decoded(blobs, source_blob_name) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def update_bounding_box_status(db_params: Dict[str, Any], bbox_id: int, status: str = "fetched", trace_id: str = None, reason: Optional[str] = None):
+    import psycopg2
+
+    from segment_hunter import workqueue
+
+    trace_id = trace_id or telemetry.current_trace_id()
+    logger.info(f"[{trace_id}] Updating bounding box {bbox_id} status to {status}")
+    try:
+        with telemetry.timed(telemetry.db_duration, "db update_bbox_status", operation="update_bbox_status"):
+            with resilience.dependency("postgres").call(), psycopg2.connect(**db_params) as conn:
+                with conn.cursor() as cur:
+                    workqueue.complete_rows(cur, [bbox_id], status, reason=reason)
+                    conn.commit()
+        logger.info(f"[{trace_id}] Successfully updated bounding box {bbox_id}")
+    except Exception as e:
+        logger.exception(f"[{trace_id}] Failed to update bounding box {bbox_id}: {e}")
+        raise
+
+
+def update_bounding_boxes_status(
+    db_params: Dict[str, Any],
+    bbox_ids: List[int],
+    status: str = "fetched",
+    segment_counts: Optional[List[int]] = None,
+    reason: Optional[str] = None,
+):
+    """Sets the queue status of several bounding boxes in one statement, e.g. every tile of a stored batch
+
+    Args:
+        db_params (dict): psycopg2 connection parameters
+        bbox_ids (list): Bounding boxes to update
+        status (str): New status
+        segment_counts (list): Distinct segments found per bounding box, in the order of
+            `bbox_ids`, kept as the prior of the next sweep's priority
+        reason (str): Failure reason, when marking them failed
+    """
+    from segment_hunter import workqueue
+
+    workqueue.complete(db_params, bbox_ids, status, segment_counts, reason)
+    logger.info(f"Updated {len(bbox_ids)} bounding boxes to {status}")
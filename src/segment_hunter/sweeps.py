@@ -0,0 +1,283 @@
+"""Sweep ledger: resumable passes over the bounding boxes of a region
+
+A sweep is one pass over a region of the grid with a set of query variants. Starting
+one records it in `sweeps` and adds a `sweep_tiles` row per bounding box whose centre
+lies in the region, so a region can be swept again, and sweeps compared tile by tile,
+without regenerating the grid or touching the tiles of other sweeps.
+
+Tiles move from pending to dispatched to fetched or failed:
+
+- `dispatch --sweep` sends pending tiles highest priority first and checkpoints every
+  chunk of tiles by marking them dispatched, so a dispatcher that crashes resumes
+  where it stopped when run again
+- explorers mark tiles fetched, with their segment count and Strava requests, once
+  their batch is stored, or failed when their message is dead-lettered
+- tiles dispatched more than REDISPATCH_SECONDS ago and still not fetched, e.g. because
+  their message was lost, are dispatched again
+
+The counts in `sweeps` are a snapshot of its tiles, refreshed by `refresh_sweep`, which
+also closes a sweep once none of its tiles is left to fetch.
+"""
+
+import os
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+from segment_hunter import logging_config, resilience, telemetry
+from segment_hunter.grid import read_sql_file
+
+if TYPE_CHECKING:
+    from segment_hunter.tilegrid import TileGrid
+
+logger = logging_config.get_logger(__name__)
+
+REDISPATCH_SECONDS = int(os.getenv("SWEEP_REDISPATCH_SECONDS", str(6 * 3600)))
+
+
+def create_tables(db_params: Dict[str, Any]):
+    import psycopg2
+
+    with psycopg2.connect(**db_params) as conn:
+        with conn.cursor() as cur:
+            cur.execute(read_sql_file("create_sweeps.sql"))
+            conn.commit()
+
+
+def _fetch_dicts(cur) -> List[Dict[str, Any]]:
+    columns = [desc[0] for desc in cur.description]
+    return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
+def start_sweep(
+    db_params: Dict[str, Any],
+    region: str,
+    bounds: Optional[List[float]] = None,
+    variants: Optional[List[Dict[str, Any]]] = None,
+) -> int:
+    """Records a new sweep over the bounding boxes of a region
+
+    Args:
+        db_params (dict): psycopg2 connection parameters
+        region (str): Name of the region, e.g. oxford
+        bounds (list): sw_latitude, sw_longitude, ne_latitude, ne_longitude of the region,
+            defaults to the whole grid
+        variants (list): Query variants the tiles are explored with, defaults to the
+            explorer's riding-only query
+
+    Returns:
+        int: ID of the sweep
+    """
+    import psycopg2
+    from psycopg2.extras import Json
+
+    create_tables(db_params)
+    grid_params = {"bounds": bounds, "variants": variants}
+    with psycopg2.connect(**db_params) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO public.sweeps (region, grid_params) VALUES (%s, %s) RETURNING id", (region, Json(grid_params))
+            )
+            sweep_id = cur.fetchone()[0]
+            if bounds is None:
+                cur.execute(
+                    "INSERT INTO public.sweep_tiles (sweep_id, bbox_id) SELECT %s, id FROM public.bounding_boxes",
+                    (sweep_id,),
+                )
+            else:
+                sw_lat, sw_lon, ne_lat, ne_lon = bounds
+                cur.execute(
+                    """
+                    INSERT INTO public.sweep_tiles (sweep_id, bbox_id)
+                    SELECT %s, id FROM public.bounding_boxes
+                    WHERE (sw_latitude + ne_latitude) / 2 BETWEEN %s AND %s
+                      AND (sw_longitude + ne_longitude) / 2 BETWEEN %s AND %s
+                    """,
+                    (sweep_id, sw_lat, ne_lat, sw_lon, ne_lon),
+                )
+            tiles = cur.rowcount
+            cur.execute("UPDATE public.sweeps SET tiles = %s WHERE id = %s", (tiles, sweep_id))
+            conn.commit()
+    logger.info(f"Started sweep {sweep_id} of {region} over {tiles} bounding boxes")
+    return sweep_id
+
+
+def get_sweep(db_params: Dict[str, Any], sweep_id: int) -> Dict[str, Any]:
+    """The ledger row of a sweep
+
+    Raises:
+        ValueError: If there is no such sweep
+    """
+    import psycopg2
+
+    with psycopg2.connect(**db_params) as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT * FROM public.sweeps WHERE id = %s", (sweep_id,))
+            rows = _fetch_dicts(cur)
+    if not rows:
+        raise ValueError(f"No sweep {sweep_id}")
+    return rows[0]
+
+
+def list_sweeps(db_params: Dict[str, Any], region: Optional[str] = None) -> List[Dict[str, Any]]:
+    import psycopg2
+
+    with psycopg2.connect(**db_params) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT * FROM public.sweeps WHERE %s IS NULL OR region = %s ORDER BY id", (region, region)
+            )
+            return _fetch_dicts(cur)
+
+
+def fetch_sweep_tiles(db_params: Dict[str, Any], sweep_id: int, limit: Optional[int] = None) -> "TileGrid":
+    """Bounding boxes of a sweep left to dispatch, pending or dispatched too long ago,
+    highest priority first, read in chunks into a TileGrid of the sweep"""
+    import psycopg2
+
+    from segment_hunter.tilegrid import TileGrid, status_sql
+
+    query = f"""
+        SELECT b.id, b.sw_latitude, b.sw_longitude, b.ne_latitude, b.ne_longitude, {status_sql("t.status")},
+               q.priority, coalesce(q.segment_count, -1), coalesce(b.hilbert, -1)
+        FROM public.sweep_tiles t
+        JOIN public.bounding_boxes b ON b.id = t.bbox_id
+        JOIN public.bbox_queue q ON q.bbox_id = t.bbox_id
+        WHERE t.sweep_id = %s
+          AND (t.status = 'pending'
+               OR (t.status = 'dispatched' AND t.dispatched_at < now() - make_interval(secs => %s)))
+        ORDER BY q.priority DESC, b.hilbert, b.id
+        LIMIT %s
+    """
+    with telemetry.timed(telemetry.db_duration, "db fetch_sweep_tiles", operation="fetch_sweep_tiles"):
+        with psycopg2.connect(**db_params) as conn:
+            with conn.cursor(name="sweep_tiles") as cur:
+                cur.execute(query, (sweep_id, REDISPATCH_SECONDS, limit))
+                tiles = TileGrid.from_cursor(cur, sweep_id)
+    logger.info(f"Fetched {len(tiles)} bounding boxes left to dispatch in sweep {sweep_id}")
+    return tiles
+
+
+def checkpoint_dispatched(db_params: Dict[str, Any], sweep_id: int, bbox_ids: List[int]):
+    """Marks tiles dispatched, unless an explorer already marked them fetched or failed"""
+    import psycopg2
+
+    with telemetry.timed(telemetry.db_duration, "db checkpoint_dispatched", operation="checkpoint_dispatched"):
+        with psycopg2.connect(**db_params) as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE public.sweep_tiles SET status = 'dispatched', dispatched_at = now() "
+                    "WHERE sweep_id = %s AND bbox_id = ANY(%s) AND status IN ('pending', 'dispatched')",
+                    (sweep_id, list(bbox_ids)),
+                )
+                conn.commit()
+
+
+def update_sweep_tiles(
+    db_params: Dict[str, Any],
+    sweep_id: int,
+    bbox_ids: List[int],
+    status: str = "fetched",
+    segment_counts: Optional[List[int]] = None,
+    api_calls: Optional[List[int]] = None,
+    reason: Optional[str] = None,
+):
+    """Records the outcome of tiles of a sweep
+
+    Args:
+        db_params (dict): psycopg2 connection parameters
+        sweep_id (int): Sweep the tiles were dispatched by
+        bbox_ids (list): Bounding boxes of the tiles
+        status (str): fetched or failed
+        segment_counts (list): Distinct segments found per tile, in the order of `bbox_ids`
+        api_calls (list): Strava requests made per tile, in the order of `bbox_ids`
+        reason (str): Failure reason
+    """
+    import psycopg2
+
+    count = len(bbox_ids)
+    query = """
+        UPDATE public.sweep_tiles AS t
+        SET status = %s, failure_reason = %s, segment_count = c.segment_count, api_calls = c.api_calls,
+            fetched_at = CASE WHEN %s = 'fetched' THEN now() ELSE t.fetched_at END
+        FROM unnest(%s::int[], %s::int[], %s::int[]) AS c(bbox_id, segment_count, api_calls)
+        WHERE t.sweep_id = %s AND t.bbox_id = c.bbox_id
+    """
+    params = (
+        status,
+        reason,
+        status,
+        list(bbox_ids),
+        list(segment_counts) if segment_counts is not None else [None] * count,
+        list(api_calls) if api_calls is not None else [None] * count,
+        sweep_id,
+    )
+    with telemetry.timed(telemetry.db_duration, "db update_sweep_tiles", operation="update_sweep_tiles"):
+        with resilience.dependency("postgres").call(), psycopg2.connect(**db_params) as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+                conn.commit()
+    logger.info(f"Updated {count} tiles of sweep {sweep_id} to {status}")
+
+
+def refresh_sweep(db_params: Dict[str, Any], sweep_id: int) -> Dict[str, Any]:
+    """Refreshes the counts of a sweep from its tiles, and finishes it once no tile is
+    pending or dispatched
+
+    Returns:
+        dict: The updated ledger row
+    """
+    import psycopg2
+
+    query = """
+        WITH counts AS (
+            SELECT count(*) AS tiles,
+                   count(*) FILTER (WHERE status = 'fetched') AS tiles_fetched,
+                   count(*) FILTER (WHERE status = 'failed') AS tiles_failed,
+                   count(*) FILTER (WHERE status IN ('pending', 'dispatched')) AS tiles_open,
+                   coalesce(sum(segment_count), 0) AS segments,
+                   coalesce(sum(api_calls), 0) AS api_calls
+            FROM public.sweep_tiles WHERE sweep_id = %s
+        )
+        UPDATE public.sweeps s
+        SET tiles = c.tiles, tiles_fetched = c.tiles_fetched, tiles_failed = c.tiles_failed,
+            segments = c.segments, api_calls = c.api_calls,
+            status = CASE WHEN c.tiles_open = 0 THEN 'finished' ELSE 'running' END,
+            finished_at = CASE WHEN c.tiles_open = 0 THEN coalesce(s.finished_at, now()) END
+        FROM counts c
+        WHERE s.id = %s
+        RETURNING s.*
+    """
+    with psycopg2.connect(**db_params) as conn:
+        with conn.cursor() as cur:
+            cur.execute(query, (sweep_id, sweep_id))
+            rows = _fetch_dicts(cur)
+            conn.commit()
+    if not rows:
+        raise ValueError(f"No sweep {sweep_id}")
+    return rows[0]
+
+
+def compare_sweeps(db_params: Dict[str, Any], sweep_a: int, sweep_b: int) -> Dict[str, Any]:
+    """Compares the tiles two sweeps both fetched
+
+    Returns:
+        dict: Tiles fetched by both, their segments and Strava requests in each sweep,
+            and how many tiles found more, fewer or the same number of segments in B
+    """
+    import psycopg2
+
+    query = """
+        SELECT count(*) AS tiles,
+               coalesce(sum(a.segment_count), 0) AS segments_a,
+               coalesce(sum(b.segment_count), 0) AS segments_b,
+               coalesce(sum(a.api_calls), 0) AS api_calls_a,
+               coalesce(sum(b.api_calls), 0) AS api_calls_b,
+               count(*) FILTER (WHERE b.segment_count > a.segment_count) AS tiles_more,
+               count(*) FILTER (WHERE b.segment_count < a.segment_count) AS tiles_fewer,
+               count(*) FILTER (WHERE b.segment_count = a.segment_count) AS tiles_same
+        FROM public.sweep_tiles a JOIN public.sweep_tiles b ON b.bbox_id = a.bbox_id
+        WHERE a.sweep_id = %s AND b.sweep_id = %s AND a.status = 'fetched' AND b.status = 'fetched'
+    """
+    with psycopg2.connect(**db_params) as conn:
+        with conn.cursor() as cur:
+            cur.execute(query, (sweep_a, sweep_b))
+            return {"sweep_a": sweep_a, "sweep_b": sweep_b, **_fetch_dicts(cur)[0]}
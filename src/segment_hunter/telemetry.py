@@ -0,0 +1,300 @@
+"""OpenTelemetry metrics and tracing shared by the dispatcher, explorers and worker
+
+Instruments are created at import time against the global meter, and become live once
+`setup_metrics` installs a MeterProvider. The exporter is picked with the
+OTEL_METRICS_EXPORTER environment variable:
+
+    prometheus  serves /metrics on PROMETHEUS_PORT (long-running worker)
+    otlp        pushes to OTEL_EXPORTER_OTLP_ENDPOINT, e.g. a collector sidecar
+    gcp         pushes to Cloud Monitoring (Cloud Functions)
+    console     prints data points to stdout periodically
+    memory      keeps data points in memory, read back with `get_metrics_data`
+    none        instruments are no-ops (default)
+
+Spans are exported according to OTEL_TRACES_EXPORTER (gcp for Cloud Trace, otlp,
+console, memory or none). Trace context is propagated in W3C `traceparent` format
+through Pub/Sub message attributes and GCS object metadata with `inject_context` and
+`extract_context`, so one bounding box shows up as a single trace from dispatch to
+NDJSON conversion.
+
+Short-lived processes such as Cloud Function invocations must call `flush` before
+returning, since push exporters otherwise export on a timer.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from opentelemetry import metrics, propagate, trace
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import (
+    ConsoleMetricExporter,
+    InMemoryMetricReader,
+    PeriodicExportingMetricReader,
+)
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter, SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.trace import SpanKind, Status, StatusCode
+
+METRICS_EXPORTER = os.getenv("OTEL_METRICS_EXPORTER", "none")
+TRACES_EXPORTER = os.getenv("OTEL_TRACES_EXPORTER", "none")
+PROMETHEUS_PORT = int(os.getenv("PROMETHEUS_PORT", "9464"))
+EXPORT_INTERVAL_MILLIS = int(os.getenv("OTEL_METRIC_EXPORT_INTERVAL", "60000"))
+
+_meter_provider: Optional[MeterProvider] = None
+_memory_reader: Optional[InMemoryMetricReader] = None
+_tracer_provider: Optional[TracerProvider] = None
+_memory_span_exporter: Optional[InMemorySpanExporter] = None
+
+meter = metrics.get_meter("segment_hunter")
+tracer = trace.get_tracer("segment_hunter")
+
+strava_request_duration = meter.create_histogram(
+    "strava.request.duration", unit="s", description="Strava API request latency by endpoint and status code"
+)
+strava_retries = meter.create_counter(
+    "strava.request.retries", description="Strava API request retries by failure reason"
+)
+strava_account_events = meter.create_counter(
+    "strava.account.events", description="Per Strava account requests, throttles, auth failures and revocations"
+)
+gcs_upload_duration = meter.create_histogram(
+    "gcs.upload.duration", unit="s", description="GCS object upload latency"
+)
+gcs_upload_bytes = meter.create_histogram(
+    "gcs.upload.size", unit="By", description="Size of uploaded GCS objects as stored, by content encoding"
+)
+upload_queue_depth = meter.create_up_down_counter(
+    "upload.queue.depth", description="Objects waiting in the background upload queue"
+)
+upload_backpressure = meter.create_counter(
+    "upload.backpressure", description="Submissions that found the upload queue full and had to wait"
+)
+db_duration = meter.create_histogram(
+    "db.operation.duration", unit="s", description="Postgres operation latency by operation"
+)
+pubsub_duration = meter.create_histogram(
+    "pubsub.operation.duration", unit="s", description="Pub/Sub pull, ack and publish latency"
+)
+segments_per_box = meter.create_histogram(
+    "explorer.segments_per_box", description="Segments returned by the explore endpoint per bounding box query"
+)
+saturated_variants = meter.create_counter(
+    "explorer.saturated_variants", description="Explore queries that returned the result limit and were split by climb category"
+)
+tiles_per_batch = meter.create_histogram(
+    "explorer.tiles_per_batch", description="Bounding boxes packed into each stored batch object"
+)
+sink_append_duration = meter.create_histogram(
+    "sink.append.duration", unit="s", description="Segment sink append latency by sink and outcome"
+)
+sink_rows = meter.create_counter(
+    "sink.rows", description="Segment rows appended to a sink, or sent to the NDJSON fallback"
+)
+concurrency_limit = meter.create_up_down_counter(
+    "dependency.concurrency_limit", description="Adaptive limit on calls in flight per dependency"
+)
+circuit_transitions = meter.create_counter(
+    "dependency.circuit_transitions", description="Circuit breaker state changes per dependency and new state"
+)
+calls_shed = meter.create_counter(
+    "dependency.calls_shed", description="Calls refused by an open circuit breaker per dependency"
+)
+segment_details = meter.create_counter(
+    "enricher.segments", description="Segments whose details were fetched, failed for good or released by outcome"
+)
+messages_total = meter.create_counter(
+    "explorer.messages", description="Explorer messages by outcome (processed, failed, dead_lettered)"
+)
+
+
+def _build_readers(exporter: str) -> list:
+    global _memory_reader
+
+    if exporter == "prometheus":
+        from opentelemetry.exporter.prometheus import PrometheusMetricReader
+        from prometheus_client import start_http_server
+
+        start_http_server(PROMETHEUS_PORT)
+        return [PrometheusMetricReader()]
+    if exporter == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
+
+        return [PeriodicExportingMetricReader(OTLPMetricExporter(), export_interval_millis=EXPORT_INTERVAL_MILLIS)]
+    if exporter == "gcp":
+        from opentelemetry.exporter.cloud_monitoring import CloudMonitoringMetricsExporter
+
+        return [
+            PeriodicExportingMetricReader(
+                CloudMonitoringMetricsExporter(), export_interval_millis=EXPORT_INTERVAL_MILLIS
+            )
+        ]
+    if exporter == "console":
+        return [PeriodicExportingMetricReader(ConsoleMetricExporter(), export_interval_millis=EXPORT_INTERVAL_MILLIS)]
+    if exporter == "memory":
+        _memory_reader = InMemoryMetricReader()
+        return [_memory_reader]
+    if exporter == "none":
+        return []
+    raise ValueError(f"Unknown OTEL_METRICS_EXPORTER '{exporter}'")
+
+
+def setup_metrics(service_name: str, exporter: Optional[str] = None) -> MeterProvider:
+    """Installs the global MeterProvider. Safe to call more than once.
+
+    Args:
+        service_name (str): Value of the service.name resource attribute
+        exporter (str): Exporter name, defaults to OTEL_METRICS_EXPORTER
+
+    Returns:
+        MeterProvider: The installed provider
+    """
+    global _meter_provider
+
+    if _meter_provider is None:
+        _meter_provider = MeterProvider(
+            resource=Resource.create({"service.name": service_name}),
+            metric_readers=_build_readers(exporter or METRICS_EXPORTER),
+        )
+        metrics.set_meter_provider(_meter_provider)
+    return _meter_provider
+
+
+def _build_span_processor(exporter: str):
+    global _memory_span_exporter
+
+    if exporter == "gcp":
+        from opentelemetry.exporter.cloud_trace import CloudTraceSpanExporter
+
+        return BatchSpanProcessor(CloudTraceSpanExporter())
+    if exporter == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        return BatchSpanProcessor(OTLPSpanExporter())
+    if exporter == "console":
+        return SimpleSpanProcessor(ConsoleSpanExporter())
+    if exporter == "memory":
+        _memory_span_exporter = InMemorySpanExporter()
+        return SimpleSpanProcessor(_memory_span_exporter)
+    if exporter == "none":
+        return None
+    raise ValueError(f"Unknown OTEL_TRACES_EXPORTER '{exporter}'")
+
+
+def setup_tracing(service_name: str, exporter: Optional[str] = None) -> TracerProvider:
+    """Installs the global TracerProvider. Safe to call more than once.
+
+    Args:
+        service_name (str): Value of the service.name resource attribute
+        exporter (str): Exporter name, defaults to OTEL_TRACES_EXPORTER
+
+    Returns:
+        TracerProvider: The installed provider
+    """
+    global _tracer_provider
+
+    if _tracer_provider is None:
+        _tracer_provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+        processor = _build_span_processor(exporter or TRACES_EXPORTER)
+        if processor is not None:
+            _tracer_provider.add_span_processor(processor)
+        trace.set_tracer_provider(_tracer_provider)
+    return _tracer_provider
+
+
+def setup(service_name: str):
+    """Installs both the metrics and tracing providers"""
+    setup_metrics(service_name)
+    setup_tracing(service_name)
+
+
+def flush_metrics(timeout_millis: int = 10000):
+    """Exports pending data points, for processes that may be frozen or stopped next"""
+    if _meter_provider is not None:
+        _meter_provider.force_flush(timeout_millis=timeout_millis)
+
+
+def flush(timeout_millis: int = 10000):
+    """Exports pending data points and spans"""
+    flush_metrics(timeout_millis)
+    if _tracer_provider is not None:
+        _tracer_provider.force_flush(timeout_millis=timeout_millis)
+
+
+def get_finished_spans():
+    """Spans recorded by the in-memory exporter (OTEL_TRACES_EXPORTER=memory)"""
+    if _memory_span_exporter is None:
+        raise RuntimeError("Spans are not being recorded in memory, call setup_tracing(exporter='memory')")
+    return _memory_span_exporter.get_finished_spans()
+
+
+def get_metrics_data():
+    """Collects data points from the in-memory reader (OTEL_METRICS_EXPORTER=memory)"""
+    if _memory_reader is None:
+        raise RuntimeError("Metrics are not being recorded in memory, call setup_metrics(exporter='memory')")
+    return _memory_reader.get_metrics_data()
+
+
+def inject_context(carrier: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """Adds the current W3C trace context (traceparent/tracestate) to `carrier`
+
+    Args:
+        carrier (dict): Pub/Sub attributes or GCS object metadata to add to
+
+    Returns:
+        dict: The carrier
+    """
+    carrier = {} if carrier is None else carrier
+    propagate.inject(carrier)
+    return carrier
+
+
+def extract_context(carrier: Optional[Dict[str, str]]):
+    """Reads a W3C trace context from Pub/Sub attributes or GCS object metadata"""
+    return propagate.extract(carrier or {})
+
+
+def link_from_carrier(carrier: Optional[Dict[str, str]]) -> Optional[trace.Link]:
+    """Link to the span whose context is in `carrier`, for spans covering several traces"""
+    span_context = trace.get_current_span(extract_context(carrier)).get_span_context()
+    return trace.Link(span_context) if span_context.is_valid else None
+
+
+def record_error(error: BaseException):
+    """Marks the active span as failed with `error`"""
+    span = trace.get_current_span()
+    span.record_exception(error)
+    span.set_status(Status(StatusCode.ERROR, str(error)))
+
+
+def current_trace_id() -> str:
+    """Hex trace ID of the active span, used to correlate log lines with traces"""
+    span_context = trace.get_current_span().get_span_context()
+    return format(span_context.trace_id, "032x") if span_context.is_valid else "no-trace"
+
+
+@contextmanager
+def timed(histogram, span_name: str, kind: SpanKind = SpanKind.CLIENT, context=None, **attributes):
+    """Wraps the block in a span and records its duration in `histogram` with outcome=ok|error
+
+    Args:
+        histogram: Histogram the duration is recorded in, in seconds
+        span_name (str): Name of the span opened around the block
+        kind (SpanKind): Span kind, CLIENT for outbound calls
+        context: Parent context, e.g. from `extract_context`, defaults to the active span
+        **attributes: Attributes added to both the span and the data point
+    """
+    start = time.perf_counter()
+    outcome = "ok"
+    with tracer.start_as_current_span(span_name, context=context, kind=kind, attributes=attributes) as span:
+        try:
+            yield span
+        except BaseException as e:
+            outcome = "error"
+            span.set_status(Status(StatusCode.ERROR, str(e)))
+            raise
+        finally:
+            histogram.record(time.perf_counter() - start, dict(attributes, outcome=outcome))
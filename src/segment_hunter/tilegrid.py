@@ -0,0 +1,192 @@
+"""Compact, array-backed grid of bounding boxes
+
+A `TileGrid` holds its tiles in one NumPy structured array of TILE_DTYPE, 53 bytes per
+tile against several hundred for a dict per row, so multi-million cell grids fit in a
+small worker's memory. Indexing, filtering by status and ordering by priority or along
+the Hilbert curve, see `hilbert`, are vectorised and return grids sharing or copying
+that array; `chunks` iterates over views without copying. Tiles only become dicts one
+at a time, when a message is built.
+
+Grids are generated with `split`, written out for `grid.load_grid` with `to_csv` and
+read back from Postgres with `from_cursor`, a server-side cursor read in chunks.
+"""
+
+import csv
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+
+import numpy as np
+from numpy.lib import recfunctions
+
+from segment_hunter import hilbert
+from segment_hunter.failures import BBOX_KEYS
+
+# Status codes, the index in STATUSES, also the values of the bbox_status enum
+STATUSES = ("pending", "dispatched", "fetched", "failed")
+UNKNOWN_STATUS = 255
+TILE_DTYPE = np.dtype(
+    [
+        ("id", "<i4"),
+        ("sw_latitude", "<f8"),
+        ("sw_longitude", "<f8"),
+        ("ne_latitude", "<f8"),
+        ("ne_longitude", "<f8"),
+        ("status", "u1"),
+        ("priority", "<f4"),
+        # -1 until a sweep has explored the tile
+        ("segment_count", "<i4"),
+        # -1 if unknown, see hilbert_indexes
+        ("hilbert", "<i8"),
+    ]
+)
+FETCH_CHUNK_ROWS = 50_000
+CSV_CHUNK_ROWS = 100_000
+
+
+def status_code(status: str) -> int:
+    return STATUSES.index(status) if status in STATUSES else UNKNOWN_STATUS
+
+
+def hilbert_indexes(tiles: np.ndarray, order: int = hilbert.HILBERT_ORDER) -> np.ndarray:
+    """Hilbert index of every tile of a TILE_DTYPE array, see hilbert.tile_index"""
+    n = 1 << order
+    cells = []
+    for low_key, high_key, (low, high) in (
+        ("sw_longitude", "ne_longitude", hilbert.LONGITUDE_RANGE),
+        ("sw_latitude", "ne_latitude", hilbert.LATITUDE_RANGE),
+    ):
+        centre = (tiles[low_key] + tiles[high_key]) / 2
+        cells.append(np.clip(((centre - low) / (high - low) * n).astype(np.int64), 0, n - 1))
+    return hilbert.hilbert_index(cells[0], cells[1], order)
+
+
+def status_sql(column: str = "status") -> str:
+    """SQL expression turning a status column, text or bbox_status, into its code, for
+    queries read with `from_cursor`"""
+    statuses = ", ".join(f"'{status}'" for status in STATUSES)
+    return f"coalesce(array_position(ARRAY[{statuses}], {column}::text) - 1, {UNKNOWN_STATUS})"
+
+
+class TileGrid:
+    """Bounding boxes in a structured array of TILE_DTYPE
+
+    Args:
+        tiles (np.ndarray): Structured array of TILE_DTYPE
+        sweep_id (int): Sweep the tiles belong to, carried by their messages
+    """
+
+    def __init__(self, tiles: Optional[np.ndarray] = None, sweep_id: Optional[int] = None):
+        self.tiles = np.zeros(0, dtype=TILE_DTYPE) if tiles is None else tiles
+        self.sweep_id = sweep_id
+
+    @classmethod
+    def split(
+        cls, sw_lat: float, sw_lon: float, ne_lat: float, ne_lon: float, rows: int, cols: int, start_id: int = 1
+    ) -> "TileGrid":
+        """Splits a bounding box into rows * cols pending tiles, row by row from the south west
+
+        Args:
+            sw_lat (float): SW latitude (bottom corner) of the area
+            sw_lon (float): SW longitude (bottom corner) of the area
+            ne_lat (float): NE latitude (top corner) of the area
+            ne_lon (float): NE longitude (top corner) of the area
+            rows (int): Number of tiles along the latitude axis
+            cols (int): Number of tiles along the longitude axis
+            start_id (int): ID of the first tile, the next ones are numbered in order
+        """
+        lats = np.linspace(sw_lat, ne_lat, rows + 1)
+        lons = np.linspace(sw_lon, ne_lon, cols + 1)
+        tiles = np.zeros(rows * cols, dtype=TILE_DTYPE)
+        tiles["id"] = np.arange(start_id, start_id + rows * cols)
+        tiles["sw_latitude"] = np.repeat(lats[:-1], cols)
+        tiles["ne_latitude"] = np.repeat(lats[1:], cols)
+        tiles["sw_longitude"] = np.tile(lons[:-1], rows)
+        tiles["ne_longitude"] = np.tile(lons[1:], rows)
+        tiles["status"] = status_code("pending")
+        tiles["segment_count"] = -1
+        tiles["hilbert"] = hilbert_indexes(tiles)
+        return cls(tiles)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Sequence[Any]], sweep_id: Optional[int] = None) -> "TileGrid":
+        """Builds a grid from tuples in the field order of TILE_DTYPE"""
+        return cls(np.array([tuple(row) for row in rows], dtype=TILE_DTYPE), sweep_id)
+
+    @classmethod
+    def from_cursor(cls, cur, sweep_id: Optional[int] = None, chunk_rows: int = FETCH_CHUNK_ROWS) -> "TileGrid":
+        """Reads an executed query selecting the fields of TILE_DTYPE in order, with the
+        status as a code from `status_sql`, chunk by chunk so that only one chunk of row
+        tuples is alive at a time"""
+        chunks = []
+        while True:
+            rows = cur.fetchmany(chunk_rows)
+            if not rows:
+                break
+            chunks.append(np.array(rows, dtype=TILE_DTYPE))
+        return cls(np.concatenate(chunks) if chunks else None, sweep_id)
+
+    def __len__(self) -> int:
+        return len(self.tiles)
+
+    def __getitem__(self, key) -> "TileGrid":
+        """Tiles selected by a slice, boolean mask or index array"""
+        return TileGrid(self.tiles[np.atleast_1d(key)] if np.isscalar(key) else self.tiles[key], self.sweep_id)
+
+    def __repr__(self):
+        return f"TileGrid({len(self)} tiles, {self.nbytes} bytes, sweep_id={self.sweep_id})"
+
+    @property
+    def nbytes(self) -> int:
+        return self.tiles.nbytes
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self.tiles["id"]
+
+    @property
+    def coordinates(self) -> np.ndarray:
+        """(n, 4) array of sw_latitude, sw_longitude, ne_latitude, ne_longitude"""
+        return recfunctions.structured_to_unstructured(self.tiles[BBOX_KEYS])
+
+    def with_status(self, *statuses: str) -> "TileGrid":
+        return self[np.isin(self.tiles["status"], [status_code(status) for status in statuses])]
+
+    def within(self, sw_lat: float, sw_lon: float, ne_lat: float, ne_lon: float) -> "TileGrid":
+        """Tiles whose centre lies inside the bounds"""
+        lat = (self.tiles["sw_latitude"] + self.tiles["ne_latitude"]) / 2
+        lon = (self.tiles["sw_longitude"] + self.tiles["ne_longitude"]) / 2
+        return self[(lat >= sw_lat) & (lat <= ne_lat) & (lon >= sw_lon) & (lon <= ne_lon)]
+
+    def by_priority(self) -> "TileGrid":
+        """Tiles ordered by priority, highest first, then by ID"""
+        return self[np.lexsort((self.tiles["id"], -self.tiles["priority"]))]
+
+    def by_hilbert(self) -> "TileGrid":
+        """Tiles along the Hilbert curve, so neighbouring tiles follow each other"""
+        return self[np.argsort(self.tiles["hilbert"], kind="stable")]
+
+    def chunks(self, size: int) -> Iterator["TileGrid"]:
+        """Consecutive views of at most `size` tiles"""
+        for start in range(0, len(self), max(1, size)):
+            yield self[start : start + size]
+
+    def iter_tiles(self) -> Iterator[Dict[str, Any]]:
+        """One bounding box dict per tile, id, coordinates and Hilbert index if known, plus
+        the sweep_id if any, as dispatch publishes them"""
+        extra = {} if self.sweep_id is None else {"sweep_id": self.sweep_id}
+        columns = (self.tiles[key].tolist() for key in ("id", "hilbert", *BBOX_KEYS))
+        for tile_id, index, *coordinates in zip(*columns):
+            tile = {"id": tile_id, **dict(zip(BBOX_KEYS, coordinates))}
+            if index >= 0:
+                tile["hilbert"] = index
+            yield {**tile, **extra}
+
+    def to_csv(self, file_path: str, columns: List[str]) -> str:
+        """Writes the tiles as CSV rows of `columns`, fields of TILE_DTYPE, and their
+        status, in chunks"""
+        with open(file_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow([*columns, "status"])
+            for chunk in self.chunks(CSV_CHUNK_ROWS):
+                statuses = [STATUSES[code] if code < len(STATUSES) else "" for code in chunk.tiles["status"].tolist()]
+                writer.writerows(zip(*(chunk.tiles[column].tolist() for column in columns), statuses))
+        return file_path
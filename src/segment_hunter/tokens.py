@@ -0,0 +1,636 @@
+"""Shared Strava access token provider
+
+The provider keeps the current token in memory and refreshes it ahead of expiry:
+
+* While the token has more than `refresh_margin` seconds left it is served from memory
+  without touching Secret Manager.
+* Inside the margin the cached token is still served, and a single background thread
+  refreshes it, so request paths never wait on the refresh.
+* Only when there is no usable token at all (cold start, or the token is about to
+  expire) does the caller block on the refresh.
+
+Refreshes are single-flighted within a process by a lock, and across processes and
+Cloud Function instances by a Postgres advisory lock. The lock holder re-reads the
+token from Secret Manager first, so instances that lost the race pick up the token
+written by the winner instead of refreshing again and invalidating its refresh token.
+
+Strava rate limits apply per API application, so StravaTokenPool holds one provider
+per application ("account") and schedules each request on the account with the most
+remaining quota. Accounts are listed in the STRAVA_ACCOUNTS environment variable
+(comma separated). Account `name` reads the secrets `strava-<secret>--<env>--<name>`;
+the unnamed default account reads the original `strava-<secret>--<env>` secrets.
+"""
+
+import json
+import os
+import threading
+import time
+import zlib
+from contextlib import closing
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+
+from segment_hunter import failures, logging_config, telemetry, utils
+
+logger = logging_config.get_logger(__name__)
+
+# Strava only issues a new access token once the current one has less than an hour left
+REFRESH_MARGIN_SECONDS = 1800
+# Below this the cached token is not handed out and callers wait for a refresh
+MIN_VALIDITY_SECONDS = 60
+# After a failed background refresh, requests keep the cached token this long before another is tried
+BACKGROUND_RETRY_SECONDS = 60
+ADVISORY_LOCK_TIMEOUT = "30s"
+# Default Strava read limits per application: (15 minute, daily)
+DEFAULT_READ_RATE_LIMITS = (100, 1000)
+RATE_LIMIT_WINDOW_SECONDS = 15 * 60
+STRAVA_TOKEN_URL = "https://www.strava.com/api/v3/oauth/token"
+# Fields of a token request Strava may report invalid, meaning the account needs re-authorising
+TOKEN_FIELDS = {"client_id", "client_secret", "refresh_token", "code"}
+# Consecutive 401/403 responses, with a refresh in between, after which an account is dropped
+MAX_AUTH_FAILURES = 2
+
+
+def advisory_lock_key(name: str) -> int:
+    """Stable signed 32-bit key for pg_advisory_lock derived from a name"""
+    return zlib.crc32(name.encode("utf-8")) - 2**31
+
+
+def get_auth_code(client_id: str, redirect_uri: str, auth_code_scope: str) -> str:
+    """Obtains an authorisation code from Strava
+
+    Args:
+        client_id (str): Strava API Client ID
+        redirect_uri (str): Callback URL of your Strava API App
+        auth_code_scope (str): Authorisation Code Scopes
+
+    Returns:
+        str: Authorisation Code
+    """
+    import webbrowser
+
+    auth_url = (
+        requests.Request(
+            "GET",
+            "http://www.strava.com/oauth/authorize",
+            params={
+                "client_id": client_id,
+                "response_type": "code",
+                "redirect_uri": redirect_uri,
+                "approval_prompt": "auto",
+                "scope": auth_code_scope,
+            },
+        )
+        .prepare()
+        .url
+    )
+
+    print("Authenticate with Strava in Browser")
+    webbrowser.open(auth_url)
+
+    return input("After logging in, paste the 'code' from the redirected URL here: ").strip()
+
+
+def get_access_token(client_id: str, client_secret: str, auth_code: str) -> dict:
+    """Swaps an auth code to return an access and refresh token from the Strava API
+
+    Args:
+        client_id (str): Strava API Client ID
+        client_secret (str): Strava API Client Secret
+        auth_code (str): Strava API Authorisation Code
+
+    Returns:
+        dict: Dictionary containing keys "access_token" and "refresh_token"
+    """
+    payload = {
+        "client_id": client_id,
+        "client_secret": client_secret,
+        "code": auth_code,
+        "grant_type": "authorization_code",
+    }
+
+    try:
+        response = requests.post(STRAVA_TOKEN_URL, data=payload)
+        response.raise_for_status()
+    except requests.exceptions.HTTPError as e:
+        logger.error(f"Request failed: {e}")
+
+    return response.json()
+
+
+def refresh_access_token(client_id: str, client_secret: str, refresh_token: str) -> dict:
+    """Refreshes an access token for the Strava API
+
+    Args:
+        client_id (str): Strava API Client ID
+        client_secret (str): Strava API Client Secret
+        refresh_token (str): Strava API Refresh Token
+
+    Raises:
+        failures.AuthError: If Strava rejected the client or refresh token, see `token_rejection`
+        requests.HTTPError: For any other failed response, e.g. 429 or 5xx
+
+    Returns:
+        dict: Token response, including the new "access_token" and "refresh_token"
+    """
+    payload = {
+        "client_id": client_id,
+        "client_secret": client_secret,
+        "grant_type": "refresh_token",
+        "refresh_token": refresh_token,
+    }
+
+    response = requests.post(STRAVA_TOKEN_URL, data=payload)
+    reason = token_rejection(response)
+    if reason:
+        raise failures.AuthError(reason, f"Strava rejected the token refresh: {response.text}")
+    response.raise_for_status()
+    return response.json()
+
+
+def token_rejection(response) -> Optional[str]:
+    """Reason the token endpoint rejected the credentials themselves, None for failures
+    worth retrying
+
+    Strava answers 401/403 for a bad client and 400 naming the invalid field for a
+    revoked or unknown refresh token; OAuth servers answer `invalid_grant`.
+    """
+    if response.status_code in failures.AUTH_HTTP_STATUSES:
+        return f"http_{response.status_code}"
+    if response.status_code != 400:
+        return None
+    try:
+        body = response.json()
+    except ValueError:
+        return None
+    if not isinstance(body, dict):
+        return None
+    if body.get("error") == "invalid_grant":
+        return "invalid_grant"
+    for error in body.get("errors") or []:
+        if isinstance(error, dict) and error.get("code") == "invalid" and error.get("field") in TOKEN_FIELDS:
+            return f"invalid_{error['field']}"
+    return None
+
+
+class StravaTokenProvider:
+    """Serves Strava access tokens from memory and refreshes them ahead of expiry
+
+    Args:
+        gcp_project_id (str): GCP project holding the Strava secrets
+        env (str): Environment suffix of the secret names
+        db_params (dict): psycopg2 connection parameters used for the cross-instance
+            advisory lock. Without them refreshes are only single-flighted in-process.
+        refresh_margin (int): Seconds before expiry at which a refresh is started
+        account (str): Name of the Strava API application, empty for the default one
+    """
+
+    def __init__(
+        self,
+        gcp_project_id: str,
+        env: str,
+        db_params: Optional[Dict[str, Any]] = None,
+        refresh_margin: int = REFRESH_MARGIN_SECONDS,
+        account: str = "",
+    ):
+        self.gcp_project_id = gcp_project_id
+        self.env = env
+        self.account = account
+        self.db_params = db_params
+        self.refresh_margin = refresh_margin
+        self._token: Optional[Dict[str, Any]] = None
+        self._refresh_lock = threading.Lock()
+        self._background_refresher: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        # Guards the single in-flight background refresh and the time the last one failed
+        self._background_lock = threading.Lock()
+        self._background_refreshing = False
+        self._last_refresh_failure: Optional[float] = None
+
+    def secret_name(self, secret: str) -> str:
+        suffix = f"--{self.account}" if self.account else ""
+        return f"strava-{secret}--{self.env}{suffix}"
+
+    @property
+    def access_token_secret(self) -> str:
+        return self.secret_name("access-token")
+
+    @property
+    def refresh_token_secret(self) -> str:
+        return self.secret_name("refresh-token")
+
+    @property
+    def lock_key(self) -> int:
+        return advisory_lock_key(self.access_token_secret)
+
+    def _seconds_left(self, token: Optional[Dict[str, Any]]) -> float:
+        if not token:
+            return 0.0
+        return token.get("expires_at", 0) - time.time()
+
+    def _is_fresh(self, token: Optional[Dict[str, Any]]) -> bool:
+        return self._seconds_left(token) > self.refresh_margin
+
+    def access_token(self) -> str:
+        """Returns a valid access token, refreshing in the background when it nears expiry
+
+        Returns:
+            str: Strava access token
+        """
+        token = self._token
+        if self._seconds_left(token) < MIN_VALIDITY_SECONDS:
+            token = self.refresh()
+        elif not self._is_fresh(token):
+            self._refresh_in_background()
+        return token["access_token"]
+
+    def refresh(self) -> Dict[str, Any]:
+        """Makes sure the cached token is fresh, refreshing it with Strava if required
+
+        Returns:
+            dict: Current token, without the refresh token
+        """
+        with self._refresh_lock:
+            # Another thread may have refreshed while we were waiting for the lock
+            if self._is_fresh(self._token):
+                return self._token
+            token = self._load_token()
+            if not self._is_fresh(token):
+                token = self._refresh_single_flight()
+            self._token = token
+            logger.info(f"Strava token valid until {token.get('expires_at')}")
+            return token
+
+    def invalidate(self):
+        """Drops the cached token, e.g. after Strava rejected it"""
+        self._token = None
+
+    def _refresh_in_background(self):
+        """Starts a refresh thread unless one is in flight or the last refresh failed
+        less than BACKGROUND_RETRY_SECONDS ago"""
+        with self._background_lock:
+            if self._background_refreshing:
+                return
+            failed = self._last_refresh_failure
+            if failed is not None and time.monotonic() - failed < BACKGROUND_RETRY_SECONDS:
+                return
+            self._background_refreshing = True
+        try:
+            thread = threading.Thread(target=self._run_background_refresh, name="strava-token-refresh", daemon=True)
+            thread.start()
+        except Exception:
+            with self._background_lock:
+                self._background_refreshing = False
+            raise
+
+    def _run_background_refresh(self):
+        try:
+            self._safe_refresh()
+        finally:
+            with self._background_lock:
+                self._background_refreshing = False
+
+    def _safe_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            with self._background_lock:
+                self._last_refresh_failure = time.monotonic()
+            logger.exception(f"Background Strava token refresh failed: {e}")
+        else:
+            with self._background_lock:
+                self._last_refresh_failure = None
+
+    def start_background_refresh(self):
+        """Starts a daemon thread that refreshes the token shortly before it enters the
+        refresh margin. Intended for long-running workers."""
+        if self._background_refresher is not None:
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.is_set():
+                self._safe_refresh()
+                wait = self._seconds_left(self._token) - self.refresh_margin
+                self._stop.wait(max(wait, MIN_VALIDITY_SECONDS))
+
+        self._background_refresher = threading.Thread(target=run, name="strava-token-refresher", daemon=True)
+        self._background_refresher.start()
+
+    def stop_background_refresh(self):
+        self._stop.set()
+        self._background_refresher = None
+
+    def _load_token(self) -> Dict[str, Any]:
+        return json.loads(utils.get_secret(self.gcp_project_id, self.access_token_secret))
+
+    def _refresh_single_flight(self) -> Dict[str, Any]:
+        if not self.db_params:
+            return self._refresh_with_strava()
+
+        import psycopg2
+
+        with closing(psycopg2.connect(**self.db_params)) as conn:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"SET lock_timeout = '{ADVISORY_LOCK_TIMEOUT}'")
+                cur.execute("SELECT pg_advisory_lock(%s)", (self.lock_key,))
+                try:
+                    # Whoever held the lock before us may already have refreshed
+                    token = self._load_token()
+                    if self._is_fresh(token):
+                        logger.info("Strava token was refreshed by another instance")
+                        return token
+                    return self._refresh_with_strava()
+                finally:
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (self.lock_key,))
+
+    def _refresh_with_strava(self) -> Dict[str, Any]:
+        logger.info("Refreshing Strava access token...")
+        client_id, client_secret, refresh_token = self._client_credentials()
+        token = refresh_access_token(client_id, client_secret, refresh_token)
+        if "access_token" not in token or "refresh_token" not in token:
+            raise RuntimeError(f"Strava token refresh failed: {token}")
+
+        new_refresh_token = token.pop("refresh_token")
+        # Persist the refresh token first, it is the one that cannot be recovered
+        utils.put_secret(self.gcp_project_id, self.refresh_token_secret, new_refresh_token)
+        utils.put_secret(self.gcp_project_id, self.access_token_secret, json.dumps(token))
+        logger.info(f"Updated secrets: {self.refresh_token_secret}, {self.access_token_secret}")
+        return token
+
+    def _client_credentials(self) -> Tuple[str, str, str]:
+        return (
+            utils.get_secret(self.gcp_project_id, self.secret_name("client-id")),
+            utils.get_secret(self.gcp_project_id, self.secret_name("client-secret")),
+            utils.get_secret(self.gcp_project_id, self.refresh_token_secret),
+        )
+
+
+class AccountQuota:
+    """Tracks the rate limit usage of one Strava application
+
+    Usage is counted locally as requests are scheduled and reconciled with the
+    X-RateLimit headers of every response. The 15 minute window resets on the quarter
+    hour and the daily window at midnight UTC, as documented by Strava.
+    """
+
+    def __init__(self, limits: Tuple[int, int] = DEFAULT_READ_RATE_LIMITS):
+        self.limit_short, self.limit_daily = limits
+        self.usage_short = 0
+        self.usage_daily = 0
+        self._short_window = self._current_short_window()
+        self._day = self._current_day()
+
+    @staticmethod
+    def _current_short_window() -> int:
+        return int(time.time() // RATE_LIMIT_WINDOW_SECONDS)
+
+    @staticmethod
+    def _current_day() -> int:
+        return int(time.time() // 86400)
+
+    def _roll_windows(self):
+        if self._current_short_window() != self._short_window:
+            self._short_window = self._current_short_window()
+            self.usage_short = 0
+        if self._current_day() != self._day:
+            self._day = self._current_day()
+            self.usage_daily = 0
+
+    def remaining(self) -> int:
+        self._roll_windows()
+        return min(self.limit_short - self.usage_short, self.limit_daily - self.usage_daily)
+
+    def seconds_until_reset(self) -> float:
+        if self.limit_daily - self.usage_daily <= 0:
+            return (self._current_day() + 1) * 86400 - time.time()
+        return (self._current_short_window() + 1) * RATE_LIMIT_WINDOW_SECONDS - time.time()
+
+    def reserve(self):
+        self._roll_windows()
+        self.usage_short += 1
+        self.usage_daily += 1
+
+    def exhaust(self):
+        self.usage_short = self.limit_short
+
+    def update_from_headers(self, headers) -> bool:
+        """Reconciles usage with Strava's rate limit headers
+
+        The read limits are used when present, since the explore and segment endpoints
+        count against them, otherwise the overall limits.
+
+        Returns:
+            bool: True if the headers carried rate limit information
+        """
+        for prefix in ("X-ReadRateLimit", "X-RateLimit"):
+            limit = headers.get(f"{prefix}-Limit")
+            usage = headers.get(f"{prefix}-Usage")
+            if limit and usage:
+                try:
+                    self.limit_short, self.limit_daily = (int(v) for v in limit.split(",")[:2])
+                    self.usage_short, self.usage_daily = (int(v) for v in usage.split(",")[:2])
+                except ValueError:
+                    continue
+                self._short_window = self._current_short_window()
+                self._day = self._current_day()
+                return True
+        return False
+
+
+class StravaTokenPool:
+    """Schedules Strava requests across several API applications by remaining quota
+
+    Call `acquire` before each request and `record_response` with its response.
+    Accounts whose tokens keep being rejected, or whose refresh Strava rejects, are
+    revoked and removed from the pool.
+
+    Args:
+        gcp_project_id (str): GCP project holding the Strava secrets
+        env (str): Environment suffix of the secret names
+        accounts (list): Names of the Strava API applications, "" for the default one
+        db_params (dict): psycopg2 connection parameters for the advisory lock
+    """
+
+    def __init__(
+        self,
+        gcp_project_id: str,
+        env: str,
+        accounts: List[str],
+        db_params: Optional[Dict[str, Any]] = None,
+    ):
+        if not accounts:
+            raise ValueError("A token pool needs at least one account")
+        self.providers = {
+            account: StravaTokenProvider(gcp_project_id, env, db_params, account=account)
+            for account in accounts
+        }
+        self.quotas = {account: AccountQuota() for account in accounts}
+        self.metrics = {
+            account: {"requests": 0, "throttled": 0, "auth_failures": 0, "revoked": 0}
+            for account in accounts
+        }
+        self.revoked: Dict[str, str] = {}
+        self._auth_failures = {account: 0 for account in accounts}
+        self._lock = threading.Lock()
+
+    def _count(self, account: str, event: str):
+        self.metrics[account][event] += 1
+        telemetry.strava_account_events.add(1, {"account": account or "default", "event": event})
+
+    def __len__(self) -> int:
+        return len(self.providers)
+
+    @property
+    def db_params(self) -> Optional[Dict[str, Any]]:
+        return next(iter(self.providers.values())).db_params if self.providers else None
+
+    @db_params.setter
+    def db_params(self, db_params: Dict[str, Any]):
+        for provider in self.providers.values():
+            provider.db_params = db_params
+
+    def acquire(self) -> Tuple[str, str]:
+        """Picks the account with the most remaining quota and reserves one request on it
+
+        Raises:
+            failures.AuthError: If every account has been revoked
+            failures.RetryableError: If every account has exhausted its quota
+
+        Returns:
+            tuple: (account name, access token)
+        """
+        with self._lock:
+            if not self.providers:
+                raise failures.AuthError("no_strava_accounts", f"All Strava accounts revoked: {self.revoked}")
+            account = max(self.providers, key=lambda a: self.quotas[a].remaining())
+            quota = self.quotas[account]
+            if quota.remaining() <= 0:
+                wait = min(q.seconds_until_reset() for a, q in self.quotas.items() if a in self.providers)
+                raise failures.RetryableError(
+                    "quota_exhausted", f"All Strava accounts are rate limited for another {int(wait)}s"
+                )
+            quota.reserve()
+            self._count(account, "requests")
+            provider = self.providers[account]
+        return account, provider.access_token()
+
+    def record_response(self, account: str, response):
+        """Updates quota and account health from a Strava response
+
+        Args:
+            account (str): Account returned by `acquire`
+            response (requests.Response): Strava API response
+        """
+        with self._lock:
+            if account not in self.providers:
+                return
+            quota = self.quotas[account]
+            quota.update_from_headers(response.headers)
+            if response.status_code == 429:
+                quota.exhaust()
+                self._count(account, "throttled")
+                logger.warning(f"Strava account '{account}' is rate limited, {len(self.providers)} accounts left in rotation")
+            elif response.status_code in failures.AUTH_HTTP_STATUSES:
+                self._count(account, "auth_failures")
+                self._auth_failures[account] += 1
+                failed = self._auth_failures[account]
+            else:
+                self._auth_failures[account] = 0
+                return
+        if response.status_code in failures.AUTH_HTTP_STATUSES:
+            self._handle_auth_failure(account, failed)
+
+    def _handle_auth_failure(self, account: str, failed: int):
+        if failed >= MAX_AUTH_FAILURES:
+            self.revoke(account, f"{failed} consecutive auth failures")
+            return
+        provider = self.providers.get(account)
+        if provider is None:
+            return
+        provider.invalidate()
+        self._refresh(account, provider)
+
+    def _refresh(self, account: str, provider: StravaTokenProvider):
+        """Refreshes an account's token, revoking the account only if Strava rejected it.
+        Any other failure, e.g. Secret Manager, network or 5xx errors, leaves the account
+        in rotation for the next refresh or request to retry."""
+        try:
+            provider.refresh()
+        except Exception as e:
+            error = failures.classify_exception(e)
+            if isinstance(error, failures.AuthError):
+                self.revoke(account, f"token refresh rejected: {error.reason}: {error}")
+            else:
+                logger.warning(f"Strava account '{account}' token refresh failed, retrying later: {error.reason}: {error}")
+
+    def revoke(self, account: str, reason: str):
+        """Removes an account from rotation"""
+        with self._lock:
+            provider = self.providers.pop(account, None)
+            if provider is None:
+                return
+            provider.stop_background_refresh()
+            self.revoked[account] = reason
+            self._count(account, "revoked")
+        logger.error(f"Removed Strava account '{account}' from the pool: {reason}")
+
+    def has_other_accounts(self, account: str) -> bool:
+        return any(a != account for a in self.providers)
+
+    def refresh_all(self):
+        """Refreshes every account ahead of expiry, revoking those Strava rejects"""
+        for account, provider in list(self.providers.items()):
+            self._refresh(account, provider)
+
+    def start_background_refresh(self):
+        for provider in list(self.providers.values()):
+            provider.start_background_refresh()
+
+    def stop_background_refresh(self):
+        for provider in list(self.providers.values()):
+            provider.stop_background_refresh()
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Per-account request metrics and remaining quota"""
+        with self._lock:
+            return {
+                account: dict(metrics, remaining=self.quotas[account].remaining(), active=account in self.providers)
+                for account, metrics in self.metrics.items()
+            }
+
+
+def configured_accounts() -> List[str]:
+    """Strava accounts listed in STRAVA_ACCOUNTS, or the single default account"""
+    accounts = [a.strip() for a in os.getenv("STRAVA_ACCOUNTS", "").split(",") if a.strip()]
+    return [("" if a == "default" else a) for a in accounts] or [""]
+
+
+_pools: Dict[Tuple[str, str], StravaTokenPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_token_pool(
+    gcp_project_id: str, env: str, db_params: Optional[Dict[str, Any]] = None
+) -> StravaTokenPool:
+    """Returns the process-wide token pool, so warm Cloud Function instances and
+    worker threads share in-memory tokens and quota tracking
+
+    Args:
+        gcp_project_id (str): GCP project holding the Strava secrets
+        env (str): Environment suffix of the secret names
+        db_params (dict): psycopg2 connection parameters for the advisory lock
+
+    Returns:
+        StravaTokenPool: Shared pool for this project and environment
+    """
+    with _pools_lock:
+        pool = _pools.get((gcp_project_id, env))
+        if pool is None:
+            pool = StravaTokenPool(gcp_project_id, env, configured_accounts(), db_params)
+            _pools[(gcp_project_id, env)] = pool
+        elif db_params and not pool.db_params:
+            pool.db_params = db_params
+        return pool
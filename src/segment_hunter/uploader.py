@@ -0,0 +1,196 @@
+"""Background upload stage for explorer outputs
+
+The explore stage hands each response to `BackgroundUploader.submit` and moves on to
+the next bounding box while a thread pool gzips and uploads it. The queue is bounded:
+once UPLOAD_QUEUE_SIZE objects are waiting, `submit` blocks, which throttles fetching
+to the pace GCS accepts uploads instead of growing memory without limit. Uploads go
+through the gcs dependency's adaptive limit and circuit breaker, and failed uploads are
+retried with jittered exponential backoff.
+
+An upload's `on_done` callback runs on the upload thread once the object is stored,
+or with the error once retries are exhausted. The explorer marks a bounding box
+fetched from there, so a box whose upload never landed stays pending and is picked up
+again by the next dispatch. Processes that may be frozen or stopped must call `flush`
+(Cloud Functions) or `close` (the worker, also registered at exit) first.
+"""
+
+import atexit
+import gzip
+import os
+import queue
+import threading
+import time
+from functools import lru_cache
+from typing import Callable, Dict, Optional
+
+from opentelemetry import context as otel_context
+
+from segment_hunter import logging_config, resilience, telemetry
+from segment_hunter.blobstore import BlobStore
+
+logger = logging_config.get_logger(__name__)
+
+UPLOAD_QUEUE_SIZE = int(os.getenv("UPLOAD_QUEUE_SIZE", "256"))
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "8"))
+UPLOAD_MAX_ATTEMPTS = int(os.getenv("UPLOAD_MAX_ATTEMPTS", "5"))
+UPLOAD_BACKOFF_SECONDS = float(os.getenv("UPLOAD_BACKOFF_SECONDS", "1"))
+# 0 uploads objects uncompressed
+UPLOAD_GZIP_LEVEL = int(os.getenv("UPLOAD_GZIP_LEVEL", "6"))
+
+
+class Upload:
+    """One object waiting to be uploaded
+
+    Args:
+        blobs (BlobStore): Destination store
+        blob_name (str): Name of the blob to save
+        data (bytes): Uncompressed contents
+        content_type (str): Content type of the uncompressed contents
+        metadata (dict): Custom metadata, the trace context of the submitter, which the
+            upload span continues
+        on_done (callable): Called with None once stored, or with the last error
+    """
+
+    def __init__(
+        self,
+        blobs: BlobStore,
+        blob_name: str,
+        data: bytes,
+        content_type: str = "application/json",
+        metadata: Optional[Dict[str, str]] = None,
+        on_done: Optional[Callable[[Optional[BaseException]], None]] = None,
+    ):
+        self.blobs = blobs
+        self.blob_name = blob_name
+        self.data = data
+        self.content_type = content_type
+        self.metadata = metadata or {}
+        self.on_done = on_done
+
+
+class BackgroundUploader:
+    """Bounded queue of uploads drained by a pool of daemon threads"""
+
+    def __init__(
+        self,
+        queue_size: int = UPLOAD_QUEUE_SIZE,
+        concurrency: int = UPLOAD_CONCURRENCY,
+        max_attempts: int = UPLOAD_MAX_ATTEMPTS,
+        backoff_seconds: float = UPLOAD_BACKOFF_SECONDS,
+        gzip_level: int = UPLOAD_GZIP_LEVEL,
+    ):
+        self.concurrency = max(1, concurrency)
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_seconds = backoff_seconds
+        self.gzip_level = gzip_level
+        self._queue: "queue.Queue[Optional[Upload]]" = queue.Queue(maxsize=max(1, queue_size))
+        self._threads = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self.stats = {"uploaded": 0, "failed": 0, "raw_bytes": 0, "stored_bytes": 0}
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.concurrency):
+                thread = threading.Thread(target=self._run, name=f"uploader-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, upload: Upload):
+        """Queues an upload, blocking while the queue is full"""
+        if self._closed:
+            raise RuntimeError("Uploader is closed")
+        self._start()
+        if self._queue.full():
+            telemetry.upload_backpressure.add(1)
+            logger.warning(f"Upload queue full ({self._queue.maxsize}), waiting for uploads to drain")
+        self._queue.put(upload)
+        telemetry.upload_queue_depth.add(1)
+
+    def _run(self):
+        while True:
+            upload = self._queue.get()
+            try:
+                if upload is None:
+                    return
+                telemetry.upload_queue_depth.add(-1)
+                self._process(upload)
+            except Exception as e:
+                # Keep the thread alive, a dead upload thread would stall every flush
+                logger.exception(f"Unexpected error uploading {upload.blob_name}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _process(self, upload: Upload):
+        # Continue the submitter's trace, for the upload span and the callback
+        token = otel_context.attach(telemetry.extract_context(upload.metadata))
+        try:
+            self._upload(upload)
+        finally:
+            otel_context.detach(token)
+
+    def _upload(self, upload: Upload):
+        data, content_encoding = upload.data, None
+        if self.gzip_level > 0:
+            data, content_encoding = gzip.compress(upload.data, compresslevel=self.gzip_level), "gzip"
+
+        error = None
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                with telemetry.timed(telemetry.gcs_upload_duration, "gcs upload", bucket=upload.blobs.name):
+                    with resilience.dependency("gcs").call():
+                        upload.blobs.write_bytes(upload.blob_name, data, upload.content_type, upload.metadata, content_encoding)
+                error = None
+                break
+            except Exception as e:
+                error = e
+                if attempt < self.max_attempts:
+                    sleep_for = resilience.backoff_delay(attempt, self.backoff_seconds, retry_after=getattr(e, "retry_after", None))
+                    logger.warning(f"Upload of {upload.blob_name} failed ({e}), retry {attempt} in {sleep_for:.1f}s")
+                    time.sleep(sleep_for)
+
+        with self._lock:
+            if error is None:
+                self.stats["uploaded"] += 1
+                self.stats["raw_bytes"] += len(upload.data)
+                self.stats["stored_bytes"] += len(data)
+            else:
+                self.stats["failed"] += 1
+        if error is None:
+            telemetry.gcs_upload_bytes.record(len(data), {"bucket": upload.blobs.name, "encoding": content_encoding or "identity"})
+        else:
+            logger.error(f"Giving up on upload of {upload.blob_name} after {self.max_attempts} attempts: {error}")
+
+        if upload.on_done is not None:
+            try:
+                upload.on_done(error)
+            except Exception as e:
+                logger.exception(f"Upload callback for {upload.blob_name} failed: {e}")
+
+    def flush(self):
+        """Waits until every queued upload, and its callback, has finished"""
+        self._queue.join()
+
+    def close(self):
+        """Flushes pending uploads and stops the upload threads"""
+        if self._closed:
+            return
+        self._closed = True
+        self.flush()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self.stats["uploaded"]:
+            ratio = self.stats["stored_bytes"] / max(1, self.stats["raw_bytes"])
+            logger.info(f"Uploader closed: {self.stats}, stored {ratio:.0%} of raw bytes")
+
+
+@lru_cache(maxsize=1)
+def get_uploader() -> BackgroundUploader:
+    """Uploader shared by every explorer in the process, closed at exit"""
+    uploader = BackgroundUploader()
+    atexit.register(uploader.close)
+    return uploader
@@ -1,5 +1,21 @@
-from google.cloud import secretmanager, storage
 import json
+from functools import lru_cache
+
+
+@lru_cache(maxsize=1)
+def get_secret_client():
+    """Secret Manager client shared by every call, imported on first use"""
+    from google.cloud import secretmanager
+
+    return secretmanager.SecretManagerServiceClient()
+
+
+@lru_cache(maxsize=1)
+def get_storage_client():
+    """GCS client shared by every call, imported on first use"""
+    from google.cloud import storage
+
+    return storage.Client()
 
 
 def get_secret(project_id: str, secret_name: str):
@@ -12,7 +28,7 @@ def get_secret(project_id: str, secret_name: str):
     Returns:
         str: secret
     """
-    client = secretmanager.SecretManagerServiceClient()
+    client = get_secret_client()
     secret_url = f"projects/{project_id}/secrets/{secret_name}/versions/latest"
     response = client.access_secret_version(name=secret_url)
     return response.payload.data.decode("UTF-8")
@@ -30,7 +46,7 @@ def put_secret(project_id: str, secret_name: str, secret_value: str):
         None
     """
 
-    client = secretmanager.SecretManagerServiceClient()
+    client = get_secret_client()
     parent = client.secret_path(project_id, secret_name)
     payload = secret_value.encode("UTF-8")
     response = client.add_secret_version(
@@ -39,40 +55,6 @@ def put_secret(project_id: str, secret_name: str, secret_value: str):
     print(f"Added secret version: {response.name}")
 
 
-def upload_blob_from_path(bucket_name: str, source_file_path: str, destination_blob_name: str):
-    """Uploads a file to a Google Cloud Storage bucket given a file path
-
-    Args:
-        bucket_name (str): GCS bucket name
-        source_file_path (str): Path to your file
-        destination_blob_name (str): Name of the blob to save in GCS
-
-    Returns:
-        None
-    """
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
-    blob.upload_from_filename(source_file_path)
-
-
-def upload_blob_from_string(bucket_name: str, string_blob: str, destination_blob_name: str):
-    """Uploads a file to a Google Cloud Storage bucket given a string
-
-    Args:
-        bucket_name (str): GCS bucket name
-        string_blob (str): String representation of your blob
-        destination_blob_name (str): Name of the blob to save in GCS
-
-    Returns:
-        None
-    """
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
-    blob.upload_from_string(string_blob, content_type="application/json")
-
-
 def load_json(file_path: str):
     """Load a JSON file as a dictionary
 
@@ -0,0 +1,321 @@
+"""Pub/Sub consumers running the explore stage
+
+    run_worker            long-running streaming pull worker (services/segment_explorer)
+    pull_once             pulls and explores a single batch of messages
+    explore_pubsub_event  Pub/Sub triggered Cloud Function (functions/segment_explorer)
+
+The Pub/Sub client library is only imported by the pull consumers, since the Cloud
+Function receives its messages from the trigger.
+"""
+
+import base64
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+from segment_hunter import explore, failures, fetch, logging_config, profiling, resilience, telemetry
+from segment_hunter.batcher import BATCH_MAX_SECONDS, BATCH_MAX_TILES
+from segment_hunter.blobstore import open_blob_store
+from segment_hunter.config import ENV, load_config
+from segment_hunter.tokens import get_token_pool
+
+logger = logging_config.get_logger(__name__)
+
+# Longest a message shed by open circuits is held before it is nacked, by default three
+# of the longest open windows, see `explore_while_shed`
+MAX_SHED_HOLD_SECONDS = float(os.getenv("MAX_SHED_HOLD_SECONDS", str(3 * resilience.MAX_OPEN_SECONDS)))
+# Seconds a held message waits between checks of the circuits, and pull_once extends its deadline by
+SHED_POLL_SECONDS = 60
+# Streaming worker settings. Messages stay leased until their tiles are stored, so the
+# client library extends leases until MAX_LEASE_DURATION, which must cover the worst
+# case retry backoff of the fetch stage, a hold while circuits are open, and the wait
+# for a batch and its upload, and enough messages are leased at once to fill a batch.
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "4"))
+WORKER_MAX_OUTSTANDING_MESSAGES = int(
+    os.getenv("WORKER_MAX_OUTSTANDING_MESSAGES", str(max(2 * WORKER_CONCURRENCY, BATCH_MAX_TILES)))
+)
+MAX_LEASE_DURATION = fetch.MAX_TOTAL_BACKOFF_SECONDS + MAX_SHED_HOLD_SECONDS + BATCH_MAX_SECONDS + 300
+# Ack deadline set by pull_once on messages waiting for their batch to be stored
+PULL_ACK_DEADLINE_SECONDS = int(os.getenv("PULL_ACK_DEADLINE_SECONDS", "120"))
+MAX_ACK_DEADLINE_SECONDS = 600
+# Retryable failures are re-raised so the function is retried, until the event is older than this
+MAX_EVENT_AGE_SECONDS = int(os.getenv("MAX_EVENT_AGE_SECONDS", "3600"))
+
+
+def explore_while_shed(
+    handle: Callable[[], str], stopping: threading.Event, extend_lease: Optional[Callable[[int], None]] = None
+) -> str:
+    """Runs `handle` and, while an open circuit sheds the message, holds it and runs it
+    again once the circuit lets calls through
+
+    Pub/Sub counts every redelivery against the subscription's max_delivery_attempts,
+    whether the message was nacked or its lease expired, while a circuit stays open for
+    up to resilience.MAX_OPEN_SECONDS at a time. Shed messages nacked during an outage
+    would be dead-lettered by the subscription itself, bypassing `dead_letter_message`,
+    so they are held instead, for up to MAX_SHED_HOLD_SECONDS. The streaming client
+    extends the lease of a held message itself, pull consumers pass `extend_lease`.
+
+    Returns:
+        str: Outcome of the last run, RETRY if the message is still shed once the hold
+            is over or the consumer is stopping
+    """
+    outcome = handle()
+    hold_until = time.monotonic() + MAX_SHED_HOLD_SECONDS
+    while outcome == explore.RETRY:
+        delay = resilience.shed_delay()
+        left = hold_until - time.monotonic()
+        if not delay or left <= 0:
+            break
+        wait = min(delay, left, SHED_POLL_SECONDS)
+        if extend_lease is not None:
+            extend_lease(int(wait) + SHED_POLL_SECONDS)
+        if stopping.wait(wait):
+            break
+        if not resilience.shed_delay():
+            outcome = handle()
+    return outcome
+
+
+def run_worker(concurrency: int = WORKER_CONCURRENCY, max_outstanding_messages: int = WORKER_MAX_OUTSTANDING_MESSAGES):
+    """Runs the explorer as a long-running streaming pull subscriber
+
+    Messages are handled on a thread pool of `concurrency` workers, and acknowledged
+    once their tiles are stored. Flow control caps the number of leased messages, and
+    the client library keeps extending their ack deadline until then, so slow Strava
+    backoffs no longer cause redelivery to another worker, and tiles still waiting for
+    their batch when the worker dies are redelivered rather than lost. SIGTERM/SIGINT
+    nack newly delivered messages, wait for those being explored, store their batches
+    and acknowledge them, then stop the pull.
+
+    Args:
+        concurrency (int): Number of messages processed in parallel
+        max_outstanding_messages (int): Maximum number of leased, unacknowledged messages
+    """
+    from google.cloud import pubsub_v1
+    from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+
+    config = load_config()
+    gcp_project_id = config["gcp_project_id"]
+
+    tokens = get_token_pool(gcp_project_id, ENV, config["db_params"])
+    tokens.refresh_all()
+    tokens.start_background_refresh()
+
+    subscriber = pubsub_v1.SubscriberClient()
+    subscription_path = subscriber.subscription_path(gcp_project_id, config["tf_outputs"]["pubsub_topic_sub"]["value"])
+
+    stopping = threading.Event()
+    in_flight = [0]
+    idle = threading.Condition()
+
+    def settle(message):
+        def on_stored(error):
+            if error is None:
+                message.ack()
+            else:
+                message.nack()
+
+        return on_stored
+
+    def callback(message):
+        with idle:
+            if stopping.is_set():
+                message.nack()
+                return
+            in_flight[0] += 1
+        try:
+            # Held messages also keep flow control from pulling more the worker would only shed
+            outcome = explore_while_shed(
+                lambda: explore.handle_message(
+                    message.data, dict(message.attributes), tokens, config, on_stored=settle(message)
+                ),
+                stopping,
+            )
+            if outcome == explore.RETRY:
+                message.nack()
+            elif outcome == explore.DEAD_LETTERED:
+                message.ack()
+            # PROCESSED messages are acknowledged by `settle` once their tiles are stored
+        finally:
+            with idle:
+                in_flight[0] -= 1
+                idle.notify_all()
+
+    flow_control = pubsub_v1.types.FlowControl(
+        max_messages=max_outstanding_messages,
+        max_lease_duration=MAX_LEASE_DURATION,
+    )
+    scheduler = ThreadScheduler(executor=ThreadPoolExecutor(max_workers=concurrency))
+    streaming_pull_future = subscriber.subscribe(
+        subscription_path,
+        callback=callback,
+        flow_control=flow_control,
+        scheduler=scheduler,
+        await_callbacks_on_shutdown=True,
+    )
+    logger.info(f"Listening on {subscription_path} with concurrency={concurrency}, max_outstanding_messages={max_outstanding_messages}")
+
+    def shutdown(signum, frame):
+        logger.info(f"Received signal {signum}, stopping streaming pull...")
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    with subscriber:
+        while not stopping.wait(1.0) and not streaming_pull_future.done():
+            pass
+        if stopping.is_set():
+            # Acknowledge the messages explored so far while the stream is still open
+            with idle:
+                idle.wait_for(lambda: in_flight[0] == 0)
+            explore.flush_outputs()
+            streaming_pull_future.cancel()
+        try:
+            streaming_pull_future.result()
+        except Exception as e:
+            if not streaming_pull_future.cancelled():
+                logger.exception(f"Streaming pull terminated unexpectedly: {e}")
+                raise
+    tokens.stop_background_refresh()
+    explore.close_outputs()
+    telemetry.flush()
+    logger.info(f"Worker stopped. Strava accounts: {tokens.summary()}, dependencies: {resilience.summary()}")
+
+
+def pull_once(max_messages: int = 50):
+    """Pulls one batch of messages and explores them in turn, acknowledging each once its
+    tiles are stored and extending the deadline of those still waiting"""
+    from google.cloud import pubsub_v1
+
+    config = load_config()
+    gcp_project_id = config["gcp_project_id"]
+    tokens = get_token_pool(gcp_project_id, ENV, config["db_params"])
+
+    subscriber = pubsub_v1.SubscriberClient()
+    subscription_id = config["tf_outputs"]["pubsub_topic_sub"]["value"]
+    subscription_path = subscriber.subscription_path(gcp_project_id, subscription_id)
+
+    logger.info(f"Fetching up to {max_messages} messages from subscription {subscription_id}")
+    with telemetry.timed(telemetry.pubsub_duration, "pubsub pull", operation="pull"):
+        response = subscriber.pull(request={"subscription": subscription_path, "max_messages": max_messages})
+    messages = response.received_messages
+    logger.info(f"Fetched {len(messages)} messages")
+
+    if not messages:
+        logger.info("No messages available.")
+        return
+
+    def acknowledge(msg):
+        with telemetry.timed(telemetry.pubsub_duration, "pubsub ack", operation="ack"):
+            subscriber.acknowledge(request={"subscription": subscription_path, "ack_ids": [msg.ack_id]})
+        logger.info(f"Acknowledged message {msg.message.message_id}")
+
+    def set_deadline(ack_ids, seconds: int):
+        subscriber.modify_ack_deadline(
+            request={"subscription": subscription_path, "ack_ids": ack_ids, "ack_deadline_seconds": seconds}
+        )
+
+    # Processed messages waiting for their tiles to be stored, acknowledged from the storing thread
+    waiting = {}
+    waiting_lock = threading.Lock()
+
+    def settle(msg):
+        def on_stored(error):
+            with waiting_lock:
+                waiting.pop(msg.ack_id, None)
+            if error is None:
+                acknowledge(msg)
+            else:
+                logger.warning(f"Tiles of message {msg.message.message_id} were not stored, nacking it: {error}")
+                set_deadline([msg.ack_id], 0)
+
+        return on_stored
+
+    def extend_lease(msg):
+        def extend(seconds: int):
+            with waiting_lock:
+                held = list(waiting)
+            set_deadline(list(dict.fromkeys([msg.ack_id] + held)), min(seconds, MAX_ACK_DEADLINE_SECONDS))
+
+        return extend
+
+    never_stopping = threading.Event()
+    for msg in messages:
+        with waiting_lock:
+            held = list(waiting)
+            waiting[msg.ack_id] = msg
+        if held:
+            set_deadline(held, PULL_ACK_DEADLINE_SECONDS)
+        outcome = explore_while_shed(
+            lambda: explore.handle_message(
+                msg.message.data, dict(msg.message.attributes), tokens, config, on_stored=settle(msg)
+            ),
+            never_stopping,
+            extend_lease(msg),
+        )
+        if outcome == explore.PROCESSED:
+            continue
+        with waiting_lock:
+            waiting.pop(msg.ack_id, None)
+        if outcome == explore.RETRY:
+            # Nack so Pub/Sub redelivers with the subscription's retry backoff
+            set_deadline([msg.ack_id], 0)
+            continue
+        acknowledge(msg)
+
+    explore.flush_outputs()
+    telemetry.flush()
+    logger.info(f"Strava accounts: {tokens.summary()}")
+
+
+def event_age_seconds(context) -> float:
+    """Seconds since the Pub/Sub event was first published"""
+    timestamp = getattr(context, "timestamp", None)
+    if not timestamp:
+        return 0.0
+    published = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    return (datetime.now(timezone.utc) - published).total_seconds()
+
+
+def explore_pubsub_event(event, context):
+    """Entry point for Google Cloud Function (Pub/Sub trigger).
+
+    Retryable failures are re-raised so the function is retried, until the event is
+    older than MAX_EVENT_AGE_SECONDS. Permanent failures, and retryable ones past that
+    age, are dead-lettered and the event is acknowledged by returning normally.
+    """
+    telemetry.setup("segment-explorer-function")
+    logger.info("Pub/Sub event received")
+    data = base64.b64decode(event.get("data", ""))
+    attributes = event.get("attributes") or {}
+    stored = []
+    try:
+        config = load_config()
+        # Module level pool: warm instances reuse cached tokens and quota tracking across invocations
+        tokens = get_token_pool(config["gcp_project_id"], ENV, config["db_params"])
+
+        age = event_age_seconds(context)
+        give_up_retrying = f"after {int(age)}s" if age >= MAX_EVENT_AGE_SECONDS else None
+        with profiling.profiled(
+            "explorer",
+            open_blob_store(config["blob_store_url"]),
+            profiling.requested(attributes),
+            attributes.get("trace_id"),
+        ):
+            outcome = explore.handle_message(data, attributes, tokens, config, give_up_retrying, on_stored=stored.append)
+        if outcome == explore.RETRY:
+            raise failures.RetryableError("redeliver", "Message will be retried by the Pub/Sub trigger")
+        logger.info(f"Pub/Sub message {outcome}")
+    finally:
+        # The instance may be frozen once the function returns
+        explore.flush_outputs()
+        telemetry.flush()
+        logging_config.flush_logs()
+    # Flushing stored the message's tiles, or gave up on them
+    if outcome == explore.PROCESSED and stored != [None]:
+        raise failures.RetryableError("store_failed", f"Explored tiles were not stored: {stored[0] if stored else 'never settled'}")
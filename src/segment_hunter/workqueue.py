@@ -0,0 +1,183 @@
+"""Work queue of bounding boxes to explore
+
+`bounding_boxes` is the grid catalogue, written once when a grid is loaded. The state
+dispatch and the explorers churn through lives in `bbox_queue`, one narrow row per
+bounding box, see sql/create_bbox_queue.sql:
+
+- `claim` moves the highest priority pending boxes to dispatched in one statement,
+  reading the partial index of pending rows and skipping rows another dispatcher has
+  locked, so concurrent dispatchers never hand out the same box
+- explorers `complete` boxes as fetched or failed once their batch is stored
+- `release` puts claimed boxes whose message was never sent back to pending, and
+  `requeue_stale` those dispatched more than sweeps.REDISPATCH_SECONDS ago and never
+  completed, e.g. because their message was lost
+
+Statuses are the enum bbox_status, declared with the values of tilegrid.STATUSES.
+Every function takes the schema, so `segment-hunter bench-queue`, see `queuebench`,
+runs the same statements on a throwaway copy.
+"""
+
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+from segment_hunter import logging_config, resilience, telemetry
+from segment_hunter.grid import read_sql_file
+
+if TYPE_CHECKING:
+    from segment_hunter.tilegrid import TileGrid
+
+logger = logging_config.get_logger(__name__)
+
+DEFAULT_SCHEMA = "public"
+
+
+def create_tables(cur, schema: str = DEFAULT_SCHEMA):
+    """Creates the bounding boxes catalogue and the queue, see `enqueue_new_rows` to fill it"""
+    from psycopg2 import sql
+
+    for name in ("create_bounding_boxes.sql", "create_bbox_queue.sql"):
+        cur.execute(sql.SQL(read_sql_file(name)).format(schema=sql.Identifier(schema)))
+
+
+def enqueue_new_rows(cur, schema: str = DEFAULT_SCHEMA):
+    """Queues the bounding boxes not queued yet, e.g. just loaded or loaded before the
+    queue existed, and copies Hilbert indexes assigned since they were queued"""
+    from psycopg2 import sql
+
+    cur.execute(sql.SQL(read_sql_file("queue_bounding_boxes.sql")).format(schema=sql.Identifier(schema)))
+
+
+def claim_rows(cur, limit: int, schema: str = DEFAULT_SCHEMA) -> "TileGrid":
+    """Marks up to `limit` pending bounding boxes dispatched, highest priority first then
+    along the Hilbert curve, and returns them. Commit to make the claim visible."""
+    from psycopg2 import sql
+
+    from segment_hunter.tilegrid import TileGrid, status_sql
+
+    query = sql.SQL(
+        f"""
+        WITH claimed AS (
+            UPDATE {{schema}}.bbox_queue AS q SET status = 'dispatched', updated_at = now()
+            FROM (
+                SELECT bbox_id FROM {{schema}}.bbox_queue WHERE status = 'pending'
+                ORDER BY priority DESC, hilbert, bbox_id LIMIT %s FOR UPDATE SKIP LOCKED
+            ) AS c
+            WHERE q.bbox_id = c.bbox_id
+            RETURNING q.bbox_id, q.status, q.priority, q.segment_count, q.hilbert
+        )
+        SELECT b.id, b.sw_latitude, b.sw_longitude, b.ne_latitude, b.ne_longitude, {status_sql("c.status")},
+               c.priority, coalesce(c.segment_count, -1), coalesce(c.hilbert, -1)
+        FROM claimed c JOIN {{schema}}.bounding_boxes b ON b.id = c.bbox_id
+        ORDER BY c.priority DESC, c.hilbert, c.bbox_id
+        """
+    ).format(schema=sql.Identifier(schema))
+    cur.execute(query, (limit,))
+    return TileGrid.from_cursor(cur)
+
+
+def complete_rows(
+    cur,
+    bbox_ids: List[int],
+    status: str = "fetched",
+    segment_counts: Optional[List[int]] = None,
+    reason: Optional[str] = None,
+    schema: str = DEFAULT_SCHEMA,
+) -> int:
+    """Sets the status of bounding boxes, with the segments each one returned if given
+
+    Returns:
+        int: Number of bounding boxes updated
+    """
+    from psycopg2 import sql
+
+    if segment_counts is None:
+        query = sql.SQL(
+            "UPDATE {schema}.bbox_queue SET status = %s::{schema}.bbox_status, failure_reason = %s, updated_at = now() "
+            "WHERE bbox_id = ANY(%s)"
+        ).format(schema=sql.Identifier(schema))
+        params = (status, reason, list(bbox_ids))
+    else:
+        query = sql.SQL(
+            "UPDATE {schema}.bbox_queue AS q SET status = %s::{schema}.bbox_status, failure_reason = %s, "
+            "segment_count = c.segment_count, updated_at = now() "
+            "FROM unnest(%s::int[], %s::int[]) AS c(bbox_id, segment_count) WHERE q.bbox_id = c.bbox_id"
+        ).format(schema=sql.Identifier(schema))
+        params = (status, reason, list(bbox_ids), list(segment_counts))
+    cur.execute(query, params)
+    return cur.rowcount
+
+
+def release_rows(cur, bbox_ids: List[int], schema: str = DEFAULT_SCHEMA) -> int:
+    """Puts claimed bounding boxes back to pending, unless an explorer completed them since"""
+    from psycopg2 import sql
+
+    query = sql.SQL(
+        "UPDATE {schema}.bbox_queue SET status = 'pending', updated_at = now() "
+        "WHERE bbox_id = ANY(%s) AND status = 'dispatched'"
+    ).format(schema=sql.Identifier(schema))
+    cur.execute(query, (list(bbox_ids),))
+    return cur.rowcount
+
+
+def requeue_stale_rows(cur, seconds: float, schema: str = DEFAULT_SCHEMA) -> int:
+    """Puts bounding boxes dispatched more than `seconds` ago back to pending"""
+    from psycopg2 import sql
+
+    query = sql.SQL(
+        "UPDATE {schema}.bbox_queue SET status = 'pending', updated_at = now() "
+        "WHERE status = 'dispatched' AND updated_at < now() - make_interval(secs => %s)"
+    ).format(schema=sql.Identifier(schema))
+    cur.execute(query, (seconds,))
+    return cur.rowcount
+
+
+def claim(db_params: Dict[str, Any], limit: int) -> "TileGrid":
+    """Claims up to `limit` pending bounding boxes for dispatch, see `claim_rows`"""
+    import psycopg2
+
+    with telemetry.timed(telemetry.db_duration, "db claim_bboxes", operation="claim_bboxes"):
+        with psycopg2.connect(**db_params) as conn:
+            with conn.cursor() as cur:
+                tiles = claim_rows(cur, limit)
+                conn.commit()
+    return tiles
+
+
+def complete(
+    db_params: Dict[str, Any],
+    bbox_ids: List[int],
+    status: str = "fetched",
+    segment_counts: Optional[List[int]] = None,
+    reason: Optional[str] = None,
+):
+    """Marks bounding boxes fetched or failed from an explorer, see `complete_rows`"""
+    import psycopg2
+
+    with telemetry.timed(telemetry.db_duration, "db complete_bboxes", operation="complete_bboxes"):
+        with resilience.dependency("postgres").call(), psycopg2.connect(**db_params) as conn:
+            with conn.cursor() as cur:
+                complete_rows(cur, bbox_ids, status, segment_counts, reason)
+                conn.commit()
+
+
+def release(db_params: Dict[str, Any], bbox_ids: List[int]) -> int:
+    import psycopg2
+
+    with telemetry.timed(telemetry.db_duration, "db release_bboxes", operation="release_bboxes"):
+        with psycopg2.connect(**db_params) as conn:
+            with conn.cursor() as cur:
+                released = release_rows(cur, bbox_ids)
+                conn.commit()
+    return released
+
+
+def requeue_stale(db_params: Dict[str, Any], seconds: float) -> int:
+    import psycopg2
+
+    with telemetry.timed(telemetry.db_duration, "db requeue_stale", operation="requeue_stale"):
+        with psycopg2.connect(**db_params) as conn:
+            with conn.cursor() as cur:
+                requeued = requeue_stale_rows(cur, seconds)
+                conn.commit()
+    if requeued:
+        logger.info(f"Requeued {requeued} bounding boxes dispatched more than {seconds:.0f}s ago")
+    return requeued
@@ -13,14 +13,15 @@ module "iam" {
 }
 
 module "secretmanager" {
-  source        = "./modules/secretmanager"
-  env           = local.env
-  project_id    = var.project_id
-  client_id     = var.client_id
-  client_secret = var.client_secret
-  refresh_token = var.refresh_token
-  access_token  = var.access_token
-  sa_password   = var.sa_password
+  source          = "./modules/secretmanager"
+  env             = local.env
+  project_id      = var.project_id
+  client_id       = var.client_id
+  client_secret   = var.client_secret
+  refresh_token   = var.refresh_token
+  access_token    = var.access_token
+  sa_password     = var.sa_password
+  strava_accounts = var.strava_accounts
 }
 
 module "object_storage" {
@@ -4,4 +4,22 @@ resource "google_bigquery_dataset" "segment_dataset" {
     delete_contents_on_destroy = true
     
     labels = var.tags
-}
\ No newline at end of file
+}
+
+# Typed segment rows, appended by the explorer through the Storage Write API or loaded
+# from NDJSON. Keep in sync with SEGMENT_SCHEMA in src/segment_hunter/sinks.py
+resource "google_bigquery_table" "segments" {
+    dataset_id = google_bigquery_dataset.segment_dataset.dataset_id
+    table_id = var.segments_table_id
+    deletion_protection = false
+
+    time_partitioning {
+        type = "DAY"
+    }
+    # Region queries filter on Hilbert index ranges and only read the matching blocks
+    clustering = ["hilbert", "id"]
+
+    schema = file("${path.module}/segments_schema.json")
+
+    labels = var.tags
+}
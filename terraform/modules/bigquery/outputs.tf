@@ -0,0 +1,3 @@
+output "segments_table" {
+  value = "${google_bigquery_table.segments.project}.${google_bigquery_table.segments.dataset_id}.${google_bigquery_table.segments.table_id}"
+}
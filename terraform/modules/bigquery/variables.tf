@@ -8,4 +8,9 @@ variable "tags" {
   type        = map(string)
   default     = {}
   description = "Tags/labels to apply to all resources in this module"
-}
\ No newline at end of file
+}
+variable "segments_table_id" {
+  type        = string
+  description = "ID of the table segments are written to"
+  default = "segments"
+}
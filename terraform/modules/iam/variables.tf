@@ -15,6 +15,7 @@ variable "iam_roles" {
     "roles/storage.admin",
     "roles/cloudsql.admin",
     "roles/pubsub.admin",
+    "roles/bigquery.dataEditor",
     "roles/cloudfunctions.admin",
     "roles/cloudbuild.builds.builder",
     "roles/run.sourceDeveloper",
@@ -16,10 +16,12 @@ resource "google_storage_bucket" "source_bucket" {
   public_access_prevention = "enforced"
 }
 
+# Run functions/build.sh first, it vendors the segment_hunter package into the function
 data "archive_file" "segment_explorer_zip" {
   type        = "zip"
   output_path = "../tmp/segment_explorer_lambda.zip"
-  source_file = "../src/segment_explorer_lambda.py"
+  source_dir  = "../functions/segment_explorer"
+  excludes    = ["__pycache__"]
 }
 
 resource "google_storage_bucket_object" "segment_explorer_src" {
@@ -47,6 +47,15 @@ resource "google_pubsub_topic" "segment_explorer_dlq" {
   }
 }
 
+# Pull subscription used by `segment-hunter replay-dlq` (src/segment_hunter/replay.py) to inspect and replay dead letters
+resource "google_pubsub_subscription" "segment_explorer_dlq_sub" {
+  name                       = "segment-explorer-dlq-sub--${var.env}"
+  topic                      = google_pubsub_topic.segment_explorer_dlq.id
+  labels                     = var.tags
+  ack_deadline_seconds       = 60
+  message_retention_duration = "604800s"
+}
+
 
 resource "google_pubsub_subscription" "segment_explorer_ndjson_sub" {
   name                 = "segment-explorer-ndjsonconvert-sub--${var.env}"
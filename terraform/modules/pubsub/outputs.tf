@@ -4,4 +4,12 @@ output "topic_name" {
 
 output "sub_name" {
   value = google_pubsub_subscription.segment_explorer_sub.name
+}
+
+output "dlq_topic_name" {
+  value = google_pubsub_topic.segment_explorer_dlq.name
+}
+
+output "dlq_sub_name" {
+  value = google_pubsub_subscription.segment_explorer_dlq_sub.name
 }
\ No newline at end of file
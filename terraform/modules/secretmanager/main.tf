@@ -1,8 +1,32 @@
+locals {
+  # Extra Strava API applications for the token pool, read via STRAVA_ACCOUNTS
+  strava_account_secrets = flatten([
+    for name, account in var.strava_accounts : [
+      {
+        name        = "strava-client-secret--${var.env}--${name}"
+        secret_data = account.client_secret
+      },
+      {
+        name        = "strava-client-id--${var.env}--${name}"
+        secret_data = account.client_id
+      },
+      {
+        name        = "strava-refresh-token--${var.env}--${name}"
+        secret_data = account.refresh_token
+      },
+      {
+        name        = "strava-access-token--${var.env}--${name}"
+        secret_data = account.access_token
+      },
+    ]
+  ])
+}
+
 module "secret-manager" {
   source     = "GoogleCloudPlatform/secret-manager/google"
   version    = "~> 0.8"
   project_id = var.project_id
-  secrets = [
+  secrets = concat([
     {
       name        = "strava-client-secret--${var.env}"
       secret_data = var.client_secret
@@ -23,5 +47,5 @@ module "secret-manager" {
       name        = "postgres-service-account-pwd--${var.env}"
       secret_data = var.sa_password
     }
-  ]
+  ], local.strava_account_secrets)
 }
\ No newline at end of file
@@ -37,3 +37,16 @@ variable "sa_password" {
   description = "Password for DB service account"
   sensitive   = true
 }
+
+
+variable "strava_accounts" {
+  type = map(object({
+    client_id     = string
+    client_secret = string
+    refresh_token = string
+    access_token  = string
+  }))
+  description = "Additional Strava API applications, keyed by account name"
+  default     = {}
+  sensitive   = true
+}
\ No newline at end of file
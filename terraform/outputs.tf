@@ -16,4 +16,16 @@ output "pubsub_topic_path" {
 
 output "pubsub_topic_sub" {
   value = module.pubsub.sub_name
-}
\ No newline at end of file
+}
+
+output "pubsub_dlq_topic" {
+  value = module.pubsub.dlq_topic_name
+}
+
+output "pubsub_dlq_sub" {
+  value = module.pubsub.dlq_sub_name
+}
+
+output "bigquery_segments_table" {
+  value = module.bigqueza.segments_table
+}
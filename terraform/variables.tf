@@ -32,6 +32,19 @@ variable "access_token" {
   description = "Strava User Access Token"
   sensitive   = true
 }
+
+variable "strava_accounts" {
+  type = map(object({
+    client_id     = string
+    client_secret = string
+    refresh_token = string
+    access_token  = string
+  }))
+  description = "Additional Strava API applications, keyed by account name"
+  default     = {}
+  sensitive   = true
+}
+
 variable "tier" {
   type        = string
   description = "Cloud SQL database instance tier"